@@ -1,7 +1,8 @@
 # from cyac import AC
 from bench_init import *
 
-sep = set([ord(s) for s in ['.', '\t', '\n', '\a', ' ', ',']])
+seps = ['.', '\t', '\n', '\a', ' ', ',']
+sep = Separators(seps) if Separators is not None else set([ord(s) for s in seps])
 
 
 def extract_re(pat, txt):
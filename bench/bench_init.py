@@ -4,6 +4,11 @@ from hat_trie import Trie as HTrie
 import re, os
 import timeit
 
+try:
+    from cyac import Separators
+except ImportError: # before 2.0, seperators are a set of code points
+    Separators = None
+
 def read_file():
     dir_ = os.path.dirname(__file__)
     with open("%s/words.txt" % dir_) as fi:
@@ -41,6 +46,9 @@ def init_trie(words, size):
         trie.insert(words[i])
     return trie
 
+def init_trie_build(words, size):
+    return Trie.build(words[:size])
+
 def init_htrie(words, size):
     trie = HTrie()
     for i in range(size):
@@ -50,11 +58,12 @@ def init_htrie(words, size):
 
 if __name__ == '__main__':
     words = read_file()
-    setup = "from __main__ import init_flashtext, init_re, init_ac, init_trie, init_htrie, words"
+    setup = "from __main__ import init_flashtext, init_re, init_ac, init_trie, init_trie_build, init_htrie, words"
 
     for size in range(20000, len(words), 20000):
         print("build", "re", size, timeit.timeit("init_re(words, %s)" % size, setup=setup, number=5))
         print("build", "flashtext", size, timeit.timeit("init_flashtext(words, %s)" % size, setup=setup, number=5))
         print("build", "hat-trie", size, timeit.timeit("init_htrie(words, %s)" % size, setup=setup, number=5))
         print("build", "trie", size, timeit.timeit("init_trie(words, %s)" % size, setup=setup, number=5))
+        print("build", "trie.build", size, timeit.timeit("init_trie_build(words, %s)" % size, setup=setup, number=5))
         print("build", "ac", size, timeit.timeit("init_ac(words, %s)" % size, setup=setup, number=5))
\ No newline at end of file
@@ -0,0 +1,347 @@
+"""
+self-contained benchmark of cyac, it needs no other package and no data file.
+corpora are generated from a seed, so runs on different machines or releases measure the same work.
+each case runs in a forked process when it's possible, so its peak rss is its own.
+it runs with older releases too, cases of the api they don't have are skipped.
+
+    python bench_suite.py --out 1.9.json            # full run
+    python bench_suite.py --quick --out new.json    # small corpora, a few seconds
+    python bench_suite.py --quick --compare 1.9.json # print the ratio to a previous run, exit 1 on regressions
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import pickle
+import platform
+import random
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError: # windows
+    resource = None
+
+import cyac
+from cyac import AC, Trie
+
+try:
+    from cyac import Separators
+except ImportError: # before 2.0, seperators are a set of code points
+    Separators = None
+
+CJK_BASE = 0x4e00
+CJK_NUM = 3000
+
+
+def make_words(alphabet, size, seed):
+    """
+    size distinct words, ascii words have 3 - 12 lowercase letters, cjk words have 2 - 4 common chars
+    """
+    rnd = random.Random(seed)
+    words = set()
+    while len(words) < size:
+        if alphabet == "ascii":
+            words.add(u"".join(rnd.choice(u"abcdefghijklmnopqrstuvwxyz") for _ in range(rnd.randint(3, 12))))
+        else:
+            words.add(u"".join(chr(CJK_BASE + rnd.randrange(CJK_NUM)) for _ in range(rnd.randint(2, 4))))
+    words = sorted(words)
+    rnd.shuffle(words)
+    return words
+
+
+def make_text(alphabet, words, density, chars, seed):
+    """
+    text of about chars chars, a token is a dictionary word with the probability density,
+    other tokens are random words which are unlikely to be in the dictionary.
+    ascii tokens are seperated by spaces, cjk tokens aren't seperated.
+    """
+    rnd = random.Random(seed)
+    misses = make_words(alphabet, 1000, seed + 1)
+    sep = u" " if alphabet == "ascii" else u""
+    tokens = []
+    size = 0
+    while size < chars:
+        token = rnd.choice(words) if rnd.random() < density else rnd.choice(misses)
+        tokens.append(token)
+        size += len(token) + len(sep)
+    return sep.join(tokens)
+
+
+def make_chain(depth, size, seed):
+    """
+    a dictionary where the fail links of "a" * depth form a chain of depth states,
+    and a text where every char walks it
+    """
+    words = [u"a" * i for i in range(1, depth + 1)]
+    words += [w for w in make_words("ascii", size, seed) if u"a" * 2 not in w][:size - depth]
+    text = (u"a" * depth + u"b") * 1000
+    return words, text
+
+
+def has_arrays():
+    # as_arrays of match, match_longest and prefix, missing before 2.0
+    try:
+        AC.build([u"a"]).match(u"a", as_arrays = True)
+    except TypeError:
+        return False
+    return True
+
+
+def build_trie(words):
+    if hasattr(Trie, "build"):
+        return Trie.build(words)
+    trie = Trie()
+    for w in words:
+        trie.insert(w)
+    return trie
+
+
+def make_seps(sep):
+    if not sep:
+        return None
+    if Separators is None:
+        return set(ord(c) for c in sep)
+    return Separators(sep)
+
+
+def best_time(fn, repeat):
+    ret = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        cost = time.perf_counter() - start
+        ret = cost if ret is None else min(ret, cost)
+    return ret
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss // 1024 if sys.platform == "darwin" else rss
+
+
+def run_isolated(case, args):
+    # returns what case returns with the peak rss of the process running it
+    if "fork" not in multiprocessing.get_all_start_methods():
+        ret = case(*args)
+        ret["peak_rss_kb"] = peak_rss_kb()
+        return ret
+    ctx = multiprocessing.get_context("fork")
+    reader, writer = ctx.Pipe(duplex=False)
+
+    def child():
+        ret = case(*args)
+        ret["peak_rss_kb"] = peak_rss_kb()
+        writer.send(ret)
+
+    p = ctx.Process(target=child)
+    p.start()
+    ret = reader.recv()
+    p.join()
+    return ret
+
+
+def throughput(seconds, ops = None, text = None):
+    ret = {"seconds": seconds}
+    if ops is not None:
+        ret["ops_per_sec"] = ops / seconds
+    if text is not None:
+        ret["mb_per_sec"] = len(text.encode("utf8")) / seconds / 1e6
+    return ret
+
+
+def case_trie(words, repeat):
+    ret = {}
+    trie = Trie()
+
+    def insert():
+        for w in words:
+            trie.insert(w)
+
+    def remove():
+        for w in words:
+            trie.remove(w)
+
+    # insert and remove alternate, so each insert starts from an empty trie
+    insert_time = remove_time = None
+    for _ in range(repeat):
+        cost = best_time(insert, 1)
+        insert_time = cost if insert_time is None else min(insert_time, cost)
+        cost = best_time(remove, 1)
+        remove_time = cost if remove_time is None else min(remove_time, cost)
+    ret["trie.insert"] = throughput(insert_time, ops = len(words))
+    ret["trie.remove"] = throughput(remove_time, ops = len(words))
+    trie = build_trie(words)
+
+    def get():
+        for w in words:
+            trie.get(w)
+
+    ret["trie.get"] = throughput(best_time(get, repeat), ops = len(words))
+    if hasattr(trie, "get_many"):
+        ret["trie.get_many"] = throughput(best_time(lambda: trie.get_many(words), repeat), ops = len(words))
+    if hasattr(Trie, "build"):
+        ret["trie.build"] = throughput(best_time(lambda: Trie.build(words), repeat), ops = len(words))
+    return ret
+
+
+def case_ac_build(words, repeat):
+    return {"ac.build": throughput(best_time(lambda: AC.build(words), repeat), ops = len(words))}
+
+
+def case_match(words, text, sep, repeat):
+    # the results are listed by every release, and also read as arrays by releases which have them
+    ac = AC.build(words)
+    trie = build_trie(words)
+    list(ac.match(u"")) # the links are built
+    seps = make_seps(sep)
+    ret = {
+        "ac.match": throughput(best_time(lambda: list(ac.match(text)), repeat), text = text),
+        "ac.match_longest": throughput(best_time(lambda: list(ac.match_longest(text, seps)), repeat), text = text),
+        "trie.match_longest": throughput(best_time(lambda: list(trie.match_longest(text, seps)), repeat), text = text),
+        "trie.replace_longest": throughput(best_time(lambda: trie.replace_longest(text, lambda x, start, end: u"-", seps), repeat), text = text),
+    }
+    if has_arrays():
+        ret["ac.match_arrays"] = throughput(best_time(lambda: ac.match(text, as_arrays = True), repeat), text = text)
+        ret["ac.match_longest_arrays"] = throughput(best_time(lambda: ac.match_longest(text, seps, as_arrays = True), repeat), text = text)
+        ret["trie.match_longest_arrays"] = throughput(best_time(lambda: trie.match_longest(text, seps, as_arrays = True), repeat), text = text)
+    return ret
+
+
+def case_chain(words, text, repeat):
+    ac = AC.build(words)
+    list(ac.match(u""))
+    ret = {"ac.match": throughput(best_time(lambda: list(ac.match(text)), repeat), text = text)}
+    if has_arrays():
+        ret["ac.match_arrays"] = throughput(best_time(lambda: ac.match(text, as_arrays = True), repeat), text = text)
+    return ret
+
+
+def case_image(words, repeat):
+    ret = {}
+    ac = AC.build(words)
+    list(ac.match(u""))
+    size = ac.buff_size()
+    fd, fname = tempfile.mkstemp(suffix = ".bin")
+    os.close(fd)
+    try:
+        ret["ac.save"] = throughput(best_time(lambda: ac.save(fname), repeat), ops = 1)
+        with open(fname, "rb") as fi:
+            data = bytearray(fi.read())
+        ret["ac.from_buff"] = throughput(best_time(lambda: AC.from_buff(data, copy = True), repeat), ops = 1)
+        ret["ac.from_buff_shared"] = throughput(best_time(lambda: AC.from_buff(data, copy = False), repeat), ops = 1)
+    finally:
+        os.remove(fname)
+    dumped = pickle.dumps(ac)
+    ret["ac.pickle_dumps"] = throughput(best_time(lambda: pickle.dumps(ac), repeat), ops = 1)
+    ret["ac.pickle_loads"] = throughput(best_time(lambda: pickle.loads(dumped), repeat), ops = 1)
+    for x in ret.values():
+        x["mb_per_sec"] = size / x["seconds"] / 1e6
+    ret["image_bytes"] = size
+    return ret
+
+
+def plan(quick):
+    # (group, params, case, args)
+    sizes = [1000, 20000] if quick else [1000, 100000, 500000]
+    chars = 200000 if quick else 2000000
+    densities = [0.05, 0.5]
+    depths = [4, 32] if quick else [4, 32, 128]
+    repeat = 3 if quick else 5
+    seed = 2021
+    for alphabet in ["ascii", "cjk"]:
+        for size in sizes:
+            words = make_words(alphabet, size, seed)
+            params = {"alphabet": alphabet, "words": size}
+            yield "trie", params, case_trie, (words, repeat)
+            yield "ac", params, case_ac_build, (words, repeat)
+            yield "image", params, case_image, (words, repeat)
+            for density in densities:
+                text = make_text(alphabet, words, density, chars, seed)
+                params = {"alphabet": alphabet, "words": size, "density": density, "chars": len(text)}
+                yield "match", params, case_match, (words, text, u" " if alphabet == "ascii" else u"", repeat)
+    for depth in depths:
+        words, text = make_chain(depth, 1000, seed)
+        yield "fail_chain", {"depth": depth, "words": len(words), "chars": len(text)}, case_chain, (words, text, repeat)
+
+
+def run(quick, out = sys.stderr):
+    results = []
+    for group, params, case, args in plan(quick):
+        ret = run_isolated(case, args)
+        rss = ret.pop("peak_rss_kb")
+        image_bytes = ret.pop("image_bytes", None)
+        for name, x in sorted(ret.items()):
+            row = {"name": name, "group": group, "params": params, "peak_rss_kb": rss}
+            if image_bytes is not None:
+                row["image_bytes"] = image_bytes
+            row.update(x)
+            results.append(row)
+            out.write("%-26s %-60s %s\n" % (name, json.dumps(params, sort_keys = True), describe(x)))
+    return {
+        "meta": {
+            "cyac": getattr(cyac, "__version__", None),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "quick": quick,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+def describe(x):
+    if "mb_per_sec" in x:
+        return "%10.2f MB/s" % x["mb_per_sec"]
+    return "%12.0f ops/s" % x["ops_per_sec"]
+
+
+def result_key(row):
+    return row["name"], json.dumps(row["params"], sort_keys = True)
+
+
+def compare(report, baseline, threshold):
+    """
+    print the speed of each case relative to baseline, returns the cases slower than 1 - threshold
+    """
+    old = dict((result_key(r), r) for r in baseline["results"])
+    slower = []
+    for row in report["results"]:
+        prev = old.get(result_key(row))
+        if prev is None:
+            continue
+        ratio = prev["seconds"] / row["seconds"]
+        mark = ""
+        if ratio < 1 - threshold:
+            mark = " SLOWER"
+            slower.append(row)
+        print("%-26s %-60s %6.2fx%s" % (row["name"], json.dumps(row["params"], sort_keys = True), ratio, mark))
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "benchmark cyac on generated corpora")
+    parser.add_argument("--quick", action = "store_true", help = "small corpora")
+    parser.add_argument("--out", help = "write the results as json")
+    parser.add_argument("--compare", help = "json of a previous run")
+    parser.add_argument("--threshold", type = float, default = 0.1, help = "slowdown reported as regression")
+    args = parser.parse_args()
+    report = run(args.quick)
+    if args.out:
+        with open(args.out, "w") as fo:
+            json.dump(report, fo, indent = 1, sort_keys = True)
+    if args.compare:
+        with open(args.compare) as fi:
+            baseline = json.load(fi)
+        if compare(report, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
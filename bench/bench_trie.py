@@ -5,6 +5,9 @@ def get_trie(trie, words, size):
     for i in range(size):
         trie.get(words[i])
 
+def get_many_trie(trie, words, size):
+    trie.get_many(words[:size])
+
 def get_htrie(trie, words, size):
     for i in range(size):
         trie[words[i]]
@@ -16,7 +19,7 @@ def remove_trie(trie, words, size):
 if __name__ == '__main__':
     words = read_file()
     txt = read_txt()
-    setup = "from __main__ import get_trie, get_htrie, remove_trie, trie, htrie, words, size"
+    setup = "from __main__ import get_trie, get_many_trie, get_htrie, remove_trie, trie, htrie, words, size"
 
     for size in range(20000, len(words), 20000):
         trie = init_trie(words, size)
@@ -25,4 +28,5 @@ if __name__ == '__main__':
         # print("build", "re", size, timeit.timeit("replace_re(rex, txt)", setup=setup, number=5))
         print("get", "hat-trie", size, timeit.timeit("get_htrie(htrie, words,size)", setup=setup, number=5), flush=True)
         print("get", "trie", size, timeit.timeit("get_trie(trie, words,size)", setup=setup, number=5), flush=True)
+        print("get", "trie get_many", size, timeit.timeit("get_many_trie(trie, words,size)", setup=setup, number=5), flush=True)
         print("remove", "trie", size, timeit.timeit("remove_trie(trie, words,size)", setup=setup, number=5), flush=True)
\ No newline at end of file
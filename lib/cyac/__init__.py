@@ -1,3 +1,3 @@
 __version__ = "1.9"
-from .ac import AC
-from .trie import Trie
+from .ac import AC, Replacements
+from .trie import Trie, Separators
@@ -1,8 +1,11 @@
 #cython: language_level=3, boundscheck=False, overflowcheck=False
 #    , profile=True, linetrace=True
-from .trie cimport Trie, ignore_case_alignment, ignore_case_offset, array_to_bytes, bytes_to_array, trie_from_buff
-from .xstring cimport xstring
-from .utf8 cimport byte_t
+from .trie cimport Trie, Matched, ignore_case_alignment, ignore_case_offset, array_to_bytes, bytes_to_array, trie_from_buff, check_bounds, matched_iter, matched_to_arrays, payload_source
+from .trie cimport add_row_hits, column_arrays
+from .trie cimport Separators, SepTable, as_separators, sep_table, in_sep, to_char_offsets, to_byte_offsets, char_offset_of_byte, ignore_case_byte_index_mapping
+from .xstring cimport stringbuf
+from .xstring cimport xstring, xbytes, xcolumn, ascii_utf8
+from .utf8 cimport byte_t, char_at_byte, char_before_byte, utf8_char_len
 from .util cimport check_buffer
 from libcpp.deque  cimport deque
 from libc.stdlib cimport malloc, free, realloc
@@ -11,9 +14,16 @@ from libc.stdio cimport *
 from libcpp cimport bool
 from libc.string cimport memset
 from libc.stdint cimport uint32_t
+from libc.limits cimport INT_MAX
 from libcpp.vector cimport vector
+from libcpp.queue cimport priority_queue
+from libcpp.utility cimport pair
 from cpython.buffer cimport PyObject_GetBuffer, PyObject_CheckBuffer, PyBuffer_Release, PyBuffer_GetPointer, Py_buffer, PyBUF_WRITABLE, PyBUF_SIMPLE
-from .version import magic_number, ac_binary_version, legacy_magic_number
+from cpython.unicode cimport PyUnicode_New, PyUnicode_KIND, PyUnicode_DATA, PyUnicode_GET_LENGTH
+from cpython cimport array
+from .version import magic_number, ac_binary_version, ac_large_binary_version, legacy_magic_number
+from .trie import from_image, PickleBuffer, append_checksum, open_image
+from os import cpu_count
 
 def new_object(obj):
     return obj.__new__(obj)
@@ -22,40 +32,125 @@ cdef struct OutNode:
     int next_
     int value
 
-cdef struct Matched:
-    int val
-    int start
-    int end
+ctypedef pair[long long, long long] RankedHit
 
 cdef struct QueueNode:
     int node_id
     int node_label
     int len
 
+_thread_pools = {}
+
+def thread_pool(int n_threads):
+    # worker threads are shared between calls with the same size
+    pool = _thread_pools.get(n_threads)
+    if pool is None:
+        from concurrent.futures import ThreadPoolExecutor
+        pool = _thread_pools.setdefault(n_threads, ThreadPoolExecutor(max_workers=n_threads))
+    return pool
+
+cdef extern from "Python.h":
+    ctypedef unsigned char Py_UCS1
+    ctypedef unsigned short Py_UCS2
+    Py_UCS4 PyUnicode_MAX_CHAR_VALUE(object o)
+
+cdef class Replacements(object):
+    """
+    replacements of keys by id for AC.replace, they are decoded once and shared by the calls using them.
+    Args:
+        replacements : list | tuple | dict
+            a list or tuple indexed by id, or a dict of id to replacement.
+            a replacement is unicode, utf8 bytes, or None to keep the key.
+            a kept key is still a match, the keys overlapping it aren't replaced
+    Examples:
+        >>> reps = Replacements([u"<%s>" % key.upper() for key in keys])
+        >>> for text in texts:
+        >>>     ac.replace(text, reps)
+    """
+    cdef list strs # keeps data alive
+    cdef vector[void*] data # NULL if the key is kept
+    cdef vector[int] kinds
+    cdef vector[Py_ssize_t] lens
+    cdef vector[Py_UCS4] maxchars
+
+    def __init__(self, replacements not None):
+        cdef int id_
+        cdef unicode rep
+        self.strs = []
+        items = replacements.items() if isinstance(replacements, dict) else enumerate(replacements)
+        for id_, value in items:
+            if id_ < 0:
+                raise AttributeError("invalid id: %d" % id_)
+            if value is None:
+                continue
+            if isinstance(value, unicode):
+                rep = value
+            elif isinstance(value, bytes):
+                rep = value.decode("utf8")
+            else:
+                raise Exception("Replaced result should be bytes or unicode")
+            if <size_t>id_ >= self.data.size():
+                self.data.resize(id_ + 1, NULL)
+                self.kinds.resize(id_ + 1, 0)
+                self.lens.resize(id_ + 1, 0)
+                self.maxchars.resize(id_ + 1, 0)
+            self.strs.append(rep)
+            self.data[id_] = PyUnicode_DATA(rep)
+            self.kinds[id_] = PyUnicode_KIND(rep)
+            self.lens[id_] = PyUnicode_GET_LENGTH(rep)
+            self.maxchars[id_] = PyUnicode_MAX_CHAR_VALUE(rep)
+
+    def __len__(self):
+        return self.data.size()
+
+    cdef inline bool has(self, int id_) noexcept nogil:
+        return <size_t>id_ < self.data.size() and self.data[id_] != NULL
+
+
 cdef class AC(object):
     cdef Trie trie
-    # cdef OutNode* output
     cdef int* fails
+    cdef int* outputs # next node with value in the fail chain, 0 if none
+    cdef bool outputs_owned # outputs is allocated even though data is in buff
+    cdef int* depths # byte length of each node's string, built on first use
     cdef unsigned int* key_lens
     cdef Py_buffer* buff
+    cdef bool dirty # keys changed since the links were built, see commit
+    cdef unsigned int generation # increased when the links are rebuilt
 
     property ignore_case:
         def __get__(self):
-            return self.ignore_case
+            return self.trie.ignore_case
     
     property size:
         def __get__(self):
             return self.trie.key_num
 
+    property frozen:
+        def __get__(self):
+            return self.trie.frozen
+
+    property payload_type:
+        def __get__(self):
+            return self.trie.payload_type
+
+    def payload(self, int id_):
+        """
+        get the payload of a key by id, see Trie.payload
+        """
+        return self.trie.payload(id_)
+
     def __getitem__(self, key):
         return self.trie[key]
 
-    def prefix(self, unicode s not None):
+    def prefix(self, unicode s not None, as_arrays = False):
         """
         return the prefix of given string which is in the trie.
         Args:
             key : string
                 keyword that you want to searh
+            as_arrays : bool
+                return two array.array('i') (ids, end_offsets) instead of an iterator
         Iterates:
             prefixes : tuple(id, end_offset)
                 s[:end_offset] matches id
@@ -63,24 +158,48 @@ cdef class AC(object):
             >>> for id_, offset in ac.prefix("python"):
             >>>     print(id_, offset)
         """
-        for x in self.trie.prefix(s):
-            yield x
+        return self.trie.prefix(s, as_arrays)
 
-    def predict(self, unicode s not None):
+    def prefix_bytes(self, data, as_arrays = False):
+        """
+        same as prefix, but data is utf8 text in bytes-like object. offsets are byte offsets.
+        """
+        return self.trie.prefix_bytes(data, as_arrays)
+
+    def predict(self, unicode s not None, with_payload = False, limit = None, order = "bfs"):
         """
         return the string in the trie which starts with given string
         Args:
             key : string
                 keyword that you want to searh
+            with_payload : bool
+                iterate (id, payload) instead of id
+            limit : int | None
+                stop after limit keys
+            order : str
+                "bfs" or "lex", see Trie.predict
         Iterates:
             predicts : id
         Examples:
             >>> for id_ in ac.predict("python"):
             >>>     print(id_)
         """
-        for x in self.trie.predict(s):
+        for x in self.trie.predict(s, with_payload, limit, order):
+            yield x
+
+    def predict_top(self, unicode s not None, int k, with_payload = False):
+        """
+        return the k keys starting with given string which have the largest payloads, see Trie.predict_top
+        """
+        for x in self.trie.predict_top(s, k, with_payload):
             yield x
     
+    def fuzzy(self, unicode word not None, int max_dist = 1):
+        """
+        return the keys which are at most max_dist edits away from word, see Trie.fuzzy
+        """
+        return self.trie.fuzzy(word, max_dist)
+
     def __iter__(self):
         for id_ in self.trie:
             yield id_
@@ -97,25 +216,178 @@ cdef class AC(object):
         for x in self.trie.items():
             yield x
 
+    def keys_buffer(self):
+        """
+        export all keys at once, see Trie.keys_buffer
+        """
+        return self.trie.keys_buffer()
+
+    def build_key_table(self):
+        """
+        keep the utf8 of all keys for fast lookups by id, see Trie.build_key_table
+        """
+        self._own()
+        self.trie.build_key_table()
+
+    def drop_key_table(self):
+        self._own()
+        self.trie.drop_key_table()
+
+    property has_key_table:
+        def __get__(self):
+            return self.trie.has_key_table
+
     def __contains__(self, unicode t):
-        t in self.trie
+        return t in self.trie
 
-    def match_longest(self, unicode s not None, sep = None):
+    def match_longest(self, unicode s not None, sep = None, as_arrays = False, with_payload = False):
         """
         extract trie's keys from given string. only return the longest.
         Args:
             s : unicode
-            sep : set(int) | None
+            sep : Separators | set(int) | None
                 If you specify seperators. e.g. set([ord(' ')]), 
                 it only matches strings tween seperators.
+            as_arrays : bool
+                return three array.array('i') (ids, start_offsets, end_offsets) instead of an iterator
+            with_payload : bool
+                append the payload of each key to the results, it's one more array if as_arrays
         Iterates:
             matched: tuple(id, start_offset, end_offset)
         Examples:
             >>> for id_, start_offset, end_offset in ac.match_longest("python", set([ord(" ")])):
             >>>     print(id_, start_offset, end_offset)
         """
-        for x in self.trie.match_longest(s, sep):
-            yield x
+        return self.match_leftmost(s, sep, True, as_arrays, with_payload)
+
+    def match_longest_fuzzy(self, unicode s not None, int max_dist = 1, sep = None):
+        """
+        extract keys allowing at most max_dist edits in each match, see Trie.match_longest_fuzzy
+        """
+        return self.trie.match_longest_fuzzy(s, max_dist, sep)
+
+    def match_longest_bytes(self, data, sep = None, as_arrays = False, with_payload = False):
+        """
+        same as match_longest, but data is utf8 text in bytes-like object. offsets are byte offsets.
+        """
+        return self.match_leftmost_bytes(data, sep, True, as_arrays, with_payload)
+
+    def match_leftmost(self, unicode s not None, sep = None, longest = True, as_arrays = False, with_payload = False):
+        """
+        extract non-overlapping keys from given string, scanning it once with fail links.
+        among the matches starting at the leftmost position, take the longest one,
+        or the one with the smallest id if longest is False.
+        Args:
+            s : unicode
+            sep : Separators | set(int) | None
+                If you specify seperators. e.g. set([ord(' ')]), 
+                it only matches strings tween seperators.
+            longest : bool
+                leftmost-longest if True, else leftmost-first
+            as_arrays : bool
+                return three array.array('i') (ids, start_offsets, end_offsets) instead of an iterator
+            with_payload : bool
+                append the payload of each key to the results, it's one more array if as_arrays
+        Iterates:
+            matched: tuple(id, start_offset, end_offset)
+        Examples:
+            >>> for id_, start_offset, end_offset in ac.match_leftmost("python", set([ord(" ")])):
+            >>>     print(id_, start_offset, end_offset)
+        """
+        cdef xstring xs = xstring(s)
+        cdef int* mapping = NULL
+        cdef vector[Matched] vect
+        cdef Separators seps = as_separators(sep)
+        cdef SepTable* sep_ptr = sep_table(seps)
+        cdef bool longest_ = longest
+        cdef ignore_case_alignment align
+        if self.trie.ignore_case:
+            align = ignore_case_alignment(xs)
+            xs = align.lowercase
+            mapping = align.lowercase_char_index_mapping
+        if self.dirty:
+            self._link()
+        self._build_depths()
+        with nogil:
+            self._leftmost(xs.bytes_, xs.byte_num, sep_ptr, longest_, vect)
+            to_char_offsets(vect, xs.char_idx_of_byte, mapping)
+        if as_arrays:
+            return matched_to_arrays(vect, True, payload_source(self.trie, with_payload))
+        return matched_iter(vect, True, payload_source(self.trie, with_payload))
+
+    def match_leftmost_bytes(self, data, sep = None, longest = True, as_arrays = False, with_payload = False):
+        """
+        same as match_leftmost, but data is utf8 text in bytes-like object. offsets are byte offsets.
+        """
+        cdef xbytes xb = xbytes(data, self.trie.ignore_case)
+        cdef vector[Matched] vect
+        cdef Separators seps = as_separators(sep)
+        cdef SepTable* sep_ptr = sep_table(seps)
+        cdef bool longest_ = longest
+        if self.dirty:
+            self._link()
+        self._build_depths()
+        with nogil:
+            self._leftmost(xb.bytes_, xb.byte_num, sep_ptr, longest_, vect)
+            to_byte_offsets(vect, xb)
+        if as_arrays:
+            return matched_to_arrays(vect, True, payload_source(self.trie, with_payload))
+        return matched_iter(vect, True, payload_source(self.trie, with_payload))
+
+    def replace_leftmost(self, unicode s not None, callback not None, sep = None, longest = True):
+        """
+        replace the keys found by match_leftmost.
+        Args:
+            s : unicode
+            callback : lambda | list | dict
+                lambda gets (id, start_offset, end_offset)
+            sep : Separators | set(int) | None
+            longest : bool
+                leftmost-longest if True, else leftmost-first
+        Returns:
+            replaced text
+        Examples:
+            >>> python_id = ac.get("python")
+            >>> text = ac.replace_leftmost("python", {python_id: "hahah"}, set([ord(" ")]))
+        """
+        cdef xstring original = xstring(s)
+        cdef xstring xs = original
+        cdef ignore_case_alignment align = None
+        cdef vector[Matched] vect
+        cdef Separators seps = as_separators(sep)
+        cdef SepTable* sep_ptr = sep_table(seps)
+        cdef bool longest_ = longest
+        cdef stringbuf sb
+        cdef int prev = 0
+        cdef int start, end
+        cdef bytes encoded_replaced
+        cdef bool callback_list_or_dict = isinstance(callback, dict) or isinstance(callback, list)
+        if self.trie.ignore_case:
+            align = ignore_case_alignment(xs)
+            xs = align.lowercase
+        if self.dirty:
+            self._link()
+        self._build_depths()
+        with nogil:
+            self._leftmost(xs.bytes_, xs.byte_num, sep_ptr, longest_, vect)
+        for m in vect:
+            start = ignore_case_byte_index_mapping(align, m.start)
+            end = ignore_case_byte_index_mapping(align, m.end)
+            sb.write(<char*>original.bytes_ + prev, start - prev)
+            if callback_list_or_dict:
+                replaced_ = callback[m.val]
+            else:
+                replaced_ = callback(m.val, ignore_case_offset(align, xs, m.start), ignore_case_offset(align, xs, m.end - 1) + 1)
+            if isinstance(replaced_, unicode):
+                encoded_replaced = replaced_.encode("utf8")
+            elif isinstance(replaced_, bytes):
+                encoded_replaced = replaced_
+            else:
+                raise Exception("Replaced result should be bytes or unicode")
+            sb.write(<char*>encoded_replaced, len(encoded_replaced))
+            prev = end
+        sb.write(<char*>original.bytes_ + prev, original.byte_num - prev)
+        return sb.to_string().decode("utf8")
 
     def replace_longest(self, unicode s not None, callback not None, sep = None):
         """
@@ -123,7 +395,7 @@ cdef class AC(object):
         Args:
             s : unicode
             callback : lambda | list | dict
-            sep : set(int) | None
+            sep : Separators | set(int) | None
                 If you specify seperators. e.g. set([ord(' ')]), 
                 it only matches strings tween seperators.
         Returns:
@@ -132,247 +404,894 @@ cdef class AC(object):
             >>> python_id = ac.get("python")
             >>> text = ac.replace_longest("python", {python_id: "hahah"}, set([ord(" ")]))
         """
-        return self.trie.replace_longest(s, callback, sep)
+        return self.replace_leftmost(s, callback, sep, True)
+
+    def replace(self, unicode text not None, replacements not None, mode = "leftmost-longest", sep = None):
+        """
+        replace keys by id, faster than replace_leftmost: the replacements are resolved once,
+        and the result is written into a new str without the gil.
+        Args:
+            text : unicode
+            replacements : Replacements | list | tuple | dict
+                replacement of each id, see Replacements. reuse a Replacements for many texts
+            mode : str
+                "leftmost-longest" or "leftmost-first" replace the results of match_leftmost,
+                "all-nonoverlapping" replaces the results of match in their order, skipping those overlapping a replaced one
+            sep : Separators | set(int) | None
+        Returns:
+            replaced text
+        Examples:
+            >>> reps = Replacements({ac.get(u"python"): u"snake"})
+            >>> ac.replace(u"python and ruby", reps)
+        """
+        cdef Replacements reps = replacements if isinstance(replacements, Replacements) else Replacements(replacements)
+        cdef Separators seps = as_separators(sep)
+        cdef SepTable* sep_ptr = sep_table(seps)
+        cdef ignore_case_alignment align = None
+        cdef xstring xs = None
+        cdef vector[Matched] vect
+        cdef byte_t* bytes_
+        cdef Py_ssize_t byte_num
+        cdef bytes encoded = None
+        cdef bool ascii = PyUnicode_MAX_CHAR_VALUE(text) < 0x80
+        cdef int mode_
+        if mode == "leftmost-longest":
+            mode_ = 0
+        elif mode == "leftmost-first":
+            mode_ = 1
+        elif mode == "all-nonoverlapping":
+            mode_ = 2
+        else:
+            raise Exception("unknown mode: %r" % (mode, ))
+        if self.trie.ignore_case:
+            align = ignore_case_alignment(xstring(text))
+            xs = align.lowercase
+            bytes_ = xs.bytes_
+            byte_num = xs.byte_num
+        else:
+            bytes_ = <byte_t*>ascii_utf8(text, &byte_num)
+            if bytes_ == NULL:
+                encoded = text.encode("utf8")
+                bytes_ = <byte_t*><char*>encoded
+                byte_num = len(encoded)
+        if byte_num > INT_MAX:
+            raise OverflowError("text is larger than 2GB")
+        if self.dirty:
+            self._link()
+        if mode_ != 2:
+            self._build_depths()
+        with nogil:
+            if mode_ == 2:
+                self._scan(bytes_, 0, <int>byte_num, <int>byte_num, 0, sep_ptr, True, vect)
+                drop_overlaps(vect)
+            else:
+                self._leftmost(bytes_, <int>byte_num, sep_ptr, mode_ == 0, vect)
+            if xs is not None:
+                to_char_offsets(vect, xs.char_idx_of_byte, align.lowercase_char_index_mapping)
+            elif not ascii:
+                utf8_to_char_offsets(bytes_, vect)
+        return replace_chars(text, vect, reps)
 
     def __cinit__(self):
         self.trie = None
-        # self.output = NULL
         self.fails = NULL
+        self.outputs = NULL
+        self.outputs_owned = False
+        self.depths = NULL
         self.key_lens = NULL
         self.buff = NULL
+        self.dirty = False
+        self.generation = 0
 
     def __dealloc__(self):
+        if self.depths:
+            free(self.depths)
         if self.buff == NULL:
-            # if self.output:
-            #     free(self.output)
             if self.fails:
                 free(self.fails)
+            if self.outputs:
+                free(self.outputs)
             if self.key_lens:
                 free(self.key_lens)
         else:
+            if self.outputs_owned:
+                free(self.outputs)
             PyBuffer_Release(self.buff)
             free(self.buff)
 
-    # cdef inline void __fetch(self, int idx, int nid, vector[Matched]& res):
-    #     cdef OutNode *e = &self.output[nid]
-    #     cdef int val, len_, start_offset, end_offset
-    #     while e[0].value >= 0:
-    #         val = e[0].value
-    #         len_ = self.key_lens[val]
-    #         start_offset = idx - len_ + 1
-    #         end_offset = idx + 1
-    #         res.push_back(Matched(val, start_offset, end_offset))
-    #         if e[0].next_ < 0:
-    #             break
-    #         e = &self.output[e[0].next_]
-
     @classmethod
-    def build(cls, pats, ignore_case=False, ordered=False):
+    def build(cls, pats, ignore_case=False, ordered=False, sorted=False, payload_type=None):
         """
         Build AC automata
         Args:
-            pats : list(unicode)
+            pats : iterable(unicode)
             ignore_case : bool
                 Defaults False
                 see Trie's constructor for details.
             ordered : bool
                 Defaults False
                 see Trie's constructor for details.
+            sorted : bool
+                Defaults False
+                pats are already sorted, see Trie.build for details.
+            payload_type : None | "int" | "float" | "bytes"
+                Defaults None
+                if it's set, pats are tuples of (pattern, payload), see Trie.build for details.
         Returns:
             ac : AC
                 ac automata
         Examples:
             >>> AC.build(["python"])
+            >>> AC.build({"python": 1.0, "ruby": 0.5}.items(), payload_type="float")
         """
-        cdef int idx, id_, l, vk, fid, nid, fs
-        cdef byte_t label
-        cdef Trie trie = Trie(ignore_case, ordered)
-        for s in pats:
-            trie.insert(s)
-        cdef QueueNode queue_node, queue_node2
-        cdef int nlen = trie.array_size
-        cdef int* fails = <int*> malloc(sizeof(int)*nlen)
-        memset(fails, -1, sizeof(int)*nlen)
-        # cdef OutNode* output = <OutNode*> malloc(sizeof(OutNode)*nlen)
-        # memset(output, -1, sizeof(OutNode)*nlen)
-        cdef deque[QueueNode] q = deque[QueueNode]()
-        key_lens = <unsigned int*> malloc(sizeof(unsigned int) * trie.leaf_size)
-        memset(key_lens, 0, sizeof(unsigned int) * trie.leaf_size)
-        cdef int ro = 0
-        fails[ro] = ro
-        cdef byte_t children[256]
-        cdef int children_nodes[256]
-        child_num = trie.children(ro, children, children_nodes, 256)
-        for idx in range(child_num):
-            label = children[idx]
-            id_ = children_nodes[idx]
-            # print("child[%s][%s] = %s" % (ro, label, id_))
-            queue_node.node_id = id_
-            queue_node.node_label = label
-            queue_node.len = 1
-            q.push_back(queue_node)
-            fails[id_] = ro
-        while q.size() > 0:
-            queue_node2 = q.front()
-            q.pop_front()
-            # print("queue_node2", queue_node2)
-            nid = queue_node2.node_id
-            l = queue_node2.len
-            vk = trie.value(nid)
-            if vk >= 0:
-                key_lens[vk] = l
-                # print("output[%s].value = %s, label: %s" % (nid, vk, queue_node2.node_label))
-                # output[nid].value = vk
-            child_num = trie.children(nid, children, children_nodes, 256)
-            for idx in range(child_num):
-                # print("child_idx %d of %d" % (idx, nid))
-                label = children[idx]
-                id_ = children_nodes[idx]
-                # print("child[%s][%s] = %s" % (nid, label, id_))
-                queue_node.node_id = id_
-                queue_node.node_label = label
-                queue_node.len = l + 1
-                q.push_back(queue_node)
-                fid = nid
-                while fid != ro:
-                    fs = fails[fid]
-                    if trie.has_label(fs, label):
-                        fid = trie.child(fs, label)
-                        break
-                    fid = fails[fid]
-                fails[id_] = fid
-                # if trie.has_value(fid):
-                #     output[id_].next_ = fid
-                #     # print("output[%s].next_ = %s" % (id_, fid))
-        ac = AC()
-        ac.trie = trie
-        # ac.output = output
-        ac.fails = fails
-        ac.key_lens = key_lens
+        cdef AC ac = AC()
+        ac.trie = Trie.build(pats, ignore_case, ordered, sorted, payload_type)
+        ac._link()
         return ac
 
-    cdef inline void __fetch(self, int idx, int nid, vector[Matched]& res, bool return_all):
+    def add(self, unicode key not None, payload = None):
+        """
+        add a key to the automaton. links are rebuilt by commit, which runs
+        before the next match if it wasn't called.
+        Args:
+            key : unicode
+            payload : int | float | bytes | None
+                see Trie.insert
+        Returns:
+            id : int
+                id of the key, the existing id if it's in the automaton already. -1 if key is empty.
+        Examples:
+            >>> for word in new_words:
+            >>>     ac.add(word)
+            >>> ac.commit()
+        """
+        cdef int id_ = self.trie.get(key)
+        if (id_ >= 0 and payload is None) or len(key) == 0:
+            return id_
+        if self.trie.frozen:
+            raise Exception("automaton is frozen, it can't be changed")
+        self._own()
+        if id_ >= 0:
+            return self.trie.insert(key, payload)
+        id_ = self.trie.insert(key, payload)
+        self.dirty = True
+        return id_
+
+    def set_payload(self, int id_, value):
+        """
+        replace the payload of a key by id, see Trie.set_payload
+        """
+        if self.trie.frozen:
+            raise Exception("automaton is frozen, it can't be changed")
+        self._own()
+        self.trie.set_payload(id_, value)
+
+    def remove(self, unicode key not None):
+        """
+        remove a key from the automaton, see add.
+        Args:
+            key : unicode
+        Returns:
+            id : int
+                id of the removed key, -1 if it's not in the automaton.
+        """
+        if self.trie.get(key) < 0:
+            return -1
+        if self.trie.frozen:
+            raise Exception("automaton is frozen, it can't be changed")
+        self._own()
+        self.dirty = True
+        return self.trie.remove(key)
+
+    def commit(self):
+        """
+        rebuild the links after add/remove, in place and without rebuilding the trie.
+        matching commits pending changes by itself, call it after a batch of changes
+        to keep that cost out of the next match.
+        """
+        if self.dirty:
+            self._link()
+
+    def freeze(self):
+        """
+        make the automaton read only and drop what is only needed for changing it,
+        see Trie.freeze. save and to_buff write the smallest image after it,
+        which is worth it when the file is mapped by many processes.
+        Examples:
+            >>> ac.freeze()
+            >>> ac.save("ac.bin")
+        """
+        self.commit()
+        self.trie.freeze()
+
+    def stats(self):
+        """
+        counters of the trie, see Trie.stats, and of the links, which are built first if keys were changed.
+        Returns:
+            stats : dict
+                fail_depths : fail_depths[n] is the number of states n fail transitions away from the root,
+                    a long tail means a text can take many fail transitions for one byte
+                memory : also has bytes of the links
+        Examples:
+            >>> ac.stats()["fail_depths"]
+        """
+        self.commit()
+        ret = self.trie.stats()
+        cdef int n = self.trie.array_size
+        cdef vector[int] depths
+        cdef vector[long long] hist
+        cdef vector[int] path
+        cdef int i, nid, d
+        depths.resize(n, -1)
+        depths[0] = 0
+        for i in range(n):
+            if depths[i] >= 0 or self.fails[i] < 0:
+                continue
+            # walk up to a state of known depth, then set the states on the way
+            nid = i
+            while depths[nid] < 0:
+                path.push_back(nid)
+                nid = self.fails[nid]
+            d = depths[nid]
+            while path.size() > 0:
+                d += 1
+                depths[path.back()] = d
+                path.pop_back()
+        for i in range(n):
+            d = depths[i]
+            if d < 0:
+                continue
+            if <int>hist.size() <= d:
+                hist.resize(d + 1)
+            hist[d] += 1
+        ret["fail_depths"] = [x for x in hist]
+        ret["memory"]["links"] = (sizeof(int) * 2 * n + sizeof(unsigned int) * self.trie.leaf_size) if self.fails != NULL else 0
+        ret["memory"]["depths"] = sizeof(int) * n if self.depths != NULL else 0
+        ret["memory"]["image"] = self.buff_size()
+        return ret
+
+    cdef void _own(self) except *:
+        # data in an external buffer is read only, copy it before changing the trie.
+        # the links are rebuilt on commit, so only the trie is copied
+        if self.buff == NULL:
+            return
+        cdef bytearray data = bytearray(self.trie.buff_size())
+        self.trie.to_buff(data)
+        self.trie = Trie.from_buff(data, True)
+        if self.outputs_owned:
+            free(self.outputs)
+        self.fails = NULL
+        self.outputs = NULL
+        self.outputs_owned = False
+        self.key_lens = NULL
+        self.dirty = True
+        PyBuffer_Release(self.buff)
+        free(self.buff)
+        self.buff = NULL
+
+    cdef void _link(self) except *:
+        # build fail links, output links and key lengths of the current trie.
+        # the arrays are reused, so there is never a second copy of them
+        cdef int nlen = self.trie.array_size
+        self.fails = <int*> realloc(self.fails, sizeof(int) * nlen)
+        self.outputs = <int*> realloc(self.outputs, sizeof(int) * nlen)
+        self.key_lens = <unsigned int*> realloc(self.key_lens, sizeof(unsigned int) * self.trie.leaf_size)
+        free(self.depths)
+        self.depths = NULL
+        with nogil:
+            build_links(self.trie, self.fails, self.outputs, self.key_lens)
+        self.dirty = False
+        self.generation += 1
+
+    cdef inline void __fetch(self, int idx, int nid, vector[Matched]& res, bool return_all) noexcept nogil:
         cdef int val, len_, start_offset, end_offset
+        if nid <= 0:
+            return
+        val = self.trie.value(nid)
+        if val < 0:
+            if not return_all:
+                return
+            nid = self.outputs[nid]
         while nid > 0:
             val = self.trie.value(nid)
-            if val >= 0:
-                len_ = self.key_lens[val]
-                start_offset = idx - len_ + 1
-                end_offset = idx + 1
-                res.push_back(Matched(val, start_offset, end_offset))
+            len_ = self.key_lens[val]
+            start_offset = idx - len_ + 1
+            end_offset = idx + 1
+            res.push_back(Matched(val, start_offset, end_offset))
             if not return_all:
                 break
-            nid = self.fails[nid]
+            nid = self.outputs[nid]
+
+    cdef int _scan(self, byte_t *bytes_, int begin, int end, int byte_num, int nid, SepTable* sep, bool return_all, vector[Matched]& res, long long* fails_taken = NULL) noexcept nogil:
+        # collect matches which end in bytes_[begin:end] into res, offsets are byte offsets.
+        # byte_num is the size of the text, separators after end are looked up in it.
+        # nid is the state after bytes_[:begin], returns the state after bytes_[:end].
+        # fail transitions are added to fails_taken unless it's NULL
+        cdef int nid_, i, chr_
+        cdef size_t k, first, kept
+        cdef byte_t b
+        for i in range(begin, end):
+            b = bytes_[i]
+            while True:
+                nid_ = self.trie.child(nid, b)
+                if nid_ >= 0:
+                    nid = nid_
+                    if sep == NULL:
+                        self.__fetch(i, nid, res, return_all)
+                        break
+                    if i + 1 < byte_num:
+                        chr_ = char_at_byte(bytes_, i + 1, byte_num)
+                        if not in_sep(sep, chr_):
+                            break
+                    first = res.size()
+                    kept = first
+                    self.__fetch(i, nid, res, return_all)
+                    for k in range(first, res.size()):
+                        if res[k].start > 0:
+                            chr_ = char_before_byte(bytes_, res[k].start, byte_num)
+                            if not in_sep(sep, chr_):
+                                continue
+                        res[kept] = res[k]
+                        kept += 1
+                    res.resize(kept)
+                    break
+                if nid == 0:
+                    break
+                nid = self.fails[nid]
+                if fails_taken != NULL:
+                    fails_taken[0] += 1
+        return nid
+
+    cdef long long _count_hits(self, byte_t *bytes_, int byte_num, SepTable* sep, bool stop, int* counts, Matched* hit) noexcept nogil:
+        # the hits of _scan with return_all, without collecting them. counts[id] is increased for each
+        # hit unless counts is NULL. if stop, the scan ends at the first hit, which is written to hit.
+        # returns the number of hits
+        cdef int nid = 0
+        cdef int nid_, i, out, val, start
+        cdef long long num = 0
+        cdef byte_t b
+        for i in range(byte_num):
+            b = bytes_[i]
+            while True:
+                nid_ = self.trie.child(nid, b)
+                if nid_ >= 0:
+                    nid = nid_
+                    break
+                if nid == 0:
+                    break
+                nid = self.fails[nid]
+            if nid <= 0:
+                continue
+            if sep != NULL and i + 1 < byte_num and not in_sep(sep, char_at_byte(bytes_, i + 1, byte_num)):
+                continue
+            out = nid if self.trie.value(nid) >= 0 else self.outputs[nid]
+            while out > 0:
+                val = self.trie.value(out)
+                start = i + 1 - self.key_lens[val]
+                if sep == NULL or start == 0 or in_sep(sep, char_before_byte(bytes_, start, byte_num)):
+                    num += 1
+                    if counts != NULL:
+                        counts[val] += 1
+                    if stop:
+                        hit[0] = Matched(val, start, i + 1)
+                        return num
+                out = self.outputs[out]
+        return num
+
+    cdef long long _count(self, text, sep, bool stop, int* counts, Matched* hit) except -1:
+        # _count_hits of unicode or utf8 text, the offsets of hit are the same as of match or match_bytes
+        cdef Separators seps = as_separators(sep)
+        cdef SepTable* sep_ptr = sep_table(seps)
+        cdef xstring xstr = None
+        cdef ignore_case_alignment align = None
+        cdef xbytes xb = None
+        cdef bytes encoded = None
+        cdef byte_t* bytes_
+        cdef Py_ssize_t byte_num
+        cdef long long num
+        cdef vector[Matched] vect
+        if isinstance(text, unicode):
+            if self.trie.ignore_case:
+                align = ignore_case_alignment(xstring(text))
+                xstr = align.lowercase
+                bytes_ = xstr.bytes_
+                byte_num = xstr.byte_num
+            else:
+                # char offsets are only needed for the first hit, an ascii str is its own utf8
+                bytes_ = <byte_t*>ascii_utf8(text, &byte_num)
+                if bytes_ == NULL:
+                    encoded = text.encode("utf8")
+                    bytes_ = <byte_t*><char*>encoded
+                    byte_num = len(encoded)
+        else:
+            xb = xbytes(text, self.trie.ignore_case)
+            bytes_ = xb.bytes_
+            byte_num = xb.byte_num
+        if byte_num > INT_MAX:
+            raise OverflowError("text is larger than 2GB")
+        if self.dirty:
+            self._link()
+        with nogil:
+            num = self._count_hits(bytes_, <int>byte_num, sep_ptr, stop, counts, hit)
+        if num == 0 or not stop:
+            return num
+        vect.push_back(hit[0])
+        if xb is not None:
+            to_byte_offsets(vect, xb)
+        elif xstr is not None:
+            to_char_offsets(vect, xstr.char_idx_of_byte, align.lowercase_char_index_mapping)
+        else:
+            vect[0].start = utf8_chars(bytes_, 0, hit.start)
+            vect[0].end = vect[0].start + utf8_chars(bytes_, hit.start, hit.end)
+        hit[0] = vect[0]
+        return num
+
+    cdef void _build_depths(self) except *:
+        cdef int* depths
+        if self.depths == NULL:
+            depths = <int*> malloc(sizeof(int) * self.trie.array_size)
+            build_depths(self.trie, depths)
+            self.depths = depths
+
+    cdef inline int _next_hit(self, byte_t *bytes_, int byte_num, SepTable* sep, int idx, int out, int floor) noexcept nogil:
+        # first node from out in the output chain, whose key ending at idx starts at a valid place after floor
+        cdef int start
+        while out > 0:
+            start = idx + 1 - self.key_lens[self.trie.value(out)]
+            if start >= floor and valid_start(bytes_, byte_num, sep, start):
+                return out
+            out = self.outputs[out]
+        return 0
+
+    cdef void _leftmost(self, byte_t *bytes_, int byte_num, SepTable* sep, bool longest, vector[Matched]& res) noexcept nogil:
+        # non-overlapping leftmost-longest (or leftmost-first) matches, offsets are byte offsets.
+        # walking the trie from each start is faster while the walks are short, since the top
+        # of the trie stays in cache. if they get long, continue with fail links in linear time.
+        cdef int offset = self.trie._match_leftmost(bytes_, byte_num, sep, longest, 8, res)
+        if offset < byte_num:
+            self._leftmost_from(bytes_, offset, byte_num, sep, longest, res)
+
+    cdef void _leftmost_from(self, byte_t *bytes_, int begin, int byte_num, SepTable* sep, bool longest, vector[Matched]& res) noexcept nogil:
+        # matches of _leftmost starting from begin, with fail links.
+        # for each end, only the hit starting leftmost is queued, shorter ones are queued when it
+        # falls behind an emitted match. the best hit is emitted once the current state can't
+        # extend to its start, and the state after it is rebuilt from fail links.
+        cdef priority_queue[RankedHit] cands # the best on top
+        cdef Matched best
+        cdef int nid = 0
+        cdef int floor = begin # end of the last emitted match
+        cdef int nid_, i, out
+        cdef byte_t b
+        for i in range(begin, byte_num + 1):
+            if i < byte_num:
+                b = bytes_[i]
+                while True:
+                    nid_ = self.trie.child(nid, b)
+                    if nid_ >= 0:
+                        nid = nid_
+                        break
+                    if nid == 0:
+                        break
+                    nid = self.fails[nid]
+            while not cands.empty():
+                best = unrank_hit(cands.top())
+                if best.start >= floor and i < byte_num and i + 1 - self.depths[nid] <= best.start:
+                    break
+                cands.pop()
+                if best.start < floor:
+                    out = self._next_hit(bytes_, byte_num, sep, best.end - 1, self.outputs[best.val], floor)
+                    if out > 0:
+                        cands.push(rank_hit(self, out, best.end - 1, longest))
+                    continue
+                best.val = self.trie.value(best.val)
+                res.push_back(best)
+                floor = best.end
+                if i < byte_num:
+                    while self.depths[nid] > i + 1 - floor:
+                        nid = self.fails[nid]
+            if i == byte_num:
+                break
+            if sep != NULL and i + 1 < byte_num and not in_sep(sep, char_at_byte(bytes_, i + 1, byte_num)):
+                continue
+            out = nid if self.trie.value(nid) >= 0 else self.outputs[nid]
+            out = self._next_hit(bytes_, byte_num, sep, i, out, floor)
+            if out > 0:
+                cands.push(rank_hit(self, out, i, longest))
 
-    def match(self, unicode text not None, sep = None, return_all = True):
+    def match(self, unicode text not None, sep = None, return_all = True, as_arrays = False, with_payload = False, counters = None):
         """
         extract trie's keys from given string. 
+        the iterator scans the text without GIL in chunks of 16KB as the matches are consumed,
+        so breaking out of the loop stops the scan. with as_arrays, the whole text is scanned at once.
         Args:
             text : unicode
-            sep : set(int) | None
+            sep : Separators | set(int) | None
                 If you specify seperators. e.g. set([ord(' ')]), 
                 it only matches strings between seperators.
             return_all: if it's false, only return the longest substring in substrings with same suffix. it's useful only when sep is None
+            as_arrays : bool
+                return three array.array('i') (ids, start_offsets, end_offsets) instead of an iterator
+            with_payload : bool
+                append the payload of each key to the results, it's one more array if as_arrays
+            counters : dict | None
+                if it's given, "bytes" scanned, "fails" transitions taken and "hits" emitted
+                by this call are added to it, as the iterator advances
         Iterates:
             matched: tuple(id, start_offset, end_offset)
         Examples:
             >>> for id_, start_offset, end_offset in ac.match_longest("python", set([ord(" ")])):
             >>>     print(id_, start_offset, end_offset)
+            >>> counters = {}
+            >>> list(ac.match("python", counters=counters))
         """
         cdef xstring xstr = xstring(text)
-        cdef xstring prev_xstr = xstr
         cdef ignore_case_alignment align = None
         cdef vector[Matched] vect
-        cdef Matched m
+        cdef Separators seps = as_separators(sep)
+        cdef SepTable* sep_ptr = sep_table(seps)
+        cdef int* mapping = NULL
+        cdef bool return_all_ = return_all
         if self.trie.ignore_case:
             align = ignore_case_alignment(xstr)
             xstr = align.lowercase
-        cdef byte_t *bytes_ = xstr.bytes_
-        cdef int byte_num = xstr.byte_num
-        cdef int nid_, i, chr_
-        cdef int nid = 0
-        cdef byte_t b
+            mapping = align.lowercase_char_index_mapping
+        if self.dirty:
+            self._link()
+        if not as_arrays:
+            return MatchScanner(self, xstr, align, None, seps, return_all_, payload_source(self.trie, with_payload), counters)
+        cdef long long fails_taken = 0
+        with nogil:
+            self._scan(xstr.bytes_, 0, xstr.byte_num, xstr.byte_num, 0, sep_ptr, return_all_, vect, &fails_taken if counters is not None else NULL)
+            to_char_offsets(vect, xstr.char_idx_of_byte, mapping)
+        if counters is not None:
+            add_counters(counters, xstr.byte_num, fails_taken, vect.size())
+        return matched_to_arrays(vect, True, payload_source(self.trie, with_payload))
+
+    def match_bytes(self, data, sep = None, return_all = True, as_arrays = False, with_payload = False, counters = None):
+        """
+        same as match, but data is utf8 text in bytes, bytearray, mmap or memoryview.
+        It is scanned in place, offsets are byte offsets. the iterator keeps the buffer of data until it's released.
+        Args:
+            data : bytes-like object
+            sep : Separators | set(int) | None
+            return_all: same as match
+            as_arrays : bool
+                return three array.array('i') (ids, start_offsets, end_offsets) instead of an iterator
+            with_payload : bool
+                append the payload of each key to the results, it's one more array if as_arrays
+            counters : dict | None
+                same as match
+        Iterates:
+            matched: tuple(id, start_offset, end_offset)
+        Examples:
+            >>> for id_, start_offset, end_offset in ac.match_bytes(b"python"):
+            >>>     print(id_, start_offset, end_offset)
+        """
+        cdef xbytes xb = xbytes(data, self.trie.ignore_case)
+        cdef vector[Matched] vect
+        cdef Separators seps = as_separators(sep)
+        cdef SepTable* sep_ptr = sep_table(seps)
         cdef bool return_all_ = return_all
+        if self.dirty:
+            self._link()
+        if not as_arrays:
+            return MatchScanner(self, None, None, xb, seps, return_all_, payload_source(self.trie, with_payload), counters)
+        cdef long long fails_taken = 0
+        with nogil:
+            self._scan(xb.bytes_, 0, xb.byte_num, xb.byte_num, 0, sep_ptr, return_all_, vect, &fails_taken if counters is not None else NULL)
+            to_byte_offsets(vect, xb)
+        if counters is not None:
+            add_counters(counters, xb.byte_num, fails_taken, vect.size())
+        return matched_to_arrays(vect, True, payload_source(self.trie, with_payload))
 
-        if sep is None:
-            for i in range(byte_num):
-                b = bytes_[i]
-                while True:
-                    nid_ = self.trie.child(nid, b)
-                    if nid_ >= 0:
-                        nid = nid_
-                        vect.clear()
-                        self.__fetch(i, nid, vect, return_all_)
-                        for m in vect:
-                            yield m.val, ignore_case_offset(align, xstr, m.start), ignore_case_offset(align, xstr, m.end - 1) + 1
-                        break
-                    if nid == 0:
-                        break
-                    nid = self.fails[nid]
+    def match_column(self, data, offsets, sep = None, return_all = True):
+        """
+        match_bytes of each row of a column, in one call.
+        Args:
+            data : bytes-like object
+                utf8 text of all rows
+            offsets : array of int32 or int64, e.g. array.array('i'), array.array('q') or a numpy array
+                row i is data[offsets[i]:offsets[i + 1]], as in arrow string arrays
+            sep : Separators | set(int) | None
+            return_all: same as match
+        Returns:
+            (rows, ids, starts, ends) : tuple(array.array('i'))
+                starts and ends are byte offsets in the row
+        Examples:
+            >>> col = pyarrow.array([u"python", u"ruby"])
+            >>> _, offsets, data = col.buffers()
+            >>> rows, ids, starts, ends = ac.match_column(data, memoryview(offsets).cast("i"))
+        """
+        cdef xcolumn col = xcolumn(data, offsets)
+        cdef vector[Matched] vect
+        cdef vector[Matched] res
+        cdef vector[int] rows
+        cdef Separators seps = as_separators(sep)
+        cdef SepTable* sep_ptr = sep_table(seps)
+        cdef bool return_all_ = return_all
+        cdef xbytes xb
+        cdef int row
+        if self.dirty:
+            self._link()
+        if self.trie.ignore_case:
+            # rows are lowercased one by one
+            for row in range(col.rows):
+                xb = col.row_bytes(row, True)
+                vect.clear()
+                self._scan(xb.bytes_, 0, xb.byte_num, xb.byte_num, 0, sep_ptr, return_all_, vect)
+                to_byte_offsets(vect, xb)
+                add_row_hits(rows, res, vect, row)
         else:
-            for i in range(byte_num):
-                b = bytes_[i]
-                while True:
-                    nid_ = self.trie.child(nid, b)
-                    if nid_ >= 0:
-                        nid = nid_
-                        if i + 1 < byte_num:
-                            chr_ = xstr.chars[xstr.char_idx_of_byte[i + 1]]
-                            if chr_ not in sep:
-                                break
-                        vect.clear()
-                        self.__fetch(i, nid, vect, return_all_)
-                        for m in vect:
-                            if m.start > 0:
-                                chr_ = xstr.chars[xstr.char_idx_of_byte[m.start - 1]]
-                                if chr_ not in sep:
-                                    continue
-                            yield m.val, ignore_case_offset(align, xstr, m.start), ignore_case_offset(align, xstr, m.end - 1) + 1
-                        break
-                    if nid == 0:
-                        break
-                    nid = self.fails[nid]
+            with nogil:
+                for row in range(col.rows):
+                    vect.clear()
+                    self._scan(col.row(row), 0, col.row_len(row), col.row_len(row), 0, sep_ptr, return_all_, vect)
+                    add_row_hits(rows, res, vect, row)
+        return column_arrays(rows, res)
+
+    def match_longest_column(self, data, offsets, sep = None):
+        """
+        match_longest_bytes of each row of a column, see match_column and Trie.match_longest_column
+        """
+        cdef xcolumn col = xcolumn(data, offsets)
+        cdef vector[Matched] vect
+        cdef vector[Matched] res
+        cdef vector[int] rows
+        cdef Separators seps = as_separators(sep)
+        cdef SepTable* sep_ptr = sep_table(seps)
+        cdef xbytes xb
+        cdef int row
+        if self.dirty:
+            self._link()
+        self._build_depths()
+        if self.trie.ignore_case:
+            for row in range(col.rows):
+                xb = col.row_bytes(row, True)
+                vect.clear()
+                self._leftmost(xb.bytes_, xb.byte_num, sep_ptr, True, vect)
+                to_byte_offsets(vect, xb)
+                add_row_hits(rows, res, vect, row)
+        else:
+            with nogil:
+                for row in range(col.rows):
+                    vect.clear()
+                    self._leftmost(col.row(row), col.row_len(row), sep_ptr, True, vect)
+                    add_row_hits(rows, res, vect, row)
+        return column_arrays(rows, res)
+
+    def replace_longest_column(self, data, offsets, callback not None, sep = None):
+        """
+        replace_longest of each row of a column, see Trie.replace_longest_column
+        """
+        return self.trie.replace_longest_column(data, offsets, callback, sep)
+
+    def count(self, text not None, sep = None):
+        """
+        number of results of match(text, sep), without creating them.
+        Args:
+            text : unicode | bytes-like object
+                bytes-like objects are utf8 text, see match_bytes
+            sep : Separators | set(int) | None
+        Returns:
+            count : int
+        Examples:
+            >>> ac.count(u"python ruby python")
+        """
+        return self._count(text, sep, False, NULL, NULL)
+
+    def contains_any(self, text not None, sep = None):
+        """
+        whether text contains any key, the scan stops at the first hit.
+        Args:
+            text : unicode | bytes-like object
+            sep : Separators | set(int) | None
+        Returns:
+            found : bool
+        Examples:
+            >>> if blocked.contains_any(document):
+            >>>     reject(document)
+        """
+        cdef Matched hit
+        return self._count(text, sep, True, NULL, &hit) > 0
+
+    def first(self, text not None, sep = None):
+        """
+        the first result of match(text, sep), the scan stops at it.
+        Args:
+            text : unicode | bytes-like object
+                offsets are byte offsets for bytes-like objects
+            sep : Separators | set(int) | None
+        Returns:
+            matched : tuple(id, start_offset, end_offset) | None
+                None if no key is in text
+        Examples:
+            >>> ac.first(u"ruby python") # (id of ruby, 0, 4)
+        """
+        cdef Matched hit
+        if self._count(text, sep, True, NULL, &hit) == 0:
+            return None
+        return (hit.val, hit.start, hit.end)
+
+    def histogram(self, text not None, sep = None):
+        """
+        number of hits of each key in text, the results of match(text, sep) counted by id.
+        Args:
+            text : unicode | bytes-like object
+            sep : Separators | set(int) | None
+        Returns:
+            counts : array.array('i')
+                counts[id] is the hits of the key, it has one item for each id, removed ids are 0
+        Examples:
+            >>> counts = ac.histogram(document)
+            >>> counts[ac[u"python"]]
+        """
+        cdef array.array counts = array.clone(int_array_template, self.trie.leaf_size, True)
+        self._count(text, sep, False, counts.data.as_ints, NULL)
+        return counts
+
+    def stream(self, sep = None, return_all = True):
+        """
+        create a scanner which keeps the automaton state between chunks,
+        so a large file or a socket can be matched piece by piece.
+        Args:
+            sep : Separators | set(int) | None
+            return_all: same as match
+        Returns:
+            scanner : StreamMatcher
+        Examples:
+            >>> scanner = ac.stream()
+            >>> for chunk in chunks:
+            >>>     for id_, start_offset, end_offset in scanner.feed(chunk):
+            >>>         print(id_, start_offset, end_offset)
+            >>> for id_, start_offset, end_offset in scanner.flush():
+            >>>     print(id_, start_offset, end_offset)
+        """
+        return StreamMatcher(self, sep, return_all)
+
+    cdef list _match_many(self, list texts, SepTable* sep, bool return_all, bool as_arrays):
+        cdef int n = len(texts)
+        cdef list xstrs = []
+        cdef vector[byte_t*] bytes_arr
+        cdef vector[int] byte_nums
+        cdef vector[int*] char_idx_arr
+        cdef vector[int*] mappings
+        cdef vector[vector[Matched]] results
+        cdef xstring xstr
+        cdef ignore_case_alignment align
+        cdef Matched m
+        cdef int i
+        for text in texts:
+            xstr = xstring(text)
+            if self.trie.ignore_case:
+                align = ignore_case_alignment(xstr)
+                xstr = align.lowercase
+                mappings.push_back(align.lowercase_char_index_mapping)
+                xstrs.append(align)
+            else:
+                mappings.push_back(NULL)
+                xstrs.append(xstr)
+            bytes_arr.push_back(xstr.bytes_)
+            byte_nums.push_back(xstr.byte_num)
+            char_idx_arr.push_back(xstr.char_idx_of_byte)
+        results.resize(n)
+        with nogil:
+            for i in range(n):
+                self._scan(bytes_arr[i], 0, byte_nums[i], byte_nums[i], 0, sep, return_all, results[i])
+                to_char_offsets(results[i], char_idx_arr[i], mappings[i])
+        if as_arrays:
+            return [matched_to_arrays(results[i], True) for i in range(n)]
+        return [[(m.val, m.start, m.end) for m in results[i]] for i in range(n)]
+
+    def match_batch(self, texts, n_threads = None, sep = None, return_all = True, as_arrays = False):
+        """
+        extract trie's keys from a list of strings, matching runs without gil in a pool of threads.
+        Args:
+            texts : list(unicode)
+            n_threads : int | None
+                number of worker threads, defaults to the number of cpus.
+            sep : Separators | set(int) | None
+                see match
+            return_all : bool
+                see match
+            as_arrays : bool
+                see match
+        Returns:
+            matched : list(list(tuple(id, start_offset, end_offset))), one list per text.
+                if as_arrays is true, one tuple of arrays per text.
+        Examples:
+            >>> for matched in ac.match_batch(["python", "ruby"], n_threads=4):
+            >>>     print(matched)
+        """
+        if self.dirty:
+            self._link()
+        cdef _BatchJob job = _BatchJob(self, sep, return_all, as_arrays)
+        cdef list texts_ = list(texts)
+        for text in texts_:
+            if not isinstance(text, unicode):
+                raise TypeError("texts should be a list of unicode, got %s" % type(text).__name__)
+        if n_threads is None:
+            n_threads = cpu_count() or 1
+        if n_threads <= 1 or len(texts_) <= 1:
+            return job.run(texts_)
+        cdef int chunk_num = min(len(texts_), n_threads * 4)
+        cdef int chunk_size = (len(texts_) + chunk_num - 1) // chunk_num
+        chunks = [texts_[i:i + chunk_size] for i in range(0, len(texts_), chunk_size)]
+        ret = []
+        for matched in thread_pool(n_threads).map(job.run, chunks):
+            ret.extend(matched)
+        return ret
 
     def __reduce__(self):
         return (new_object, (AC,), self.__getstate__())
 
+    def __reduce_ex__(self, protocol):
+        # with protocol 5, the image is one PickleBuffer, which can be passed out of band.
+        # an automaton loaded by from_buff(copy=False) passes its buffer without copying it
+        if protocol < 5 or PickleBuffer is None:
+            return self.__reduce__()
+        if self.buff != NULL:
+            image = memoryview(<object>self.buff.obj)[:self.buff_size()]
+        else:
+            image = bytearray(self.buff_size())
+            self.to_buff(image)
+        return (from_image, (AC, PickleBuffer(image)))
+
     def __getstate__(self):
+        self.commit()
         return (self.trie,
             int(ac_binary_version),
             array_to_bytes(<char*>self.fails, self.trie.array_size * sizeof(int)),
+            array_to_bytes(<char*>self.outputs, self.trie.array_size * sizeof(int)),
             array_to_bytes(<char*>self.key_lens, self.trie.leaf_size * sizeof(unsigned int)),
         )
 
     def __setstate__(self, data):
-        self.trie, version, fails, key_lens = data
+        if len(data) == 4: # before version 2
+            self.trie, version, fails, key_lens = data
+            outputs = None
+        else:
+            self.trie, version, fails, outputs, key_lens = data
         if isinstance(version, int) and version > ac_binary_version:
             raise Exception("data is generated by new cyac, please update cyac module.")
-        # if self.output != NULL:
-        #     free(self.output)
         if self.fails != NULL:
             free(self.fails)
+        if self.outputs != NULL:
+            free(self.outputs)
         if self.key_lens != NULL:
             free(self.key_lens)
-        # self.output = <OutNode*> bytes_to_array(output, self.trie.array_size * sizeof(OutNode))
         self.fails = <int*> bytes_to_array(fails, self.trie.array_size * sizeof(int))
+        if outputs is None:
+            self.outputs = <int*> malloc(sizeof(int) * self.trie.array_size)
+            build_outputs(self.trie, self.fails, self.outputs)
+        else:
+            self.outputs = <int*> bytes_to_array(outputs, self.trie.array_size * sizeof(int))
         self.key_lens = <unsigned int*> bytes_to_array(key_lens, self.trie.leaf_size * sizeof(unsigned int))
 
 
     cdef write(self, FILE* ptr_fw):
         cdef uint32_t magic = magic_number
-        cdef int version = ac_binary_version
+        self.commit()
+        cdef long long size = self.buff_size()
+        cdef int version = ac_large_binary_version if size > INT_MAX else ac_binary_version
+        cdef int small_size = <int>size
         fwrite(<void*>&magic, sizeof(magic), 1, ptr_fw)
         fwrite(<void*>&version, sizeof(version), 1, ptr_fw)
-        cdef int size = self.buff_size()
-        fwrite(<void*>&size, sizeof(size), 1, ptr_fw)
+        if version == ac_large_binary_version:
+            fwrite(<void*>&size, sizeof(size), 1, ptr_fw)
+        else:
+            fwrite(<void*>&small_size, sizeof(small_size), 1, ptr_fw)
         self.trie.write(ptr_fw)
-        # fwrite(<void*>self.output, sizeof(OutNode), self.trie.array_size, ptr_fw)
         fwrite(<void*>self.fails, sizeof(int), self.trie.array_size, ptr_fw)
+        fwrite(<void*>self.outputs, sizeof(int), self.trie.array_size, ptr_fw)
         fwrite(<void*>self.key_lens, sizeof(unsigned int), self.trie.leaf_size, ptr_fw)
 
-    def save(self, fname):
+    def save(self, fname, checksum = False):
         """
         save data into binary file
+        Args:
+            fname : str
+            checksum : bool
+                append the crc32 of the image, checked by load(fname, checksum=True)
         """
         cdef FILE *ptr_fw
         cdef bytes bfname = fname.encode("utf8")
@@ -382,13 +1301,18 @@ cdef class AC(object):
             raise Exception("Cannot open file: %s" % fname)
         self.write(ptr_fw)
         fclose(ptr_fw)
+        if checksum:
+            append_checksum(fname)
 
 
     def buff_size(self):
         """
         return the memory size of buffer needed for exporting to external buffer.
         """
-        return self.trie.buff_size() + sizeof(uint32_t) + sizeof(int) + sizeof(int) + (sizeof(int)) * self.trie.array_size + sizeof(unsigned int) * self.trie.leaf_size
+        cdef long long size = self.trie.buff_size() + sizeof(uint32_t) + sizeof(int) + sizeof(int) + (sizeof(int)) * self.trie.array_size * 2 + sizeof(unsigned int) * self.trie.leaf_size
+        if size > INT_MAX: # the size is a long long
+            size += sizeof(int)
+        return size
 
 
     def to_buff(self, buff):
@@ -401,20 +1325,23 @@ cdef class AC(object):
         cdef Py_buffer view
         if PyObject_GetBuffer(buff, &view, PyBUF_WRITABLE) != 0:
             raise Exception("cannot get writable buffer: https://docs.python.org/zh-cn/3/c-api/buffer.html")
-        if self.buff_size() < view.len:
+        if view.len < self.buff_size():
+            PyBuffer_Release(&view)
             raise Exception("buff size is smaller than needed.")
         cdef void* buf = view.buf
+        self.commit()
         self._to_buff(buf)
         PyBuffer_Release(&view)
 
 
     @classmethod
-    def from_buff(cls, buff, copy = True):
+    def from_buff(cls, buff, copy = True, verify = False):
         """
         init ac from buff
         Args:
             buff: object satisfy Python buff protocol https://docs.python.org/zh-cn/3/c-api/buffer.html
             copy: whether copy data, by default, it copies data from buff
+            verify: check every link of the image, see load
         """
         check_buffer(buff)
         cdef Py_buffer* view = <Py_buffer*>malloc(sizeof(Py_buffer))
@@ -423,7 +1350,15 @@ cdef class AC(object):
             free(view)
             free(view2)
             raise Exception("cannot get readable buffer: https://docs.python.org/zh-cn/3/c-api/buffer.html")
-        ac = ac_from_buff(view.buf, view.len, copy)
+        cdef AC ac
+        try:
+            ac = ac_from_buff(view.buf, view.len, copy)
+        except:
+            PyBuffer_Release(view)
+            PyBuffer_Release(view2)
+            free(view)
+            free(view2)
+            raise
         if copy:
             ac.buff = NULL
             ac.trie.buff = NULL
@@ -435,84 +1370,713 @@ cdef class AC(object):
 
             ac.buff = view
             ac.trie.buff = view2
+        if verify:
+            ac._verify()
         return ac
 
+    @classmethod
+    def load(cls, path, mmap = True, verify = True, populate = False, checksum = False):
+        """
+        load a file written by save
+        Args:
+            path : str
+            mmap : bool
+                share the pages of the file, see from_buff(copy=False), else the file is read into memory
+            verify : bool
+                check every link of the image, a corrupted file raises Exception instead of crashing a later match.
+                the sizes of the sections are always checked
+            populate : bool
+                read the file when it's mapped, so the first matches don't wait for page faults
+            checksum : bool
+                check the crc32 appended by save(path, checksum=True), raise Exception if it's missing
+        Returns:
+            ac : AC
+        Examples:
+            >>> ac.save("entities.bin", checksum=True)
+            >>> ac = AC.load("entities.bin", populate=True, checksum=True)
+        """
+        return cls.from_buff(open_image(path, mmap, populate, checksum), copy = not mmap, verify = verify)
+
+    cdef int _verify(self) except -1:
+        # links of the trie, then fail and output links, which lead to shallower nodes, and key lengths
+        cdef vector[int] depths
+        cdef int size = self.trie.array_size
+        cdef int i, f, o, p, v
+        self.trie._verify(depths)
+        for i in range(size):
+            if depths[i] < 0:
+                continue
+            p = self.trie.array[i].check
+            if i > 0 and self.trie._node_base(&self.trie.array[p]) == i:
+                continue # the value of a key with longer keys, it's not a state
+            f = self.fails[i]
+            o = self.outputs[i]
+            if f < 0 or f >= size or depths[f] < 0 or (i > 0 and depths[f] >= depths[i]) \
+                    or o < 0 or o >= size or depths[o] < 0 or (o > 0 and depths[o] >= depths[i]):
+                raise Exception("invalid data, links of node %d are not correct" % i)
+            v = self.trie.value(i)
+            if v >= 0 and self.key_lens[v] != <unsigned int>depths[i]:
+                raise Exception("invalid data, length of key %d is not correct" % v)
+        return 0
+
     cdef void _to_buff(self, void* buf):
-        cdef int offset = 0
+        cdef long long offset = 0
 
         cdef char* buff = <char*>buf
         cdef uint32_t magic = magic_number
         memcpy(buff, <void*>&magic, sizeof(magic))
         offset += sizeof(magic)
 
-        cdef int version = ac_binary_version
+        cdef long long size = self.buff_size()
+        cdef int version = ac_large_binary_version if size > INT_MAX else ac_binary_version
         memcpy(buff + offset, <void*>&version, sizeof(version))
         offset += sizeof(version)
 
-        cdef int size = self.buff_size()
-        memcpy(buff + offset, <void*>&size, sizeof(size))
-        offset += sizeof(size)
+        cdef int small_size = <int>size
+        if version == ac_large_binary_version:
+            memcpy(buff + offset, <void*>&size, sizeof(size))
+            offset += sizeof(size)
+        else:
+            memcpy(buff + offset, <void*>&small_size, sizeof(small_size))
+            offset += sizeof(small_size)
 
         self.trie._to_buff(buff + offset)
         offset += self.trie.buff_size()
 
-        # memcpy(buff + offset, <void*>self.output, sizeof(OutNode) * self.trie.array_size)
-        # offset += sizeof(OutNode) * self.trie.array_size
-
         memcpy(buff + offset, <void*>self.fails, sizeof(int) * self.trie.array_size)
         offset += sizeof(int) * self.trie.array_size
 
+        memcpy(buff + offset, <void*>self.outputs, sizeof(int) * self.trie.array_size)
+        offset += sizeof(int) * self.trie.array_size
+
         memcpy(buff + offset, <void*>self.key_lens, sizeof(unsigned int) * self.trie.leaf_size)
         offset += sizeof(unsigned int) * self.trie.leaf_size
 
 
-cdef AC ac_from_buff(void* buf, int buf_size, bool copy):
+cdef array.array int_array_template = array.array('i')
+
+
+cdef inline int utf8_chars(byte_t* bytes_, int begin, int end) noexcept nogil:
+    # chars in bytes_[begin:end]
+    cdef int i
+    cdef int num = 0
+    for i in range(begin, end):
+        if bytes_[i] & 0xc0 != 0x80:
+            num += 1
+    return num
+
+
+cdef void utf8_to_char_offsets(byte_t* bytes_, vector[Matched]& res) noexcept nogil:
+    # byte offsets of non-overlapping hits ordered by start to char offsets
+    cdef size_t i
+    cdef int byte_pos = 0
+    cdef int char_pos = 0
+    for i in range(res.size()):
+        char_pos += utf8_chars(bytes_, byte_pos, res[i].start)
+        byte_pos = res[i].start
+        res[i].start = char_pos
+        char_pos += utf8_chars(bytes_, byte_pos, res[i].end)
+        byte_pos = res[i].end
+        res[i].end = char_pos
+
+
+cdef void drop_overlaps(vector[Matched]& res) noexcept nogil:
+    # keeps the hits which start after the end of the last kept one
+    cdef size_t i
+    cdef size_t kept = 0
+    cdef int last = 0
+    for i in range(res.size()):
+        if res[i].start >= last:
+            res[kept] = res[i]
+            last = res[i].end
+            kept += 1
+    res.resize(kept)
+
+
+cdef inline Py_UCS4 read_char(void* data, int kind, Py_ssize_t i) noexcept nogil:
+    if kind == 1:
+        return (<Py_UCS1*>data)[i]
+    if kind == 2:
+        return (<Py_UCS2*>data)[i]
+    return (<Py_UCS4*>data)[i]
+
+
+cdef Py_UCS4 max_char(void* data, int kind, Py_ssize_t begin, Py_ssize_t end, Py_UCS4 found) noexcept nogil:
+    # max of found and the chars in data[begin:end], it stops in the highest bucket of kind
+    cdef Py_UCS4 top = 0x80 if kind == 1 else (0x100 if kind == 2 else 0x10000)
+    cdef Py_ssize_t i
+    cdef Py_UCS4 c
+    for i in range(begin, end):
+        if found >= top:
+            break
+        c = read_char(data, kind, i)
+        if c > found:
+            found = c
+    return found
+
+
+cdef void copy_chars(void* dst, int dst_kind, Py_ssize_t at, void* src, int src_kind, Py_ssize_t begin, Py_ssize_t end) noexcept nogil:
+    cdef Py_ssize_t i
+    if dst_kind == src_kind:
+        memcpy(<char*>dst + at * dst_kind, <char*>src + begin * src_kind, (end - begin) * src_kind)
+        return
+    for i in range(begin, end):
+        if dst_kind == 1:
+            (<Py_UCS1*>dst)[at] = <Py_UCS1>read_char(src, src_kind, i)
+        elif dst_kind == 2:
+            (<Py_UCS2*>dst)[at] = <Py_UCS2>read_char(src, src_kind, i)
+        else:
+            (<Py_UCS4*>dst)[at] = read_char(src, src_kind, i)
+        at += 1
+
+
+cdef unicode replace_chars(unicode text, vector[Matched]& vect, Replacements reps):
+    # text with the hits in char offsets replaced, the kept chars decide the kind of the result with the replacements
+    cdef Py_ssize_t text_len = PyUnicode_GET_LENGTH(text)
+    cdef void* src = PyUnicode_DATA(text)
+    cdef int src_kind = PyUnicode_KIND(text)
+    cdef Py_ssize_t out_len = text_len
+    cdef Py_ssize_t prev = 0
+    cdef Py_ssize_t at = 0
+    cdef Py_ssize_t start
+    cdef Py_UCS4 maxchar = 0
+    cdef size_t i, replaced = 0
+    cdef unicode ret
+    cdef void* dst
+    cdef int dst_kind
+    with nogil:
+        for i in range(vect.size()):
+            # hits of an ignore_case automaton may overlap when a char is lowercased into several
+            start = max(vect[i].start, prev)
+            if not reps.has(vect[i].val) or vect[i].end <= start:
+                continue
+            maxchar = max_char(src, src_kind, prev, start, maxchar)
+            maxchar = max(maxchar, reps.maxchars[vect[i].val])
+            out_len += reps.lens[vect[i].val] - (vect[i].end - start)
+            prev = vect[i].end
+            replaced += 1
+        maxchar = max_char(src, src_kind, prev, text_len, maxchar)
+    if replaced == 0:
+        return text
+    ret = PyUnicode_New(out_len, maxchar)
+    dst = PyUnicode_DATA(ret)
+    dst_kind = PyUnicode_KIND(ret)
+    prev = 0
+    with nogil:
+        for i in range(vect.size()):
+            start = max(vect[i].start, prev)
+            if not reps.has(vect[i].val) or vect[i].end <= start:
+                continue
+            copy_chars(dst, dst_kind, at, src, src_kind, prev, start)
+            at += start - prev
+            copy_chars(dst, dst_kind, at, reps.data[vect[i].val], reps.kinds[vect[i].val], 0, reps.lens[vect[i].val])
+            at += reps.lens[vect[i].val]
+            prev = vect[i].end
+        copy_chars(dst, dst_kind, at, src, src_kind, prev, text_len)
+    return ret
+
+
+cdef inline bool valid_start(byte_t* bytes_, int byte_num, SepTable* sep, int start) noexcept nogil:
+    # same as Trie.match_longest: a key starts after a seperator, but not with one
+    if sep == NULL:
+        return True
+    if start > 0 and not in_sep(sep, char_before_byte(bytes_, start, byte_num)):
+        return False
+    return not in_sep(sep, char_at_byte(bytes_, start, byte_num))
+
+
+cdef inline RankedHit rank_hit(AC ac, int node, int idx, bool longest) noexcept nogil:
+    # the key of node ends at idx. the queue pops the largest, so the leftmost,
+    # then the longest or the smallest id ranks highest
+    cdef int val = ac.trie.value(node)
+    cdef long long start = idx + 1 - ac.key_lens[val]
+    cdef long long rank = (start << 32) | (0x7fffffff - idx - 1 if longest else val)
+    return RankedHit(-rank, (<long long>node << 32) | (idx + 1))
+
+
+cdef inline Matched unrank_hit(RankedHit hit) noexcept nogil:
+    # val is the node of the key
+    cdef Matched m
+    m.val = <int>(hit.second >> 32)
+    m.start = <int>((-hit.first) >> 32)
+    m.end = <int><unsigned int>hit.second
+    return m
+
+
+cdef void add_counters(dict counters, long long byte_num, long long fails_taken, long long hits):
+    counters["bytes"] = counters.get("bytes", 0) + byte_num
+    counters["fails"] = counters.get("fails", 0) + fails_taken
+    counters["hits"] = counters.get("hits", 0) + hits
+
+
+cdef void build_links(Trie trie, int* fails, int* outputs, unsigned int* key_lens) noexcept nogil:
+    cdef int idx, id_, l, vk, fid, nid, fs, child_num
+    cdef byte_t label
+    cdef QueueNode queue_node, queue_node2
+    cdef deque[QueueNode] q = deque[QueueNode]()
+    cdef byte_t children[256]
+    cdef int children_nodes[256]
+    cdef int ro = 0
+    memset(fails, -1, sizeof(int) * trie.array_size)
+    memset(outputs, 0, sizeof(int) * trie.array_size)
+    memset(key_lens, 0, sizeof(unsigned int) * trie.leaf_size)
+    fails[ro] = ro
+    child_num = trie.children(ro, children, children_nodes, 256)
+    for idx in range(child_num):
+        label = children[idx]
+        id_ = children_nodes[idx]
+        queue_node.node_id = id_
+        queue_node.node_label = label
+        queue_node.len = 1
+        q.push_back(queue_node)
+        fails[id_] = ro
+    while q.size() > 0:
+        queue_node2 = q.front()
+        q.pop_front()
+        nid = queue_node2.node_id
+        l = queue_node2.len
+        vk = trie.value(nid)
+        if vk >= 0:
+            key_lens[vk] = l
+        child_num = trie.children(nid, children, children_nodes, 256)
+        for idx in range(child_num):
+            label = children[idx]
+            id_ = children_nodes[idx]
+            queue_node.node_id = id_
+            queue_node.node_label = label
+            queue_node.len = l + 1
+            q.push_back(queue_node)
+            fid = nid
+            while fid != ro:
+                fs = trie.child(fails[fid], label)
+                if fs >= 0:
+                    fid = fs
+                    break
+                fid = fails[fid]
+            fails[id_] = fid
+            # fid is shallower than id_, its output is set already
+            outputs[id_] = fid if fid != ro and trie.has_value(fid) else outputs[fid]
+
+
+cdef void build_depths(Trie trie, int* depths):
+    cdef deque[int] q
+    cdef byte_t children[256]
+    cdef int children_nodes[256]
+    cdef int nid, idx, child_num
+    memset(depths, 0, sizeof(int) * trie.array_size)
+    q.push_back(0)
+    while q.size() > 0:
+        nid = q.front()
+        q.pop_front()
+        child_num = trie.children(nid, children, children_nodes, 256)
+        for idx in range(child_num):
+            depths[children_nodes[idx]] = depths[nid] + 1
+            q.push_back(children_nodes[idx])
+
+
+cdef void build_outputs(Trie trie, int* fails, int* outputs):
+    # output links for data saved before version 2, parents are visited before children
+    cdef deque[int] q
+    cdef byte_t children[256]
+    cdef int children_nodes[256]
+    cdef int nid, fid, idx, child_num
+    memset(outputs, 0, sizeof(int) * trie.array_size)
+    q.push_back(0)
+    while q.size() > 0:
+        nid = q.front()
+        q.pop_front()
+        child_num = trie.children(nid, children, children_nodes, 256)
+        for idx in range(child_num):
+            q.push_back(children_nodes[idx])
+        if nid == 0:
+            continue
+        fid = fails[nid]
+        outputs[nid] = fid if fid > 0 and trie.has_value(fid) else outputs[fid]
+
+
+cdef int complete_utf8_len(byte_t* src, int n) noexcept nogil:
+    # length of src without the trailing truncated utf8 char
+    cdef int i = n - 1
+    while i > 0 and n - i < 4 and src[i] & 0xc0 == 0x80:
+        i -= 1
+    if i >= 0 and i + utf8_char_len(src[i]) > n:
+        return i
+    return n
+
+
+# bytes scanned at a time by the iterator of AC.match
+cdef int scan_chunk = 1 << 14
+
+
+cdef class MatchScanner(object):
+    """
+    iterator returned by AC.match and AC.match_bytes. the text is scanned without GIL in chunks of
+    scan_chunk bytes when the matches of the last chunk are consumed, so only the matches of a chunk are kept.
+    """
+    cdef AC ac
+    cdef xstring xstr # the text, or xb if it's None
+    cdef ignore_case_alignment align
+    cdef xbytes xb
+    cdef byte_t* bytes_
+    cdef int byte_num
+    cdef int offset # bytes scanned
+    cdef int nid
+    cdef unsigned int generation # generation of the links nid belongs to
+    cdef Separators seps
+    cdef bool return_all
+    cdef Trie payload_trie # payloads are appended to tuples if it's not None
+    cdef dict counters
+    cdef vector[Matched] vect
+    cdef size_t pos
+
+    def __cinit__(self, AC ac, xstring xstr, ignore_case_alignment align, xbytes xb, Separators seps, bool return_all, Trie payload_trie, dict counters):
+        self.ac = ac
+        self.xstr = xstr
+        self.align = align
+        self.xb = xb
+        if xstr is not None:
+            self.bytes_ = xstr.bytes_
+            self.byte_num = xstr.byte_num
+        else:
+            self.bytes_ = xb.bytes_
+            self.byte_num = xb.byte_num
+        self.offset = 0
+        self.nid = 0
+        self.generation = ac.generation
+        self.seps = seps
+        self.return_all = return_all
+        self.payload_trie = payload_trie
+        self.counters = counters
+        self.pos = 0
+
+    cdef void _resync(self) except *:
+        # keys were added or removed, node ids changed. find the state after the scanned bytes again
+        cdef vector[Matched] ignored
+        cdef int begin = 0
+        cdef int end
+        self.ac.commit()
+        self.generation = self.ac.generation
+        self.nid = 0
+        with nogil:
+            while begin < self.offset:
+                end = begin + min(scan_chunk, self.offset - begin)
+                ignored.clear()
+                self.nid = self.ac._scan(self.bytes_, begin, end, self.byte_num, self.nid, NULL, False, ignored)
+                begin = end
+
+    cdef bool _fill(self) except *:
+        # matches of the next chunk, False at the end of the text
+        cdef SepTable* sep = sep_table(self.seps)
+        cdef long long fails_taken = 0
+        cdef long long* fails_ptr = &fails_taken if self.counters is not None else NULL
+        cdef int end
+        cdef int* mapping = NULL
+        self.vect.clear()
+        self.pos = 0
+        while self.vect.size() == 0:
+            if self.offset >= self.byte_num:
+                return False
+            if self.ac.dirty or self.generation != self.ac.generation:
+                self._resync()
+            end = self.offset + min(scan_chunk, self.byte_num - self.offset)
+            with nogil:
+                self.nid = self.ac._scan(self.bytes_, self.offset, end, self.byte_num, self.nid, sep, self.return_all, self.vect, fails_ptr)
+            if self.counters is not None:
+                add_counters(self.counters, end - self.offset, fails_taken, self.vect.size())
+                fails_taken = 0
+            self.offset = end
+        if self.xstr is None:
+            to_byte_offsets(self.vect, self.xb)
+        else:
+            if self.align is not None:
+                mapping = self.align.lowercase_char_index_mapping
+            to_char_offsets(self.vect, self.xstr.char_idx_of_byte, mapping)
+        return True
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.pos >= self.vect.size() and not self._fill():
+            raise StopIteration
+        cdef Matched* m = &self.vect[self.pos]
+        self.pos += 1
+        if self.payload_trie is not None:
+            return m.val, m.start, m.end, self.payload_trie._payload(m.val)
+        return m.val, m.start, m.end
+
+
+cdef class StreamMatcher(object):
+    """
+    scanner created by AC.stream. it keeps the automaton state and the tail of the
+    scanned text, so keywords spanning chunks are found and memory doesn't grow with the stream.
+    """
+    cdef AC ac
+    cdef Separators seps
+    cdef bool return_all
+    cdef int nid
+    cdef unsigned int generation # generation of the links nid belongs to
+    cdef int keep # history size which is enough for the longest key and the char before it
+    cdef int mode # 0: not started, 1: unicode chunks, 2: bytes chunks
+    cdef vector[byte_t] history # tail of the scanned bytes, followed by the current chunk
+    cdef vector[long long] hist_starts # stream offset of history bytes
+    cdef vector[long long] hist_ends
+    cdef vector[Matched] pending # matched at the end of history, waiting for the next char
+    cdef bytes carry # truncated utf8 char at the end of the last bytes chunk
+    cdef long long position
+
+    def __cinit__(self, AC ac, sep, bool return_all):
+        cdef int i
+        self.ac = ac
+        self.seps = as_separators(sep)
+        self.return_all = return_all
+        ac.commit()
+        self._sync_keep()
+        self.reset()
+
+    cdef void _sync_keep(self):
+        cdef int i
+        self.generation = self.ac.generation
+        self.keep = 4
+        for i in range(self.ac.trie.leaf_size):
+            if <int>self.ac.key_lens[i] + 4 > self.keep:
+                self.keep = self.ac.key_lens[i] + 4
+
+    cdef void _resync(self) except *:
+        # keys were added or removed, node ids changed. the state is the longest
+        # suffix of the scanned text in the trie, find it again from the history
+        cdef vector[Matched] ignored
+        self.ac.commit()
+        self._sync_keep()
+        self.nid = self.ac._scan(self.history.data(), 0, self.history.size(), self.history.size(), 0, NULL, False, ignored)
+
+    property position:
+        def __get__(self):
+            return self.position
+
+    def reset(self):
+        """
+        drop the state, the next chunk starts a new stream
+        """
+        self.nid = 0
+        self.mode = 0
+        self.position = 0
+        self.carry = b""
+        self.history.clear()
+        self.hist_starts.clear()
+        self.hist_ends.clear()
+        self.pending.clear()
+
+    def feed(self, chunk):
+        """
+        scan the next chunk of the stream.
+        Args:
+            chunk : unicode | bytes-like object
+                unicode chunks get char offsets, utf8 bytes get byte offsets.
+                one stream can't mix them.
+        Returns:
+            matched: list of tuple(id, start_offset, end_offset), offsets are counted from the start of the stream
+        """
+        return self._feed(chunk, False)
+
+    def flush(self):
+        """
+        end the stream, return the matches which were waiting for more text and reset the scanner.
+        Returns:
+            matched: list of tuple(id, start_offset, end_offset)
+        """
+        if self.mode == 0:
+            return []
+        res = self._feed(b"" if self.mode == 2 else u"", True)
+        self.reset()
+        return res
+
+    cdef long long _offset(self, int j, int begin, long long base, xstring xs, int* mapping, xbytes xb, bool end):
+        # stream offset of the char holding history byte j, offset after it if end
+        if j < begin:
+            return self.hist_ends[j] if end else self.hist_starts[j]
+        j -= begin
+        if xs is not None:
+            return base + char_offset_of_byte(xs.char_idx_of_byte, mapping, j) + (1 if end else 0)
+        if end:
+            return base + xb.end_offset(j + 1)
+        return base + xb.start_offset(j)
+
+    cdef list _feed(self, chunk, bool final):
+        cdef xstring xs = None
+        cdef xbytes xb = None
+        cdef ignore_case_alignment align
+        cdef int* mapping = NULL
+        cdef int begin = self.history.size()
+        cdef long long base = self.position
+        cdef vector[Matched] hits, out, waiting
+        cdef vector[long long] starts, ends
+        cdef SepTable* sep = sep_table(self.seps)
+        cdef Matched m
+        cdef byte_t* bytes_
+        cdef bytes data
+        cdef int byte_num, n, cut, i
+        cdef size_t k
+        if self.ac.dirty or self.generation != self.ac.generation:
+            self._resync()
+        if isinstance(chunk, unicode):
+            if self.mode == 2:
+                raise Exception("can't feed unicode to a stream of bytes")
+            self.mode = 1
+            xs = xstring(chunk)
+            if self.ac.trie.ignore_case:
+                align = ignore_case_alignment(xs)
+                xs = align.lowercase
+                mapping = align.lowercase_char_index_mapping
+            bytes_ = xs.bytes_
+            n = xs.byte_num
+            self.position += len(chunk)
+        else:
+            if self.mode == 1:
+                raise Exception("can't feed bytes to a stream of unicode")
+            self.mode = 2
+            data = self.carry + bytes(memoryview(chunk))
+            n = len(data) if final else complete_utf8_len(<byte_t*>data, len(data))
+            self.carry = data[n:]
+            xb = xbytes(data[:n], self.ac.trie.ignore_case)
+            bytes_ = xb.bytes_
+            n = xb.byte_num
+            self.position += len(data) - len(self.carry)
+        self.history.resize(begin + n)
+        memcpy(self.history.data() + begin, bytes_, n)
+        bytes_ = self.history.data()
+        byte_num = self.history.size()
+
+        with nogil:
+            for k in range(self.pending.size()):
+                m = self.pending[k]
+                if m.end < byte_num:
+                    if in_sep(sep, char_at_byte(bytes_, m.end, byte_num)):
+                        out.push_back(m)
+                elif final:
+                    out.push_back(m)
+                else:
+                    waiting.push_back(m)
+            self.nid = self.ac._scan(bytes_, begin, byte_num, byte_num, self.nid, NULL, self.return_all, hits)
+            for k in range(hits.size()):
+                m = hits[k]
+                if sep != NULL:
+                    if m.start > 0 and not in_sep(sep, char_before_byte(bytes_, m.start, byte_num)):
+                        continue
+                    if m.end == byte_num and not final:
+                        waiting.push_back(m)
+                        continue
+                    if m.end < byte_num and not in_sep(sep, char_at_byte(bytes_, m.end, byte_num)):
+                        continue
+                out.push_back(m)
+        self.pending.swap(waiting)
+        res = [(m.val, self._offset(m.start, begin, base, xs, mapping, xb, False),
+                self._offset(m.end - 1, begin, base, xs, mapping, xb, True)) for m in out]
+
+        # keep the tail which the next chunk may need, cut at a char boundary
+        cut = byte_num - self.keep
+        if cut < 0:
+            cut = 0
+        while cut > 0 and self.history[cut] & 0xc0 == 0x80:
+            cut -= 1
+        for i in range(cut, byte_num):
+            starts.push_back(self._offset(i, begin, base, xs, mapping, xb, False))
+            ends.push_back(self._offset(i, begin, base, xs, mapping, xb, True))
+        self.hist_starts.swap(starts)
+        self.hist_ends.swap(ends)
+        if cut > 0:
+            self.history.erase(self.history.begin(), self.history.begin() + cut)
+            for k in range(self.pending.size()):
+                self.pending[k].start -= cut
+                self.pending[k].end -= cut
+        return res
+
+
+cdef class _BatchJob(object):
+    cdef AC ac
+    cdef Separators seps
+    cdef bool return_all
+    cdef bool as_arrays
+
+    def __cinit__(self, AC ac, sep, bool return_all, bool as_arrays):
+        self.ac = ac
+        self.seps = as_separators(sep)
+        self.return_all = return_all
+        self.as_arrays = as_arrays
+
+    def run(self, list texts):
+        return self.ac._match_many(texts, sep_table(self.seps), self.return_all, self.as_arrays)
+
+
+cdef AC ac_from_buff(void* buf, long long buf_size, bool copy):
 
     cdef char* buff = <char*>buf
-    cdef int offset = 0
+    cdef long long offset = 0
     cdef AC ac = new_object(AC)
     cdef uint32_t magic
-    cdef int size, ac_version
+    cdef long long size
+    cdef int small_size
+    cdef int ac_version = 0
+    check_bounds(sizeof(magic), buf_size)
     memcpy(<void*>&magic, buff, sizeof(magic))
     if magic != magic_number and magic != legacy_magic_number:
         raise Exception("invalid data, magic number is not correct")
     offset += sizeof(magic)
 
     if magic == magic_number:
+        check_bounds(offset + sizeof(ac_version), buf_size)
         memcpy(<void*>&ac_version, buff + offset, sizeof(ac_version))
-        if ac_binary_version < ac_version:
+        if ac_large_binary_version < ac_version:
             raise Exception("reading newer binary file, please update cyac")
         offset += sizeof(ac_version)
 
-    memcpy(&size, buff + offset, sizeof(int))
-    offset += sizeof(int)
-    if size > buf_size:
-        raise Exception("invalid data, buf size is not correct")
-    trie = trie_from_buff(buff + offset, buf_size - offset, copy)
+    if ac_version == ac_large_binary_version:
+        check_bounds(offset + sizeof(long long), buf_size)
+        memcpy(&size, buff + offset, sizeof(long long))
+        offset += sizeof(long long)
+    else:
+        check_bounds(offset + sizeof(int), buf_size)
+        memcpy(&small_size, buff + offset, sizeof(int))
+        offset += sizeof(int)
+        size = small_size
+    check_bounds(size, buf_size)
+    # fails and outputs for each node, and the length of each key follow the trie
+    trie = trie_from_buff(buff + offset, buf_size - offset, copy,
+                          sizeof(int) * (2 if ac_version >= 2 else 1) + (sizeof(OutNode) if magic == legacy_magic_number else 0), sizeof(unsigned int))
     offset += trie.buff_size()
     if copy:
         if magic == legacy_magic_number:
             offset += sizeof(OutNode) * trie.array_size
-        # ac.output = <OutNode*>malloc(sizeof(OutNode) * trie.array_size)
-        # memcpy(<void*>ac.output, buff + offset, sizeof(OutNode) * trie.array_size)
-        # offset += sizeof(OutNode) * trie.array_size
 
         ac.fails = <int*>malloc(sizeof(int) * trie.array_size)
         memcpy(<void*>ac.fails, buff + offset, sizeof(int) * trie.array_size)
         offset += sizeof(int) * trie.array_size
 
+        ac.outputs = <int*>malloc(sizeof(int) * trie.array_size)
+        if ac_version >= 2:
+            memcpy(<void*>ac.outputs, buff + offset, sizeof(int) * trie.array_size)
+            offset += sizeof(int) * trie.array_size
+        else:
+            build_outputs(trie, ac.fails, ac.outputs)
+
         ac.key_lens = <unsigned int*>malloc(sizeof(unsigned int) * trie.leaf_size)
         memcpy(<void*>ac.key_lens, buff + offset, sizeof(unsigned int) * trie.leaf_size)
         offset += sizeof(unsigned int) * trie.leaf_size
     else:
         if magic == legacy_magic_number:
             offset += sizeof(OutNode) * trie.array_size
-        # ac.output = <OutNode*>(buff + offset)
-        # offset += sizeof(OutNode) * trie.array_size
 
         ac.fails = <int*>(buff + offset)
         offset += sizeof(int) * trie.array_size
 
+        if ac_version >= 2:
+            ac.outputs = <int*>(buff + offset)
+            offset += sizeof(int) * trie.array_size
+        else:
+            ac.outputs = <int*>malloc(sizeof(int) * trie.array_size)
+            ac.outputs_owned = True
+            build_outputs(trie, ac.fails, ac.outputs)
+
         ac.key_lens = <unsigned int*>(buff + offset)
         offset += sizeof(unsigned int) * trie.leaf_size
 
@@ -0,0 +1,274 @@
+"""
+an automaton split into several AC automata, for dictionaries beyond the limits of one:
+2^30 nodes, and 2^31 ids. keys are spread over the shards by a hash of their utf8 bytes,
+match scans the text with each shard and merges the results in the order of a single automaton.
+
+Examples:
+    >>> from cyac.sharded import ShardedAC
+    >>> ac = ShardedAC.build(words, shards=4)
+    >>> for id_, start, end in ac.match(text):
+    >>>     print(ac[id_], start, end)
+    >>> ac.save("entities.bin")
+    >>> with open("entities.bin", "rb") as fi:
+    >>>     ac = ShardedAC.from_buff(mmap.mmap(fi.fileno(), 0, access=mmap.ACCESS_READ), copy=False)
+"""
+import heapq
+import struct
+import zlib
+from .ac import AC
+from .version import sharded_magic_number
+
+_header = struct.Struct("<II") # magic, number of shards, then the size of each image as a long long
+
+
+def _route(key, shards, ignore_case):
+    # shard of key, keys of an ignore_case automaton are lowercased
+    if ignore_case:
+        key = key.lower()
+    return zlib.crc32(key.encode("utf8")) % shards
+
+
+def _check_return_all(return_all):
+    if not return_all:
+        raise Exception("return_all=False depends on the state of one automaton, it can't be merged from shards")
+
+
+def _padded(size):
+    # images stay aligned in 8 bytes
+    return (size + 7) & ~7
+
+
+class ShardedAC(object):
+    """
+    ids are global: the id of a key in shard s is local_id * shards + s.
+    it has the lookup and match methods of AC, but not the longest or leftmost matches,
+    nor match with return_all=False, which can't be chosen by one shard alone.
+    """
+
+    def __init__(self, shards = 2, ignore_case = False, ordered = False, payload_type = None):
+        """
+        an empty automaton of `shards` AC automata, see AC.build for the other arguments.
+        """
+        if shards < 1:
+            raise Exception("shards must be positive")
+        self.ignore_case = ignore_case
+        self.shards = [AC.build([], ignore_case, ordered, False, payload_type) for _ in range(shards)]
+
+    @classmethod
+    def build(cls, pats, shards = 2, ignore_case = False, ordered = False, payload_type = None):
+        """
+        Build the automata at once, see AC.build
+        Args:
+            pats : iterable(unicode)
+                tuples of (pattern, payload) if payload_type is set
+            shards : int
+                number of automata, keep each one under 2^30 nodes and a few GB
+        Returns:
+            ac : ShardedAC
+        Examples:
+            >>> ShardedAC.build(["python", "ruby"], shards=4)
+        """
+        parts = [[] for _ in range(shards)]
+        for pat in pats:
+            key = pat if payload_type is None else pat[0]
+            parts[_route(key, shards, ignore_case)].append(pat)
+        ret = cls.__new__(cls)
+        ret.ignore_case = ignore_case
+        ret.shards = [AC.build(part, ignore_case, ordered, False, payload_type) for part in parts]
+        return ret
+
+    def _shard_of(self, key):
+        return _route(key, len(self.shards), self.ignore_case)
+
+    def _split(self, id_):
+        # shard and local id of a global id
+        if id_ < 0:
+            raise AttributeError("invalid id: %d" % id_)
+        return self.shards[id_ % len(self.shards)], id_ // len(self.shards)
+
+    def _global(self, local_id, shard):
+        return local_id * len(self.shards) + shard if local_id >= 0 else local_id
+
+    def add(self, key, payload = None):
+        """
+        add a key, see AC.add
+        Returns:
+            id : int
+                global id of the key, -1 if key is empty.
+        """
+        shard = self._shard_of(key)
+        return self._global(self.shards[shard].add(key, payload), shard)
+
+    def remove(self, key):
+        """
+        remove a key, see AC.remove
+        Returns:
+            id : int
+                global id of the removed key, -1 if it's not in the automaton.
+        """
+        shard = self._shard_of(key)
+        return self._global(self.shards[shard].remove(key), shard)
+
+    def get(self, key):
+        """
+        global id of key, -1 if it's not in the automaton
+        """
+        shard = self._shard_of(key)
+        ac = self.shards[shard]
+        return self._global(ac[key], shard) if key in ac else -1
+
+    def __contains__(self, key):
+        return self.get(key) >= 0
+
+    def __getitem__(self, key):
+        """
+        the key of a global id, or the global id of a key
+        """
+        if isinstance(key, int):
+            shard, id_ = self._split(key)
+            return shard[id_]
+        id_ = self.get(key)
+        if id_ < 0:
+            raise KeyError(key)
+        return id_
+
+    def __len__(self):
+        return sum(shard.size for shard in self.shards)
+
+    def __iter__(self):
+        # global ids, shard by shard
+        n = len(self.shards)
+        for i, shard in enumerate(self.shards):
+            for id_ in shard:
+                yield id_ * n + i
+
+    def items(self):
+        """
+        Iterates:
+            (key, id) : tuple(unicode, int)
+                global ids, shard by shard
+        """
+        n = len(self.shards)
+        for i, shard in enumerate(self.shards):
+            for key, id_ in shard.items():
+                yield key, id_ * n + i
+
+    def payload(self, id_):
+        """
+        the payload of a key by global id, see Trie.payload
+        """
+        shard, id_ = self._split(id_)
+        return shard.payload(id_)
+
+    def set_payload(self, id_, value):
+        shard, id_ = self._split(id_)
+        shard.set_payload(id_, value)
+
+    def commit(self):
+        """
+        rebuild the links of changed shards, see AC.commit
+        """
+        for shard in self.shards:
+            shard.commit()
+
+    def freeze(self):
+        for shard in self.shards:
+            shard.freeze()
+
+    def match(self, text, sep = None, return_all = True, with_payload = False):
+        """
+        extract keys from text, the results are the same as of one automaton with all keys,
+        but with global ids. see AC.match for the arguments.
+        return_all=False isn't supported, it reports the key of the state of one automaton,
+        which differs from shard to shard.
+        Iterates:
+            matched: tuple(id, start_offset, end_offset)
+                ordered by end_offset, then start_offset. the payload is appended if with_payload
+        """
+        _check_return_all(return_all)
+        return self._merge([shard.match(text, sep, with_payload = with_payload) for shard in self.shards])
+
+    def match_bytes(self, data, sep = None, return_all = True, with_payload = False):
+        """
+        same as match, but data is utf8 text in bytes, bytearray, mmap or memoryview. offsets are byte offsets.
+        """
+        _check_return_all(return_all)
+        return self._merge([shard.match_bytes(data, sep, with_payload = with_payload) for shard in self.shards])
+
+    def _merge(self, results):
+        # each shard is ordered by (end, start), and a key is in one shard only
+        n = len(self.shards)
+        streams = [[(m[2], m[1], m[0] * n + i) + tuple(m[3:]) for m in ms] for i, ms in enumerate(results)]
+        for m in heapq.merge(*streams):
+            yield (m[2], m[1], m[0]) + m[3:]
+
+    def stats(self):
+        """
+        AC.stats of each shard
+        """
+        return [shard.stats() for shard in self.shards]
+
+    def buff_size(self):
+        """
+        return the memory size of buffer needed for exporting to external buffer.
+        """
+        return _header.size + 8 * len(self.shards) + sum(_padded(shard.buff_size()) for shard in self.shards)
+
+    def to_buff(self, buff):
+        """
+        copy data into buff, the image of each shard follows a header with their sizes
+        Args:
+            buff: object satisfy Python buff protocol
+        """
+        view = memoryview(buff).cast("B")
+        if len(view) < self.buff_size():
+            raise Exception("buff size is smaller than needed.")
+        sizes = [shard.buff_size() for shard in self.shards]
+        _header.pack_into(view, 0, sharded_magic_number, len(self.shards))
+        struct.pack_into("<%dq" % len(sizes), view, _header.size, *sizes)
+        offset = _header.size + 8 * len(sizes)
+        for shard, size in zip(self.shards, sizes):
+            shard.to_buff(view[offset:offset + size])
+            offset += _padded(size)
+
+    @classmethod
+    def from_buff(cls, buff, copy = True):
+        """
+        init the automaton from buff, see AC.from_buff
+        Args:
+            buff: object satisfy Python buff protocol
+            copy: whether copy data, by default, it copies data from buff
+        """
+        view = memoryview(buff).cast("B")
+        if len(view) < _header.size:
+            raise Exception("invalid data, buf size is not correct")
+        magic, n = _header.unpack_from(view, 0)
+        if magic != sharded_magic_number:
+            raise Exception("invalid data, magic number is not correct")
+        if n < 1 or len(view) < _header.size + 8 * n:
+            raise Exception("invalid data, buf size is not correct")
+        sizes = struct.unpack_from("<%dq" % n, view, _header.size)
+        ret = cls.__new__(cls)
+        ret.shards = []
+        offset = _header.size + 8 * n
+        for size in sizes:
+            if size < 0 or offset + size > len(view):
+                raise Exception("invalid data, buf size is not correct")
+            ret.shards.append(AC.from_buff(view[offset:offset + size], copy))
+            offset += _padded(size)
+        ret.ignore_case = ret.shards[0].ignore_case
+        return ret
+
+    def save(self, fname):
+        """
+        save data into binary file, load it with from_buff
+        """
+        sizes = [shard.buff_size() for shard in self.shards]
+        with open(fname, "wb") as fo:
+            fo.write(_header.pack(sharded_magic_number, len(self.shards)))
+            fo.write(struct.pack("<%dq" % len(sizes), *sizes))
+            # one shard in memory at a time
+            for shard, size in zip(self.shards, sizes):
+                data = bytearray(_padded(size))
+                shard.to_buff(data)
+                fo.write(data)
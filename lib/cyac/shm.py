@@ -0,0 +1,78 @@
+"""
+share a Trie or an AC automaton between processes with multiprocessing.shared_memory (python >= 3.8).
+the image is copied into shared memory once, processes attach to it by name without copying it.
+
+Examples:
+    >>> from cyac import AC
+    >>> from cyac.shm import publish, attach
+    >>> shm = publish(AC.build([u"python", u"ruby"]))
+    >>> # in other processes
+    >>> ac, block = attach(shm.name)
+    >>> ac.match(u"python")
+    >>> del ac
+    >>> block.close()
+    >>> # in the publishing process, when all processes are done
+    >>> shm.close()
+    >>> shm.unlink()
+"""
+from multiprocessing import shared_memory
+from .ac import AC
+
+
+def publish(obj, name = None):
+    """
+    copy the image of obj into a new shared memory block
+    Args:
+        obj : Trie | AC
+        name : str | None
+            name of the block, a unique name is generated if it's None
+    Returns:
+        shm : SharedMemory
+            pass shm.name to attach. the caller closes and unlinks it when it isn't used any more
+    """
+    shm = shared_memory.SharedMemory(name = name, create = True, size = obj.buff_size())
+    try:
+        obj.to_buff(shm.buf)
+    except:
+        shm.close()
+        shm.unlink()
+        raise
+    return shm
+
+
+def _open_untracked(name):
+    # python < 3.13 registers every opened block with the resource tracker, which unlinks it when the process
+    # exits. unregistering it afterwards breaks the tracker shared with the publisher by multiprocessing,
+    # so the block isn't registered. a block created by another thread meanwhile isn't registered either
+    from multiprocessing import resource_tracker
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name = name)
+    finally:
+        resource_tracker.register = register
+
+
+def attach(name, cls = AC, copy = False):
+    """
+    load an automaton or a trie published by publish, it shares memory with the block unless copy is True.
+    the block is never written, the data is copied before the first change.
+    Args:
+        name : str
+        cls : AC | Trie
+        copy : bool
+    Returns:
+        (obj, shm) : (AC | Trie, SharedMemory)
+            keep shm while obj is used, delete obj before shm.close()
+    """
+    try:
+        # the publisher owns the block, it mustn't be unlinked when this process exits
+        shm = shared_memory.SharedMemory(name = name, track = False)
+    except TypeError: # python < 3.13
+        shm = _open_untracked(name)
+    try:
+        obj = cls.from_buff(shm.buf, copy = copy)
+    except:
+        shm.close()
+        raise
+    return obj, shm
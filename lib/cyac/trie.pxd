@@ -3,10 +3,18 @@ from libc.string cimport strlen, memcpy, memset
 from libc.stdlib cimport malloc, free, realloc
 from libcpp cimport bool
 from libcpp.deque  cimport deque
+from libcpp.vector cimport vector
 from libc.stdio cimport *
 from libcpp cimport bool
 import cython
-from .xstring cimport xstring, byte_t, ignore_case_alignment, unicode_int_t, stringbuf
+from libcpp.string cimport string
+from .xstring cimport xstring, xbytes, xcolumn, byte_t, ignore_case_alignment, unicode_int_t, stringbuf, ascii_utf8, PyUnicode_IS_ASCII
+
+cdef extern from "<algorithm>" namespace "std" nogil:
+    void sort[Iter](Iter first, Iter last)
+    bool binary_search[Iter, T](Iter first, Iter last, const T& value)
+    void push_heap[Iter, Compare](Iter first, Iter last, Compare comp)
+    void pop_heap[Iter, Compare](Iter first, Iter last, Compare comp)
 
 
 cdef struct Block:
@@ -18,6 +26,31 @@ cdef struct Block:
     int ehead
 
 
+cdef struct Matched:
+    int val
+    int start
+    int end
+
+
+cdef struct WeightedNode:
+    long long weight # max weight in the subtree of node, or the weight of id_ if id_ >= 0
+    int node
+    int id_
+    int tie # smallest id of the keys of that weight in the subtree, or id_
+
+
+cdef struct FuzzyHit:
+    int id_
+    int dist
+    int end # chars of the text matched by the key
+
+
+cdef struct KeyRef:
+    int start # offset in the key buffer
+    int len_
+    int id_
+
+
 cdef struct Node:
     int value
     int check
@@ -25,10 +58,10 @@ cdef struct Node:
     byte_t child
     unsigned short flags
 
-cpdef inline bytes array_to_bytes(char* ptr, int size):
+cpdef inline bytes array_to_bytes(char* ptr, Py_ssize_t size):
     return <bytes>ptr[:size]
 
-cpdef inline char* bytes_to_array(bytes data, int capacity):
+cpdef inline char* bytes_to_array(bytes data, Py_ssize_t capacity):
     cdef char* ptr = <char*> malloc(capacity)
     memcpy(ptr, <char *>data, len(data))
     return ptr
@@ -36,10 +69,71 @@ cpdef inline char* bytes_to_array(bytes data, int capacity):
 
 cdef inline int ignore_case_offset(ignore_case_alignment align, xstring xs, int byte_idx):
     cdef int char_offset = xs.char_idx_of_byte[byte_idx]
-    if align is None:
+    if align is None or align.lowercase_char_index_mapping == NULL:
         return char_offset
     return align.lowercase_char_index_mapping[char_offset]
 
+cdef inline int ignore_case_byte_index_mapping(ignore_case_alignment align, int byte_idx):
+    if align is None or align.lowercase.char_offsets == align.original.char_offsets:
+        return byte_idx
+    cdef int char_offset = align.lowercase.char_idx_of_byte[byte_idx]
+    if align.lowercase_char_index_mapping != NULL:
+        char_offset = align.lowercase_char_index_mapping[char_offset]
+    cdef int ret = align.original.char_offsets[char_offset]
+    return ret
+
+cdef inline int char_offset_of_byte(int* char_idx_of_byte, int* lowercase_char_index_mapping, int byte_idx) noexcept nogil:
+    # same as ignore_case_offset, usable without gil
+    cdef int char_offset = char_idx_of_byte[byte_idx]
+    if lowercase_char_index_mapping == NULL:
+        return char_offset
+    return lowercase_char_index_mapping[char_offset]
+
+cdef struct SepTable:
+    unsigned char bmp[8192] # one bit for each char in the BMP
+    int* others # sorted seperators out of the BMP
+    int other_num
+
+cdef class Separators(object):
+    cdef SepTable table
+    cdef vector[int] others
+    cdef void _add(self, int chr_) except *
+
+cdef Separators as_separators(sep)
+
+cdef inline SepTable* sep_table(Separators seps):
+    if seps is None:
+        return NULL
+    return &seps.table
+
+cdef inline bool in_sep(SepTable* sep, int chr_) noexcept nogil:
+    if chr_ < 0:
+        return False
+    if chr_ < 0x10000:
+        return (sep.bmp[chr_ >> 3] >> (chr_ & 7)) & 1
+    return binary_search(sep.others, sep.others + sep.other_num, chr_)
+
+cdef inline void to_char_offsets(vector[Matched]& res, int* char_idx_of_byte, int* mapping) noexcept nogil:
+    cdef size_t i
+    for i in range(res.size()):
+        res[i].start = char_offset_of_byte(char_idx_of_byte, mapping, res[i].start)
+        res[i].end = char_offset_of_byte(char_idx_of_byte, mapping, res[i].end - 1) + 1
+
+cdef inline void to_byte_offsets(vector[Matched]& res, xbytes xb) noexcept nogil:
+    cdef size_t i
+    if xb.align is None:
+        return
+    for i in range(res.size()):
+        res[i].start = xb.start_offset(res[i].start)
+        res[i].end = xb.end_offset(res[i].end)
+
+cdef inline void add_row_hits(vector[int]& rows, vector[Matched]& res, vector[Matched]& vect, int row) noexcept nogil:
+    # matches of a column row are appended to res
+    cdef size_t i
+    for i in range(vect.size()):
+        rows.push_back(row)
+        res.push_back(vect[i])
+
 cdef class Trie(object):
     cdef int key_num
     cdef int key_capacity
@@ -57,30 +151,64 @@ cdef class Trie(object):
     cdef int last_remove_leaf
     cdef int* leafs
     cdef int leaf_size
+    cdef bool frozen # read only, no spare capacity and no blocks, see freeze
+    cdef int payload_kind # PAYLOAD_NONE, PAYLOAD_INT, PAYLOAD_FLOAT or PAYLOAD_BYTES
+    cdef long long* payloads # one for each leaf slot, double for floats, offset << 32 | size in blob for bytes
+    cdef char* blob
+    cdef long long blob_size
+    cdef long long blob_capacity
+    cdef long long blob_garbage # bytes of replaced and removed payloads left in blob, see _compact_blob
+    cdef long long* key_slots # offset << 32 | size of each key in key_blob, NULL without a key table
+    cdef char* key_blob
+    cdef long long key_blob_size
+    cdef long long key_blob_capacity
+    cdef long long* node_weights # max weight of keys under each node for predict_top, NULL until it's used
+    cdef int* node_ties # smallest id of the keys under each node which have its max weight
+    cdef bool weights_shared # node_weights and node_ties are in buff, saved with a frozen trie
+    cdef vector[long long] relocations # relocations[n] counts resolves which moved n nodes, see stats
     cdef Py_buffer* buff
     cdef inline int _get(self, byte_t *key, int key_size, int from_, int start)
     cdef inline int follow(self, int from_, byte_t label)
     cdef bool has_label(self, int id_, byte_t label)
-    cdef inline int child(self, int id_, byte_t label)
-    cdef inline int children(self, int id_, byte_t *labels, int *children_arr, int first_n)
-    cdef inline int jump(self, byte_t byte, int from_)
-    cdef inline int jump_bytes(self, byte_t *bytes_, int byte_num, int from_)
+    cdef inline int child(self, int id_, byte_t label) noexcept nogil
+    cdef inline int children(self, int id_, byte_t *labels, int *children_arr, int first_n) noexcept nogil
+    cdef inline int jump(self, byte_t byte, int from_) noexcept nogil
+    cdef inline int jump_bytes(self, byte_t *bytes_, int byte_num, int from_) noexcept nogil
     cdef inline int jump_uchar(self, xstring text, int uchar_idx, int from_)
     cdef bytes substring(self, int id_, int start_id)
     cdef bytes key(self, int id_)
-    cdef inline int value(self, int id_)
-    cdef inline bool has_value(self, int id_)
-    cpdef int insert(self, unicode key)
+    cdef inline int value(self, int id_) noexcept nogil
+    cdef inline bool has_value(self, int id_) noexcept nogil
+    cpdef int insert(self, unicode key, payload=*)
     cpdef int remove(self, unicode key_)
     cpdef int get(self, unicode key)
     cdef inline int get_bytes(self, byte_t* bkey, int len_)
+    cdef int _insert_bytes(self, byte_t* ckey, int bkey_len, payload) except -2
+    cdef int _remove_bytes(self, byte_t* cbkey, int size) except -2
+    cdef void _build_sorted(self, byte_t* buf, vector[KeyRef]& keys)
+    cdef void _resize_slots(self, int old_capacity)
+    cdef long long _append_key(self, byte_t* key, int size) except? -1
+    cdef unicode _key_of(self, int id_)
+    cdef void _export_keys(self, string& data, vector[long long]& offsets, bool walk=*)
+    cdef inline long long _weight(self, int id_)
+    cdef void _build_weights(self)
+    cdef inline void _drop_weights(self)
+    cdef bool _saves_weights(self)
+    cdef void _fuzzy_walk(self, int node, int depth, int cp, int remain, int* word, int n, int max_dist, bool whole, SepTable* sep, vector[int]& rows, vector[FuzzyHit]& hits) noexcept nogil
+    cdef object _payload(self, int id_)
+    cdef long long _encode_payload(self, value) except? -1
+    cdef void _drop_payload(self, int id_)
+    cdef void _compact_blob(self)
+    cdef void _own(self) except *
+    cdef void _prefix(self, byte_t *bytes_, int byte_num, vector[Matched]& res) noexcept nogil
+    cdef int _match_leftmost(self, byte_t *bytes_, int byte_num, SepTable* sep, bool longest, int max_steps, vector[Matched]& res) noexcept nogil
 
     # Private Method, Don't Call
     cdef inline void _node_init(self, Node* n, int value, int check)
     cdef inline int _node_child_num(self, Node *n)
     cdef inline void _node_set_child_num(self, Node *n, int val)
-    cdef inline int _node_base(self, Node *n)
-    cdef inline bool _node_is_child(self, Node *n, int par)
+    cdef inline int _node_base(self, Node *n) noexcept nogil
+    cdef inline bool _node_is_child(self, Node *n, int par) noexcept nogil
     cdef inline byte_t* _node_child_ptr(self, Node *n)
     cdef inline byte_t* _node_sibling_ptr(self, Node *n)
     cdef inline void _block_init(self, Block* block, int prev, int next_, int trial, int ehead, int num, int reject)
@@ -100,6 +228,20 @@ cdef class Trie(object):
     cdef inline int find_places(self, byte_t *child, int child_num)
     cdef inline int resolve(self, int from_n, int base_n, byte_t label_n)
     cdef void _to_buff(self, void* buff)
+    cdef int _flags(self)
+    cdef long long _image_size(self)
+    cdef int _block_list_size(self, int head)
+    cdef int _verify(self, vector[int]& depths) except -1
     cdef write(self, FILE* ptr_fw)
 
-cdef Trie trie_from_buff(void* buf, int buf_size, bool copy)
+cdef inline int check_bounds(long long end, long long buf_size) except -1:
+    # a section of an image must end in the buffer before it's read
+    if end > buf_size:
+        raise ValueError("invalid data, buf size is not correct")
+    return 0
+
+cdef Trie trie_from_buff(void* buf, long long buf_size, bool copy, long long node_tail=*, long long leaf_tail=*)
+cdef object matched_iter(vector[Matched]& vect, bool with_start, Trie payload_trie=*)
+cdef tuple matched_to_arrays(vector[Matched]& vect, bool with_start, Trie payload_trie=*)
+cdef tuple column_arrays(vector[int]& rows, vector[Matched]& vect)
+cdef Trie payload_source(Trie trie, with_payload)
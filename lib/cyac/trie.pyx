@@ -2,31 +2,266 @@
 #    , profile=True, linetrace=True
 
 from libc.stdlib cimport malloc, free, realloc
-from libc.string cimport memcpy 
+from libc.string cimport memcpy, memcmp, memset
 from libc.stdio cimport FILE, fopen, fwrite, fclose
 from libcpp.string cimport string
+from libcpp.utility cimport pair
 from libc.stdint cimport uint32_t
+from libc.limits cimport LLONG_MIN
 from cython cimport typeof
 from .util cimport check_buffer
+from .utf8 cimport char_at_byte, utf8_char_len, encode_unicode, valid_utf8
 from cpython.buffer cimport PyObject_GetBuffer, PyObject_CheckBuffer, PyBuffer_Release, PyBuffer_GetPointer, Py_buffer, PyBUF_WRITABLE, PyBUF_SIMPLE
-from .version import magic_number, legacy_magic_number
+from cpython cimport array
+from cpython.unicode cimport PyUnicode_AsUTF8AndSize, PyUnicode_DecodeUTF8
+import unicodedata
+from .version import magic_number, legacy_magic_number, extended_magic_number, checksum_magic_number
+import array
+import mmap as mmap_module
+import os
+import struct
+import zlib
+
+try:
+    from pickle import PickleBuffer
+except ImportError: # python < 3.8
+    PickleBuffer = None
 
 def new_object(obj):
     return obj.__new__(obj)
 
+def from_image(cls, buff):
+    # rebuild Trie or AC pickled with protocol 5, it shares the image in buff and copies it on the first change
+    return cls.from_buff(buff, copy = False)
+
+_trailer = struct.Struct("<IIq") # magic, crc32 and size of the image it follows, see append_checksum
+
+def append_checksum(fname):
+    # trailer of save(fname, checksum=True). images are read up to their size, so it's ignored by from_buff
+    crc = 0
+    with open(fname, "r+b") as fo:
+        while True:
+            chunk = fo.read(1 << 20)
+            if not chunk:
+                break
+            crc = zlib.crc32(chunk, crc)
+        fo.write(_trailer.pack(checksum_magic_number, crc, fo.tell()))
+
+def open_image(path, bool use_mmap, bool populate, bool checksum):
+    # the image saved in path as a buffer, without the checksum trailer
+    with open(path, "rb") as fi:
+        if not use_mmap:
+            data = fi.read()
+        elif os.fstat(fi.fileno()).st_size == 0:
+            raise ValueError("invalid data, buf size is not correct")
+        elif populate and hasattr(mmap_module, "MAP_POPULATE"):
+            # pages are read when the file is mapped
+            data = mmap_module.mmap(fi.fileno(), 0, flags = mmap_module.MAP_SHARED | mmap_module.MAP_POPULATE, prot = mmap_module.PROT_READ)
+        else:
+            data = mmap_module.mmap(fi.fileno(), 0, access = mmap_module.ACCESS_READ)
+            if populate and hasattr(mmap_module, "MADV_WILLNEED"):
+                data.madvise(mmap_module.MADV_WILLNEED)
+    view = memoryview(data)
+    if len(view) >= _trailer.size:
+        magic, crc, size = _trailer.unpack_from(view, len(view) - _trailer.size)
+        if magic == checksum_magic_number and size == len(view) - _trailer.size:
+            view = view[:size]
+            if checksum and zlib.crc32(view) != crc:
+                raise Exception("invalid data, checksum is not correct")
+            return view
+    if checksum:
+        raise Exception("invalid data, no checksum is saved")
+    return view
+
 cdef extern from "<algorithm>" namespace "std" nogil:
     void reverse[T](T a, T b);
+    Iter unique[Iter](Iter first, Iter last)
+
+cdef const char* key_utf8(unicode key, bool ignore_case, string& lowered, Py_ssize_t* size) except NULL:
+    # utf8 of key, an ascii key is used in place. the utf8 of other keys and a lowercased key are kept
+    # in lowered, so the pointer is valid until lowered changes, and python doesn't keep a copy in the key
+    cdef const char* ret
+    cdef Py_ssize_t i
+    cdef unicode lower_key
+    cdef bytes encoded
+    if not ignore_case:
+        ret = ascii_utf8(key, size)
+        if ret != NULL:
+            return ret
+        encoded = key.encode("utf8")
+        lowered.assign(<char*>encoded, len(encoded))
+        size[0] = len(encoded)
+        return lowered.c_str()
+    if PyUnicode_IS_ASCII(key):
+        ret = ascii_utf8(key, size)
+        lowered.assign(ret, size[0])
+        for i in range(size[0]):
+            if b'A' <= lowered[i] <= b'Z':
+                lowered[i] += 32
+    else:
+        lower_key = key.lower()
+        ret = PyUnicode_AsUTF8AndSize(lower_key, size)
+        lowered.assign(ret, size[0])
+    return lowered.c_str()
+
+cdef class Separators(object):
+    """
+    a set of seperator chars, which can be used as sep of the match and replace functions.
+    chars in the BMP are tested by a bitmap, so build it once and pass it to every call.
+    Args:
+        chars : unicode | iterable(unicode | int)
+        categories : iterable(str) | None
+            unicode categories of seperators, e.g. ("Zs", "Po"). a category of one letter means all categories starting with it
+    Examples:
+        >>> sep = Separators(u" \t\n,.")
+        >>> for id_, start_offset, end_offset in ac.match(u"python, ruby", sep=sep):
+        >>>     print(id_, start_offset, end_offset)
+        >>> ac.match(u"python, ruby", sep=Separators.word_boundaries())
+    """
+    def __cinit__(self, chars = u"", categories = None):
+        cdef int i
+        memset(self.table.bmp, 0, sizeof(self.table.bmp))
+        for c in chars:
+            self._add(ord(c) if isinstance(c, unicode) else c)
+        if categories is not None:
+            categories = frozenset(categories)
+            for i in range(0x110000):
+                category = unicodedata.category(chr(i))
+                if category in categories or category[0] in categories:
+                    self._add(i)
+        sort(self.others.begin(), self.others.end())
+        self.others.erase(unique(self.others.begin(), self.others.end()), self.others.end())
+        self.table.others = self.others.data()
+        self.table.other_num = self.others.size()
+
+    cdef void _add(self, int chr_) except *:
+        if chr_ < 0 or chr_ > 0x10ffff:
+            raise Exception("seperator %d is not a unicode code point" % chr_)
+        if chr_ < 0x10000:
+            self.table.bmp[chr_ >> 3] |= 1 << (chr_ & 7)
+        else:
+            self.others.push_back(chr_)
+
+    @classmethod
+    def word_boundaries(cls):
+        """
+        seperators between words: whitespaces, punctuations, symbols and control chars
+        """
+        global _word_boundaries
+        if _word_boundaries is None:
+            _word_boundaries = cls(categories=("Z", "P", "S", "Cc"))
+        return _word_boundaries
+
+    def __contains__(self, c):
+        return in_sep(&self.table, ord(c) if isinstance(c, unicode) else c)
+
+    def __iter__(self):
+        cdef int i
+        for i in range(0x10000):
+            if in_sep(&self.table, i):
+                yield i
+        for i in self.others:
+            yield i
+
+    def __reduce__(self):
+        return (Separators, (list(self),))
+
+_word_boundaries = None
+
+cdef Separators as_separators(sep):
+    if sep is None or isinstance(sep, Separators):
+        return sep
+    return Separators(sep)
+
+cdef extern from *:
+    """
+    #include <algorithm>
+    #include <cstring>
+    struct CyacKeyLess {
+        const char* buf;
+        const int* offsets;
+        bool operator()(int a, int b) const {
+            int la = offsets[a + 1] - offsets[a], lb = offsets[b + 1] - offsets[b];
+            int r = memcmp(buf + offsets[a], buf + offsets[b], la < lb ? la : lb);
+            return r < 0 || (r == 0 && la < lb);
+        }
+    };
+    // sort key indexes by the utf8 bytes of keys, equal keys keep the input order
+    static void cyac_sort_keys(const char* buf, const int* offsets, int* order, int n) {
+        CyacKeyLess less = {buf, offsets};
+        std::stable_sort(order, order + n, less);
+    }
+    """
+    void cyac_sort_keys(const char* buf, const int* offsets, int* order, int n) nogil
+
+
+cdef struct BuildTask:
+    int node
+    int lo # range of sorted keys sharing the prefix of node
+    int hi
+    int depth
+
+
+cdef struct FuzzyTask:
+    int node
+    int depth # chars from the root
+    int cp # char ending at node, or its first bits
+    int remain # continuation bytes of cp left
+
+
+cdef inline int compare_keys(const char* buf, int a_start, int a_len, int b_start, int b_len) noexcept nogil:
+    cdef int r = memcmp(buf + a_start, buf + b_start, a_len if a_len < b_len else b_len)
+    if r != 0:
+        return r
+    return a_len - b_len
+
 
 cdef int CHILD_NUM_MASK = (1 << 9) -1
 cdef int END_MASK = 1 << 9
 cdef int value_limit = (1 << 31) - 1
+cdef int node_limit = 1 << 30 # capacity doubles, so it stays below value_limit
+
+cdef int PAYLOAD_NONE = 0
+cdef int PAYLOAD_INT = 1
+cdef int PAYLOAD_FLOAT = 2
+cdef int PAYLOAD_BYTES = 3
+payload_types = (None, "int", "float", "bytes")
+cdef int FLAG_FROZEN = 1 # flags of extended image, the payload kind is in bits 8-15
+cdef int FLAG_KEY_TABLE = 2
+cdef int FLAG_LARGE = 4 # the size is a long long, set only for images over 2GB
+cdef int FLAG_WEIGHTS = 8 # max weights for predict_top, saved with a frozen trie of int or float payloads
+
+cdef bool weighted_less(const WeightedNode& a, const WeightedNode& b) noexcept nogil:
+    # order of the heap in predict_top: the largest weight is on the top, then the smallest id.
+    # a subtree is ordered by the smallest id of its keys of that weight, so keys of the same weight
+    # come out by id. a key and a subtree never have the same tie, the subtree doesn't have the key
+    if a.weight != b.weight:
+        return a.weight < b.weight
+    return a.tie > b.tie
+
+cdef vector[int] code_points(unicode s):
+    cdef vector[int] ret
+    cdef Py_UCS4 ch
+    ret.reserve(len(s))
+    for ch in s:
+        ret.push_back(ch)
+    return ret
 
-cdef inline int ignore_case_byte_index_mapping(ignore_case_alignment align, int byte_idx):
-    if align is None:
-        return byte_idx
-    cdef int char_offset = align.lowercase.char_idx_of_byte[byte_idx]
-    char_offset = align.lowercase_char_index_mapping[char_offset]
-    cdef int ret = align.original.char_offsets[char_offset]
+cdef inline long long padded_size(long long size):
+    # sections after the key blob stay aligned in 8 bytes
+    return (size + 7) & ~7
+
+cdef inline long long blob_slot(long long offset, long long size):
+    # offset << 32 | size, offsets up to 4GB use the sign bit
+    return <long long>((<unsigned long long>offset << 32) | <unsigned long long>size)
+
+cdef inline long long slot_offset(long long slot):
+    return <long long>(<unsigned long long>slot >> 32)
+
+cdef void* copy_memory(const void* src, long long size):
+    # a section of a shared image copied into memory the trie owns
+    cdef void* ret = malloc(max(size, 1))
+    memcpy(ret, src, size)
     return ret
 
 
@@ -63,10 +298,10 @@ cdef class Trie(object):
     cdef inline void _node_set_child_num(self, Node *n, int val):
         n.flags = val
 
-    cdef inline int _node_base(self, Node *n):
+    cdef inline int _node_base(self, Node *n) noexcept nogil:
         return -(n.value + 1)
 
-    cdef inline bool _node_is_child(self, Node *n, int par):
+    cdef inline bool _node_is_child(self, Node *n, int par) noexcept nogil:
         return n.check == par
 
     cdef inline byte_t* _node_child_ptr(self, Node *n):
@@ -95,14 +330,41 @@ cdef class Trie(object):
         def __get__(self):
             return self.key_num
 
+    property frozen:
+        def __get__(self):
+            return self.frozen
+
+    property payload_type:
+        def __get__(self):
+            return payload_types[self.payload_kind]
+
+    property has_key_table:
+        def __get__(self):
+            return self.key_slots != NULL
+
     def __len__(self):
         return self.key_num
     
     cdef inline Node* _node(self, int nid):
         return self.array + nid
 
-    def __cinit__(self, bool ignore_case = False, bool ordered = False):
+    def __cinit__(self, bool ignore_case = False, bool ordered = False, payload_type = None):
         cdef int i
+        if payload_type not in payload_types:
+            raise Exception("payload_type should be one of %r" % (payload_types,))
+        self.payload_kind = payload_types.index(payload_type)
+        self.payloads = NULL
+        self.blob = NULL
+        self.blob_size = 0
+        self.blob_capacity = 0
+        self.blob_garbage = 0
+        self.key_slots = NULL
+        self.key_blob = NULL
+        self.key_blob_size = 0
+        self.key_blob_capacity = 0
+        self.node_weights = NULL
+        self.node_ties = NULL
+        self.weights_shared = False
         self.last_remove_leaf = value_limit
         self.ignore_case = ignore_case
         self.ordered = ordered
@@ -115,6 +377,7 @@ cdef class Trie(object):
         self.array_size = self.capacity
         self.blocks = <Block*> malloc((self.capacity >> 8) * sizeof(Block))
         self.max_trial = 1
+        self.frozen = False
         self._node_init(self.array, -1, -1)
         for i in range(1, 256):
             self._node_init(&self.array[i], -(i - 1), -(i + 1))
@@ -128,6 +391,7 @@ cdef class Trie(object):
         self.bheadC = 0
         self.bheadO = 0
         self.buff = NULL
+        self._resize_slots(0)
     
     cdef inline int _get(self, byte_t *key, int key_size, int from_, int start):
         cdef int pos, value, to
@@ -182,6 +446,8 @@ cdef class Trie(object):
     cdef int add_block(self):
         cdef int i
         if self.array_size == self.capacity:
+            if self.capacity >= node_limit:
+                raise OverflowError("a trie can't have more than 2^30 nodes, split the keys with cyac.sharded.ShardedAC")
             self.capacity *= 2
             self.blocks = <Block*> realloc(self.blocks, sizeof(Block) * (self.capacity >> 8))
             self.array = <Node*> realloc(self.array, sizeof(Node) * self.capacity)
@@ -259,7 +525,7 @@ cdef class Trie(object):
         if has_child and keep_order:
             child_ptr = self._node_sibling_ptr(&self.array[base ^ child_ptr[0]])
             while self.ordered and child_ptr[0] != 0 and child_ptr[0] < label:
-                c = self._node_sibling_ptr(&self.array[base ^ child_ptr[0]])
+                child_ptr = self._node_sibling_ptr(&self.array[base ^ child_ptr[0]])
         
         self.array[base^label].sibling = child_ptr[0]
         child_ptr[0] = label
@@ -281,7 +547,7 @@ cdef class Trie(object):
     cdef bool has_label(self, int id_, byte_t label):
         return self.child(id_, label) >= 0
 
-    cdef inline int child(self, int id_, byte_t label):
+    cdef inline int child(self, int id_, byte_t label) noexcept nogil:
         cdef Node *parent_ptr = &self.array[id_]
         cdef int base = self._node_base(&parent_ptr[0])
         cdef int cid = base ^ label
@@ -290,10 +556,11 @@ cdef class Trie(object):
             return -1 
         return cid
 
-    cdef inline int children(self, int id_, byte_t *labels, int *children_arr, int first_n):
+    cdef inline int children(self, int id_, byte_t *labels, int *children_arr, int first_n) noexcept nogil:
         cdef Node *parent_ptr = &self.array[id_]
         cdef int base = self._node_base(&parent_ptr[0])
         cdef byte_t s = parent_ptr[0].child
+        cdef int to
         if s == 0 and base > 0:
             s = self.array[base].sibling
         cdef int num = 0
@@ -407,6 +674,9 @@ cdef class Trie(object):
             child_num = self.set_child(base_p, from_p_ptr[0].child, 255, False, children)
         base = self.find_place() if child_num == 1 else self.find_places(children, child_num)
         base ^= children[0]
+        if self.relocations.size() == 0:
+            self.relocations.resize(257)
+        self.relocations[child_num - 1 if flag else child_num] += 1
         if flag:
             from_ = from_n
             from_ptr = &self.array[from_n]
@@ -460,7 +730,7 @@ cdef class Trie(object):
         else:
             return to_pn
     
-    cdef inline int jump(self, byte_t byte, int from_):
+    cdef inline int jump(self, byte_t byte, int from_) noexcept nogil:
         from_ptr = &self.array[from_]
         if from_ptr[0].value >= 0:
             return -1
@@ -469,7 +739,7 @@ cdef class Trie(object):
             return -1
         return to
 
-    cdef inline int jump_bytes(self, byte_t *bytes_, int byte_num, int from_):
+    cdef inline int jump_bytes(self, byte_t *bytes_, int byte_num, int from_) noexcept nogil:
         cdef int i
         cdef byte_t byte
         for i in range(byte_num):
@@ -508,7 +778,7 @@ cdef class Trie(object):
     cdef bytes key(self, int id_):
         return self.substring(id_, 0)
 
-    cdef inline int value(self, int id_):
+    cdef inline int value(self, int id_) noexcept nogil:
         cdef Node *ptr = &self.array[id_]
         cdef int val = ptr[0].value
         if val >= 0:
@@ -519,7 +789,7 @@ cdef class Trie(object):
             return to_ptr[0].value
         return -1
 
-    cdef inline bool has_value(self, int id_):
+    cdef inline bool has_value(self, int id_) noexcept nogil:
         cdef Node *ptr = &self.array[id_]
         cdef int val = ptr[0].value
         if val >= 0:
@@ -559,9 +829,7 @@ cdef class Trie(object):
             lnode = self.leafs[sid]
             if lnode < 0:
                 raise AttributeError("Cannot find with id: %d" % sid)
-            bs = self.key(lnode)
-            bs = bs.decode("utf8")
-            return bs
+            return self._key_of(sid)
         elif isinstance(sid, unicode):
             ret = self.get(sid)
             if ret < 0:
@@ -569,10 +837,13 @@ cdef class Trie(object):
             return ret
         raise AttributeError("Index type is not supported")
 
-    cpdef int insert(self, unicode key):
+    cpdef int insert(self, unicode key, payload = None):
         """insert key into the trie, return the id of this key.
         Args:
             key : string, Cannot be empty.
+            payload : int | float | bytes | None
+                value kept with the key, the trie should be created with payload_type.
+                if key exists, its payload is replaced.
         Returns:
             id  : int
                 The id is continuously increasing. you can use this id to index other values.
@@ -580,16 +851,35 @@ cdef class Trie(object):
         Examples:
             >>> trie.insert("python")
         """
-        if self.ignore_case:
-            key = key.lower()
-        cdef bytes bkey = key.encode("utf8")
-        cdef int bkey_len = len(bkey)
+        cdef string lowered
+        cdef Py_ssize_t size
+        cdef const char* ckey = key_utf8(key, self.ignore_case, lowered, &size)
+        return self._insert_bytes(<byte_t*>ckey, size, payload)
+
+    cdef int _insert_bytes(self, byte_t* ckey, int bkey_len, payload) except -2:
         if bkey_len == 0:
             return -1
-        cdef byte_t *ckey = bkey
-        val = self.get_bytes(ckey, bkey_len)
+        cdef int val = self.get_bytes(ckey, bkey_len)
+        cdef long long slot = 0
         if val >= 0:
+            if payload is not None:
+                slot = self._encode_payload(payload)
+                self._drop_payload(val)
+                self.payloads[val] = slot
+                self._drop_weights()
             return val
+        if self.frozen:
+            raise Exception("trie is frozen, it can't be changed")
+        self._own()
+        # each byte adds a block at most twice, fail before changing anything
+        if self.array_size > node_limit - <long long>512 * (bkey_len + 1):
+            raise OverflowError("a trie can't have more than 2^30 nodes, split the keys with cyac.sharded.ShardedAC")
+        self._drop_weights()
+        cdef long long key_slot = 0
+        if payload is not None:
+            slot = self._encode_payload(payload)
+        if self.key_slots != NULL:
+            key_slot = self._append_key(ckey, bkey_len)
         cdef int p = self._get(ckey, bkey_len, 0, 0)
         cdef int id_
         if self.last_remove_leaf != value_limit:
@@ -600,13 +890,347 @@ cdef class Trie(object):
             if self.leaf_size == self.key_capacity:
                 self.key_capacity *= 2
                 self.leafs = <int*> realloc(self.leafs, self.key_capacity*sizeof(int))
+                self._resize_slots(self.key_capacity // 2)
             self.leaf_size += 1
         cdef Node *p_ptr = &self.array[p]
         p_ptr[0].value = id_
         self.leafs[id_] = p
+        if self.payload_kind != PAYLOAD_NONE:
+            self.payloads[id_] = slot
+        if self.key_slots != NULL:
+            self.key_slots[id_] = key_slot
         self.key_num += 1
         return id_
 
+    cdef void _resize_slots(self, int old_capacity):
+        # payloads and key slots follow the capacity of leafs, new slots are zero
+        if self.payload_kind != PAYLOAD_NONE:
+            self.payloads = <long long*> realloc(self.payloads, sizeof(long long) * max(self.key_capacity, 1))
+            if self.key_capacity > old_capacity:
+                memset(self.payloads + old_capacity, 0, sizeof(long long) * (self.key_capacity - old_capacity))
+        if self.key_slots != NULL:
+            self.key_slots = <long long*> realloc(self.key_slots, sizeof(long long) * max(self.key_capacity, 1))
+            if self.key_capacity > old_capacity:
+                memset(self.key_slots + old_capacity, 0, sizeof(long long) * (self.key_capacity - old_capacity))
+
+    cdef long long _append_key(self, byte_t* key, int size) except? -1:
+        # utf8 of a new key is appended to key_blob, removed keys are left in it until build_key_table
+        if self.key_blob_size + size > 0xffffffff:
+            raise OverflowError("keys are larger than 4GB")
+        if self.key_blob_size + size > self.key_blob_capacity:
+            self.key_blob_capacity = max(self.key_blob_capacity * 2, self.key_blob_size + size)
+            self.key_blob = <char*> realloc(self.key_blob, self.key_blob_capacity)
+        memcpy(self.key_blob + self.key_blob_size, key, size)
+        cdef long long slot = blob_slot(self.key_blob_size, size)
+        self.key_blob_size += size
+        return slot
+
+    cdef unicode _key_of(self, int id_):
+        cdef long long slot
+        if self.key_slots != NULL:
+            slot = self.key_slots[id_]
+            return PyUnicode_DecodeUTF8(self.key_blob + slot_offset(slot), slot & 0xffffffff, NULL)
+        return self.key(self.leafs[id_]).decode("utf8")
+
+    cdef void _export_keys(self, string& data, vector[long long]& offsets, bool walk=False):
+        # utf8 of all keys ordered by id, offsets has leaf_size + 1 items, removed ids are empty.
+        # keys come from the key table if there is one, unless walk is set
+        cdef vector[long long] starts
+        cdef vector[int] lens
+        cdef vector[int] stack
+        cdef string walked
+        cdef string path
+        cdef byte_t labels[256]
+        cdef int nodes[256]
+        cdef int id_, node, depth, vk, num, i
+        cdef long long slot
+        offsets.resize(self.leaf_size + 1)
+        if self.key_slots != NULL and not walk:
+            for id_ in range(self.leaf_size):
+                offsets[id_] = data.size()
+                if self.leafs[id_] >= 0:
+                    slot = self.key_slots[id_]
+                    data.append(self.key_blob + slot_offset(slot), <size_t>(slot & 0xffffffff))
+            offsets[self.leaf_size] = data.size()
+            return
+        # walk the trie once, keys share their prefixes in path
+        starts.resize(self.leaf_size, 0)
+        lens.resize(self.leaf_size, 0)
+        stack.push_back(0)
+        stack.push_back(0)
+        while stack.size() > 0:
+            depth = stack.back()
+            stack.pop_back()
+            node = stack.back()
+            stack.pop_back()
+            if depth > 0:
+                path.resize(depth)
+                path[depth - 1] = <char>(self._node_base(&self.array[self.array[node].check]) ^ node)
+            vk = self.value(node)
+            if vk >= 0:
+                starts[vk] = walked.size()
+                lens[vk] = depth
+                walked.append(path.data(), <size_t>depth)
+            num = self.children(node, labels, nodes, 256)
+            for i in range(num - 1, -1, -1):
+                stack.push_back(nodes[i])
+                stack.push_back(depth + 1)
+        for id_ in range(self.leaf_size):
+            offsets[id_] = data.size()
+            if self.leafs[id_] >= 0:
+                data.append(walked.data() + starts[id_], <size_t>lens[id_])
+        offsets[self.leaf_size] = data.size()
+
+    cdef long long _encode_payload(self, value) except? -1:
+        # value kept in payloads, bytes are appended to blob
+        cdef long long slot = 0
+        cdef double d
+        cdef bytes data
+        if self.payload_kind == PAYLOAD_NONE:
+            raise Exception("trie has no payloads, create it with payload_type")
+        if self.frozen:
+            raise Exception("trie is frozen, its payloads can't be changed")
+        self._own()
+        if self.payload_kind == PAYLOAD_INT:
+            slot = value
+        elif self.payload_kind == PAYLOAD_FLOAT:
+            d = value
+            memcpy(&slot, &d, sizeof(d))
+        else:
+            data = bytes(memoryview(value))
+            # replaced bytes are dropped before the blob grows, when they are most of it
+            if self.blob_size + len(data) > self.blob_capacity and self.blob_garbage * 2 > self.blob_size \
+                    and self.blob_garbage >= self.leaf_size:
+                self._compact_blob()
+            if self.blob_size + len(data) > 0xffffffff:
+                raise OverflowError("payloads are larger than 4GB")
+            if self.blob_size + len(data) > self.blob_capacity:
+                self.blob_capacity = max(self.blob_capacity * 2, self.blob_size + len(data))
+                self.blob = <char*> realloc(self.blob, self.blob_capacity)
+            memcpy(self.blob + self.blob_size, <char*>data, len(data))
+            slot = blob_slot(self.blob_size, len(data))
+            self.blob_size += len(data)
+        return slot
+
+    cdef void _drop_payload(self, int id_):
+        # the bytes of a replaced or removed payload stay in blob until _compact_blob
+        if self.payload_kind == PAYLOAD_BYTES:
+            self.blob_garbage += self.payloads[id_] & 0xffffffff
+            self.payloads[id_] = 0
+
+    cdef void _compact_blob(self):
+        # copy the payloads of the keys in use into a new blob, in the order of ids
+        cdef long long size = 0
+        cdef long long slot, len_
+        cdef char* blob
+        cdef int id_
+        for id_ in range(self.leaf_size):
+            if self.leafs[id_] >= 0:
+                size += self.payloads[id_] & 0xffffffff
+        blob = <char*> malloc(max(size, 1))
+        size = 0
+        for id_ in range(self.leaf_size):
+            if self.leafs[id_] < 0:
+                self.payloads[id_] = 0
+                continue
+            slot = self.payloads[id_]
+            len_ = slot & 0xffffffff
+            memcpy(blob + size, self.blob + slot_offset(slot), len_)
+            self.payloads[id_] = blob_slot(size, len_)
+            size += len_
+        free(self.blob)
+        self.blob = blob
+        self.blob_size = self.blob_capacity = size
+        self.blob_garbage = 0
+
+    cdef object _payload(self, int id_):
+        cdef long long slot = self.payloads[id_]
+        cdef double d
+        if self.payload_kind == PAYLOAD_INT:
+            return slot
+        if self.payload_kind == PAYLOAD_FLOAT:
+            memcpy(&d, &slot, sizeof(d))
+            return d
+        return self.blob[slot_offset(slot): slot_offset(slot) + (slot & 0xffffffff)]
+
+    def payload(self, int id_):
+        """
+        get the payload of a key by id
+        Args:
+            id_ : int
+        Returns:
+            payload : int | float | bytes
+                0, 0.0 or b"" if it isn't set
+        Raises:
+            AttributeError: If `id_` is invalid
+        """
+        if self.payload_kind == PAYLOAD_NONE:
+            raise Exception("trie has no payloads, create it with payload_type")
+        if id_ < 0 or id_ >= self.leaf_size or self.leafs[id_] < 0:
+            raise AttributeError("Cannot find with id: %d" % id_)
+        return self._payload(id_)
+
+    def set_payload(self, int id_, value):
+        """
+        replace the payload of a key by id.
+        replaced bytes are dropped from the blob when they are more than half of it, and by freeze.
+        Args:
+            id_ : int
+            value : int | float | bytes
+        """
+        if id_ < 0 or id_ >= self.leaf_size or self.leafs[id_] < 0:
+            raise AttributeError("Cannot find with id: %d" % id_)
+        cdef long long slot = self._encode_payload(value)
+        self._drop_payload(id_)
+        self.payloads[id_] = slot
+        self._drop_weights()
+
+    @classmethod
+    def build(cls, keys, bool ignore_case = False, bool ordered = False, bool sorted = False, payload_type = None):
+        """
+        build a trie from keys in one pass. It's much faster than inserting keys one by one,
+        since every node is placed once with all of its children, nothing is relocated.
+        Args:
+            keys : iterable(unicode)
+                any iterable, e.g. a generator reading lines of a file. keys are kept as utf8
+                in a compact buffer until the trie is built, not in a python list.
+            ignore_case : bool
+            ordered : bool
+                see Trie's constructor for details.
+            sorted : bool
+                keys are already sorted (lowercased keys if ignore_case), skip sorting.
+            payload_type : None | "int" | "float" | "bytes"
+                if it's set, keys are tuples of (key, payload). the last payload of a key wins.
+        Returns:
+            trie : Trie
+                ids are the same as inserting keys in the given order
+        Examples:
+            >>> with open("words.txt", encoding="utf8") as fi:
+            >>>     trie = Trie.build((line.rstrip("\\n") for line in fi), sorted=True)
+        """
+        cdef Trie trie = cls(ignore_case, ordered, payload_type)
+        cdef string buf
+        cdef vector[int] offsets
+        cdef vector[int] order
+        cdef vector[KeyRef] sorted_keys
+        cdef vector[pair[int, int]] firsts
+        cdef vector[long long] slots # payload of each key
+        cdef vector[int] groups # index in sorted_keys of each key
+        cdef bytes bkey
+        cdef int n, i, k, a, b, prev
+        cdef long long total = 0
+        cdef bool has_payload = trie.payload_kind != PAYLOAD_NONE
+        offsets.push_back(0)
+        for key in keys:
+            if has_payload:
+                key, payload = key
+            if ignore_case:
+                key = key.lower()
+            bkey = (<unicode?>key).encode("utf8")
+            if len(bkey) == 0:
+                continue
+            total += len(bkey)
+            if total > value_limit:
+                raise OverflowError("keys are larger than 2GB")
+            n = offsets.size() - 1
+            if has_payload:
+                slots.push_back(trie._encode_payload(payload))
+            buf.append(<char*>bkey, len(bkey))
+            offsets.push_back(buf.size())
+            if sorted and n > 0 and compare_keys(buf.c_str(), offsets[n - 1], offsets[n] - offsets[n - 1], offsets[n], offsets[n + 1] - offsets[n]) > 0:
+                raise Exception("keys are not sorted: %r" % key)
+        n = offsets.size() - 1
+        order.resize(n)
+        for i in range(n):
+            order[i] = i
+        if not sorted:
+            with nogil:
+                cyac_sort_keys(buf.c_str(), offsets.data(), order.data(), n)
+        # one entry for each distinct key, ids follow the first occurrence
+        prev = -1
+        groups.resize(n)
+        for i in range(n):
+            a = order[i]
+            if prev >= 0 and compare_keys(buf.c_str(), offsets[prev], offsets[prev + 1] - offsets[prev], offsets[a], offsets[a + 1] - offsets[a]) == 0:
+                groups[a] = sorted_keys.size() - 1
+                continue
+            groups[a] = sorted_keys.size()
+            firsts.push_back(pair[int, int](a, sorted_keys.size()))
+            sorted_keys.push_back(KeyRef(offsets[a], offsets[a + 1] - offsets[a], 0))
+            prev = a
+        if not sorted:
+            sort(firsts.begin(), firsts.end())
+        for k in range(firsts.size()):
+            sorted_keys[firsts[k].second].id_ = k
+        trie._build_sorted(<byte_t*>buf.c_str(), sorted_keys)
+        if has_payload:
+            # the last payload of a key wins, the bytes of the others are garbage
+            for a in range(n):
+                k = sorted_keys[groups[a]].id_
+                trie._drop_payload(k)
+                trie.payloads[k] = slots[a]
+            if trie.blob_garbage * 2 > trie.blob_size:
+                trie._compact_blob()
+        return trie
+
+    cdef void _build_sorted(self, byte_t* buf, vector[KeyRef]& keys):
+        # place all children of a node at once, depth first
+        cdef vector[BuildTask] tasks
+        cdef BuildTask task
+        cdef byte_t children[256]
+        cdef int los[256]
+        cdef int his[256]
+        cdef int child_num, i, j, base, to, key_count
+        cdef byte_t label
+        key_count = keys.size()
+        if key_count > self.key_capacity:
+            i = self.key_capacity
+            self.key_capacity = key_count
+            self.leafs = <int*> realloc(self.leafs, self.key_capacity * sizeof(int))
+            self._resize_slots(i)
+        if key_count > 0:
+            tasks.push_back(BuildTask(0, 0, key_count, 0))
+        while tasks.size() > 0:
+            task = tasks.back()
+            tasks.pop_back()
+            child_num = 0
+            i = task.lo
+            if keys[i].len_ == task.depth:
+                children[0] = 0
+                los[0] = i
+                his[0] = i + 1
+                child_num = 1
+                i += 1
+            while i < task.hi:
+                label = buf[keys[i].start + task.depth]
+                j = i + 1
+                while j < task.hi and buf[keys[j].start + task.depth] == label:
+                    j += 1
+                children[child_num] = label
+                los[child_num] = i
+                his[child_num] = j
+                child_num += 1
+                i = j
+            if task.node == 0:
+                base = 0 # children of root are in the first block
+            else:
+                base = self.find_place() if child_num == 1 else self.find_places(children, child_num)
+                base ^= children[0]
+                self.array[task.node].value = -base - 1
+            for i in range(child_num):
+                to = self.pop_enode(base, children[i], task.node)
+                self.array[to].sibling = children[i + 1] if i + 1 < child_num else 0
+                if children[i] == 0:
+                    self.array[to].value = keys[los[i]].id_
+                    self.leafs[keys[los[i]].id_] = to
+            self.array[task.node].child = children[0]
+            self._node_set_child_num(&self.array[task.node], child_num)
+            for i in range(child_num - 1, -1, -1):
+                if children[i] != 0:
+                    tasks.push_back(BuildTask(base ^ children[i], los[i], his[i], task.depth + 1))
+        self.leaf_size = key_count
+        self.key_num = key_count
+
     cpdef int remove(self, unicode key):
         """
         remove the given key from the trie
@@ -620,12 +1244,14 @@ cdef class Trie(object):
         Examples:
             >>> trie.remove("python")
         """
-        if self.ignore_case:
-            key = key.lower()
+        cdef string lowered
+        cdef Py_ssize_t size
+        cdef const char* ckey = key_utf8(key, self.ignore_case, lowered, &size)
+        return self._remove_bytes(<byte_t*>ckey, size)
+
+    cdef int _remove_bytes(self, byte_t* cbkey, int size) except -2:
         cdef Node *from_ptr
-        cdef bytes bkey = key.encode("utf8")
-        cdef byte_t* cbkey = bkey
-        cdef int to = self.jump_bytes(cbkey, len(bkey), 0)
+        cdef int to = self.jump_bytes(cbkey, size, 0)
         cdef int base, from_
         cdef byte_t label
         if to < 0:
@@ -633,6 +1259,10 @@ cdef class Trie(object):
         cdef int vk = self.value(to)
         if vk < 0:
             return -1
+        if self.frozen:
+            raise Exception("trie is frozen, it can't be changed")
+        self._own()
+        self._drop_weights()
         cdef Node *to_ptr = &self.array[to]
         if to_ptr[0].value < 0:
             base = self._node_base(to_ptr)
@@ -644,13 +1274,15 @@ cdef class Trie(object):
             from_ptr = &self.array[from_]
             base = self._node_base(from_ptr)
             label = (to ^ base)
-            if to_ptr[0].sibling != 0  or  from_ptr[0].child != label:
+            # the root is never released, its last child is unlinked like the others
+            if to_ptr[0].sibling != 0  or  from_ptr[0].child != label or from_ == 0:
                 self.pop_sibling(from_, label)
                 self.push_enode(to)
                 break
             self.push_enode(to)
             to = from_
         self.key_num -= 1
+        self._drop_payload(vk)
         self.leafs[vk] = -self.last_remove_leaf - 1
         self.last_remove_leaf = vk
         return vk
@@ -668,11 +1300,90 @@ cdef class Trie(object):
         Examples:
             >>> trie.get("python")
         """
-        if self.ignore_case:
-            key = key.lower()
-        cdef bytes bkey = key.encode("utf8")
-        cdef byte_t* ckey = bkey
-        return self.get_bytes(ckey, len(bkey))
+        cdef string lowered
+        cdef Py_ssize_t size
+        cdef const char* ckey = key_utf8(key, self.ignore_case, lowered, &size)
+        return self.get_bytes(<byte_t*>ckey, size)
+
+    def insert_many(self, keys, payloads = None):
+        """
+        insert keys into the trie, it's the same as calling insert for each key, but it loops in C.
+        Args:
+            keys : iterable(unicode)
+            payloads : iterable(int | float | bytes | None) | None
+                payload of each key, see insert. Exception is raised if it hasn't as many items as keys,
+                after the keys before the missing payload are inserted if they are iterators
+        Returns:
+            ids : array.array('i')
+                id of each key, -1 for empty keys
+        Examples:
+            >>> ids = trie.insert_many([u"python", u"ruby"])
+        """
+        cdef vector[int] ids
+        cdef string lowered
+        cdef Py_ssize_t size
+        cdef const char* ckey
+        cdef unicode key
+        cdef object missing = object()
+        if payloads is None:
+            for key in keys:
+                ckey = key_utf8(key, self.ignore_case, lowered, &size)
+                ids.push_back(self._insert_bytes(<byte_t*>ckey, size, None))
+            return ids_to_array(ids)
+        if hasattr(keys, "__len__") and hasattr(payloads, "__len__") and len(keys) != len(payloads):
+            raise Exception("keys and payloads have different lengths: %d != %d" % (len(keys), len(payloads)))
+        payloads = iter(payloads)
+        for key in keys:
+            payload = next(payloads, missing)
+            if payload is missing:
+                raise Exception("there are fewer payloads than keys")
+            ckey = key_utf8(key, self.ignore_case, lowered, &size)
+            ids.push_back(self._insert_bytes(<byte_t*>ckey, size, payload))
+        if next(payloads, missing) is not missing:
+            raise Exception("there are more payloads than keys")
+        return ids_to_array(ids)
+
+    def get_many(self, keys):
+        """
+        get id of each key, it's the same as calling get for each key, but it loops in C.
+        Args:
+            keys : iterable(unicode)
+        Returns:
+            ids : array.array('i')
+                id of each key, -1 if it doesn't exist
+        Examples:
+            >>> ids = trie.get_many([u"python", u"ruby"])
+        """
+        cdef vector[int] ids
+        cdef string lowered
+        cdef Py_ssize_t size
+        cdef const char* ckey
+        cdef unicode key
+        for key in keys:
+            ckey = key_utf8(key, self.ignore_case, lowered, &size)
+            ids.push_back(self.get_bytes(<byte_t*>ckey, size))
+        return ids_to_array(ids)
+
+    def remove_many(self, keys):
+        """
+        remove keys from the trie, it's the same as calling remove for each key, but it loops in C.
+        Args:
+            keys : iterable(unicode)
+        Returns:
+            ids : array.array('i')
+                id of each removed key, -1 if it doesn't exist
+        Examples:
+            >>> ids = trie.remove_many([u"python", u"ruby"])
+        """
+        cdef vector[int] ids
+        cdef string lowered
+        cdef Py_ssize_t size
+        cdef const char* ckey
+        cdef unicode key
+        for key in keys:
+            ckey = key_utf8(key, self.ignore_case, lowered, &size)
+            ids.push_back(self._remove_bytes(<byte_t*>ckey, size))
+        return ids_to_array(ids)
 
     cdef inline int get_bytes(self, byte_t* key, int size):
         cdef int to = self.jump_bytes(key, size, 0)
@@ -684,12 +1395,25 @@ cdef class Trie(object):
         return vk
 
 
-    def prefix(self, unicode s not None):
+    cdef void _prefix(self, byte_t *bytes_, int byte_num, vector[Matched]& res) noexcept nogil:
+        cdef int node = 0
+        cdef int bi, vk
+        for bi in range(byte_num):
+            node = self.jump(bytes_[bi], node)
+            if node < 0:
+                break
+            vk = self.value(node)
+            if vk >= 0:
+                res.push_back(Matched(vk, 0, bi + 1))
+
+    def prefix(self, unicode s not None, as_arrays = False):
         """
         return the prefix of given string which is in the trie.
         Args:
             key : string
                 keyword that you want to searh
+            as_arrays : bool
+                return two array.array('i') (ids, end_offsets) instead of an iterator
         Iterates:
             prefixes : tuple(id, end_offset)
                 s[:end_offset] matches id
@@ -697,59 +1421,350 @@ cdef class Trie(object):
             >>> for id_, offset in trie.prefix("python"):
             >>>     print(id_, offset)
         """
-        cdef ignore_case_alignment align = None
         cdef xstring xs = xstring(s)
+        cdef int* mapping = NULL
+        cdef vector[Matched] vect
+        cdef ignore_case_alignment align
         if self.ignore_case:
             align = ignore_case_alignment(xs)
             xs = align.lowercase
-        cdef byte_t b
-        cdef int node = 0
-        cdef int bi
-        for bi in range(xs.byte_num):
-            b = xs.bytes_[bi]
-            node = self.jump(b, node)
-            if node >= 0:
-                vk = self.value(node)
-                if vk >= 0:
-                    yield vk, ignore_case_offset(align, xs, bi) + 1
-            else:
-                break
-
-    def predict(self, unicode s not None):
+            mapping = align.lowercase_char_index_mapping
+        self._prefix(xs.bytes_, xs.byte_num, vect)
+        to_char_offsets(vect, xs.char_idx_of_byte, mapping)
+        if as_arrays:
+            return matched_to_arrays(vect, False)
+        return matched_iter(vect, False)
+
+    def prefix_bytes(self, data, as_arrays = False):
+        """
+        same as prefix, but data is utf8 text in bytes, bytearray, mmap or memoryview. offsets are byte offsets.
+        Examples:
+            >>> for id_, offset in trie.prefix_bytes(b"python"):
+            >>>     print(id_, offset)
+        """
+        cdef xbytes xb = xbytes(data, self.ignore_case)
+        cdef vector[Matched] vect
+        with nogil:
+            self._prefix(xb.bytes_, xb.byte_num, vect)
+            to_byte_offsets(vect, xb)
+        if as_arrays:
+            return matched_to_arrays(vect, False)
+        return matched_iter(vect, False)
+
+    def predict(self, unicode s not None, with_payload = False, limit = None, order = "bfs"):
         """
         return the string in the trie which starts with given string
         Args:
             key : string
                 keyword that you want to searh
+            with_payload : bool
+                iterate (id, payload) instead of id
+            limit : int | None
+                stop after limit keys, None for all of them
+            order : str
+                "bfs", shorter keys go first, keys of the same length are in the order of the trie,
+                see Trie's constructor for ordered. "lex", keys are in lexicographical order of code points.
         Iterates:
             predicts : id
         Examples:
             >>> for id_ in trie.predict("python"):
             >>>     print(id_)
+            >>> list(trie.predict("py", limit=10, order="lex"))
         """
+        if order != "bfs" and order != "lex":
+            raise Exception("order should be bfs or lex")
+        if limit is not None and limit < 0:
+            raise ValueError("limit should be None or at least 0")
         cdef ignore_case_alignment align = None
         cdef xstring xs = xstring(s)
         if self.ignore_case:
             align = ignore_case_alignment(xs)
             xs = align.lowercase
+        cdef Trie payload_trie = payload_source(self, with_payload)
         cdef int node = self.jump_bytes(xs.bytes_, xs.byte_num, 0)
         if node < 0:
             return
-        cdef int cid, vk, idx
+        cdef long long remain = -1 if limit is None else limit
+        if remain == 0:
+            return
+        cdef bool lex = order == "lex"
+        cdef int cid, vk, idx, base, num
         cdef deque[int] q = deque[int]()
         cdef int child_num = 0
         cdef byte_t children[256]
         cdef int children_nodes[256]
         q.push_back(node)
         while q.size() > 0:
-            node = q.front()
-            q.pop_front()
+            if lex:
+                # depth first, a key goes before the keys it prefixes
+                node = q.back()
+                q.pop_back()
+            else:
+                node = q.front()
+                q.pop_front()
             vk = self.value(node)
             if vk >= 0:
-                yield vk
+                yield (vk, payload_trie._payload(vk)) if payload_trie is not None else vk
+                remain -= 1
+                if remain == 0:
+                    return
             num = self.children(node, children, children_nodes, 256)
+            if lex:
+                sort(children, children + num)
+                base = self._node_base(&self.array[node])
+                for idx in range(num - 1, -1, -1):
+                    q.push_back(base ^ children[idx])
+            else:
+                for idx in range(num):
+                    q.push_back(children_nodes[idx])
+
+    def predict_top(self, unicode s not None, int k, with_payload = False):
+        """
+        return the k keys starting with given string which have the largest payloads,
+        ordered by payload from the largest, and keys of the same payload by id.
+        the trie needs int or float payloads. it walks the subtrees with the largest payloads first,
+        and stops after k keys, so it's fast for short prefixes of many keys.
+        the max payload under each node is computed on the first call after the trie is changed,
+        a frozen trie saves them in its image, so a loaded or mapped one doesn't compute them again.
+        Args:
+            s : unicode
+                prefix of keys
+            k : int
+                number of keys, at most
+            with_payload : bool
+                iterate (id, payload) instead of id
+        Iterates:
+            predicts : id
+        Examples:
+            >>> trie = Trie.build([(u"python", 10), (u"perl", 2), (u"php", 5)], payload_type="int")
+            >>> list(trie.predict_top(u"p", 2)) # [0, 2]
+        """
+        if self.payload_kind != PAYLOAD_INT and self.payload_kind != PAYLOAD_FLOAT:
+            raise Exception("predict_top needs int or float payloads, create the trie with payload_type")
+        cdef ignore_case_alignment align = None
+        cdef xstring xs = xstring(s)
+        if self.ignore_case:
+            align = ignore_case_alignment(xs)
+            xs = align.lowercase
+        cdef int node = self.jump_bytes(xs.bytes_, xs.byte_num, 0)
+        if node < 0 or k <= 0:
+            return
+        if self.node_weights == NULL:
+            self._build_weights()
+        cdef vector[WeightedNode] heap
+        cdef WeightedNode top, item
+        cdef byte_t labels[256]
+        cdef int nodes[256]
+        cdef int num, idx, vk
+        item.weight = self.node_weights[node]
+        item.tie = self.node_ties[node]
+        item.node = node
+        item.id_ = -1
+        heap.push_back(item)
+        while heap.size() > 0 and k > 0:
+            if self.node_weights == NULL:
+                raise Exception("trie is changed during predict_top")
+            pop_heap(heap.begin(), heap.end(), weighted_less)
+            top = heap.back()
+            heap.pop_back()
+            if top.id_ >= 0:
+                k -= 1
+                yield (top.id_, self._payload(top.id_)) if with_payload else top.id_
+                continue
+            vk = self.value(top.node)
+            if vk >= 0:
+                item.weight = self._weight(vk)
+                item.tie = vk
+                item.node = top.node
+                item.id_ = vk
+                heap.push_back(item)
+                push_heap(heap.begin(), heap.end(), weighted_less)
+            num = self.children(top.node, labels, nodes, 256)
+            item.id_ = -1
             for idx in range(num):
-                q.push_back(children_nodes[idx])
+                item.weight = self.node_weights[nodes[idx]]
+                item.tie = self.node_ties[nodes[idx]]
+                item.node = nodes[idx]
+                heap.push_back(item)
+                push_heap(heap.begin(), heap.end(), weighted_less)
+
+    cdef inline long long _weight(self, int id_):
+        # payload as an integer with the same order, the bits of negative doubles are reversed
+        cdef long long bits = self.payloads[id_]
+        if self.payload_kind == PAYLOAD_FLOAT:
+            bits ^= (bits >> 63) & 0x7fffffffffffffff
+        return bits
+
+    cdef void _build_weights(self):
+        # walk the trie from the root, then pass the max weight of each node and the smallest id
+        # which has it up to its parent in reverse order
+        cdef vector[int] order
+        cdef vector[int] stack
+        cdef byte_t labels[256]
+        cdef int nodes[256]
+        cdef int node, parent, vk, num, idx
+        cdef long long w
+        cdef long long* weights = <long long*> malloc(sizeof(long long) * max(self.array_size, 1))
+        cdef int* ties = <int*> malloc(sizeof(int) * max(self.array_size, 1))
+        stack.push_back(0)
+        while stack.size() > 0:
+            node = stack.back()
+            stack.pop_back()
+            order.push_back(node)
+            vk = self.value(node)
+            weights[node] = self._weight(vk) if vk >= 0 else LLONG_MIN
+            ties[node] = vk if vk >= 0 else value_limit
+            num = self.children(node, labels, nodes, 256)
+            for idx in range(num):
+                stack.push_back(nodes[idx])
+        for idx in range(<int>order.size() - 1, 0, -1):
+            node = order[idx]
+            w = weights[node]
+            parent = self.array[node].check
+            if w > weights[parent] or (w == weights[parent] and ties[node] < ties[parent]):
+                weights[parent] = w
+                ties[parent] = ties[node]
+        self.node_weights = weights
+        self.node_ties = ties
+
+    cdef inline void _drop_weights(self):
+        if not self.weights_shared:
+            free(self.node_weights)
+            free(self.node_ties)
+        self.node_weights = NULL
+        self.node_ties = NULL
+        self.weights_shared = False
+
+    cdef bool _saves_weights(self):
+        # the weights are kept in the image of a frozen trie, which doesn't change any more
+        return self.frozen and (self.payload_kind == PAYLOAD_INT or self.payload_kind == PAYLOAD_FLOAT)
+
+    def fuzzy(self, unicode word not None, int max_dist = 1):
+        """
+        return the keys which are at most max_dist edits (insert, delete or replace a char) away from word.
+        it walks the trie once with rows of levenshtein distances, and skips a subtree as soon as
+        no key in it can be close enough.
+        Args:
+            word : unicode
+            max_dist : int
+        Iterates:
+            matched : tuple(id, dist)
+                ordered by dist, then by id
+        Examples:
+            >>> trie = Trie.build([u"python", u"pythons", u"typhon"])
+            >>> list(trie.fuzzy(u"pyton", 1)) # [(0, 1)]
+        """
+        if max_dist < 0:
+            raise Exception("max_dist should be >= 0")
+        cdef vector[int] chars = code_points(word.lower() if self.ignore_case else word)
+        cdef vector[int] rows
+        cdef vector[FuzzyHit] hits
+        with nogil:
+            self._fuzzy_walk(0, 0, 0, 0, chars.data(), chars.size(), max_dist, True, NULL, rows, hits)
+        cdef list ret = [(hits[i].dist, hits[i].id_) for i in range(hits.size())]
+        ret.sort()
+        return iter([(id_, dist) for dist, id_ in ret])
+
+    cdef void _fuzzy_walk(self, int node, int depth, int cp, int remain, int* word, int n, int max_dist, bool whole, SepTable* sep, vector[int]& rows, vector[FuzzyHit]& hits) noexcept nogil:
+        # depth is the number of chars from the root, cp is the char ending at node, or its first bits if remain bytes are left.
+        # rows[depth * W + t] is the distance between the key and word[:j], j = depth - max_dist + t.
+        # if whole, keys are compared to word, otherwise to any prefix of word, which mustn't start by skipping chars.
+        # nodes are walked depth first from a stack, the row of a node is kept until all of its children are popped
+        cdef int W = 2 * max_dist + 1
+        cdef int INF = max_dist + 1
+        cdef int t, j, v, low, base, to, vk, best, cur, prev
+        cdef byte_t label
+        cdef byte_t utf8[8]
+        cdef FuzzyHit hit
+        cdef FuzzyTask task
+        cdef vector[FuzzyTask] stack
+        stack.push_back(FuzzyTask(node, depth, cp, remain))
+        while stack.size() > 0:
+            task = stack.back()
+            stack.pop_back()
+            node = task.node
+            depth = task.depth
+            cp = task.cp
+            remain = task.remain
+            cur = depth * W
+            prev = cur - W
+            base = self._node_base(&self.array[node])
+            label = self.array[node].child
+            if label == 0 and base > 0:
+                label = self.array[base].sibling
+            if remain > 0:
+                # the char isn't complete, follow its continuation bytes
+                while label != 0:
+                    to = base ^ label
+                    stack.push_back(FuzzyTask(to, depth, (cp << 6) | (label & 0x3f), remain - 1))
+                    label = self.array[to].sibling
+                continue
+            if <int>rows.size() < cur + W:
+                rows.resize(max(<int>rows.size() * 2, cur + W))
+            low = INF
+            for t in range(W):
+                j = depth - max_dist + t
+                if j < 0 or j > n:
+                    v = INF
+                elif depth == 0:
+                    v = min(j, INF) if whole else (0 if j == 0 else INF)
+                else:
+                    v = INF
+                    if t + 1 < W:
+                        v = rows[prev + t + 1] + 1
+                    if j > 0:
+                        if t > 0:
+                            v = min(v, rows[cur + t - 1] + 1)
+                        v = min(v, rows[prev + t] + (word[j - 1] != cp))
+                    v = min(v, INF)
+                rows[cur + t] = v
+                low = min(low, v)
+            if low > max_dist:
+                continue
+            vk = self.value(node)
+            if vk >= 0 and depth > 0:
+                best = -1
+                if whole:
+                    if 0 <= n - depth + max_dist < W and rows[cur + n - depth + max_dist] <= max_dist:
+                        best = n - depth + max_dist
+                else:
+                    # the closest, then the longest end
+                    for t in range(W - 1, -1, -1):
+                        j = depth - max_dist + t
+                        if j < 1 or j > n or rows[cur + t] > max_dist:
+                            continue
+                        if sep != NULL and j < n and not in_sep(sep, word[j]):
+                            continue
+                        if best < 0 or rows[cur + t] < rows[cur + best]:
+                            best = t
+                if best >= 0:
+                    hit.id_ = vk
+                    hit.dist = rows[cur + best]
+                    hit.end = depth - max_dist + best
+                    hits.push_back(hit)
+            if low == max_dist:
+                # no edit is left, only chars of word at the cells equal to max_dist can follow, jump to them
+                # instead of scanning all children
+                for t in range(W):
+                    j = depth - max_dist + t + 1
+                    if j < 1 or j > n or rows[cur + t] != max_dist or word[j - 1] == 0:
+                        continue
+                    for v in range(t):
+                        if rows[cur + v] == max_dist and depth - max_dist + v + 1 >= 1 and word[depth - max_dist + v] == word[j - 1]:
+                            break
+                    else:
+                        to = self.jump_bytes(utf8, encode_unicode(word[j - 1], utf8) - utf8, node)
+                        if to >= 0:
+                            stack.push_back(FuzzyTask(to, depth + 1, word[j - 1], 0))
+                continue
+            while label != 0:
+                to = base ^ label
+                if label < 0x80:
+                    stack.push_back(FuzzyTask(to, depth + 1, label, 0))
+                else:
+                    remain = utf8_char_len(label) - 1
+                    stack.push_back(FuzzyTask(to, depth + 1, label & (0x3f >> remain), remain))
+                label = self.array[to].sibling
 
     def items(self):
         """
@@ -765,73 +1780,262 @@ cdef class Trie(object):
         for id_ in range(0,self.leaf_size):
             lnode = self.leafs[id_]
             if lnode >= 0:
-                key_ = self.key(lnode)
-                yield key_.decode("utf8"), id_
+                yield self._key_of(id_), id_
+
+    def keys_buffer(self):
+        """
+        export all keys at once, much faster than items for a large trie.
+        Returns:
+            (data, offsets) : (bytes, array.array('q'))
+                utf8 of the keys ordered by id, the key of id is data[offsets[id]:offsets[id + 1]],
+                it's empty if the id is removed. offsets has len(ids) + 1 items.
+        Examples:
+            >>> data, offsets = trie.keys_buffer()
+            >>> data[offsets[id_]:offsets[id_ + 1]].decode("utf8")
+        """
+        cdef string data
+        cdef vector[long long] offsets
+        self._export_keys(data, offsets)
+        cdef array.array arr = array.clone(int64_array_template, offsets.size(), False)
+        if offsets.size() > 0:
+            memcpy(arr.data.as_voidptr, offsets.data(), sizeof(long long) * offsets.size())
+        return <bytes>data, arr
+
+    def build_key_table(self):
+        """
+        keep the utf8 of all keys, so trie[id_] and items don't walk the trie up to the root.
+        the table is kept by insert, and saved with the trie. build it again to drop removed keys from it.
+        Examples:
+            >>> trie.build_key_table()
+            >>> trie[id_]
+        """
+        self._own()
+        cdef string data
+        cdef vector[long long] offsets
+        self._export_keys(data, offsets)
+        if data.size() > 0xffffffff:
+            raise OverflowError("keys are larger than 4GB")
+        self.drop_key_table()
+        self.key_slots = <long long*> malloc(sizeof(long long) * max(self.key_capacity, 1))
+        memset(self.key_slots, 0, sizeof(long long) * max(self.key_capacity, 1))
+        cdef int id_
+        for id_ in range(self.leaf_size):
+            self.key_slots[id_] = blob_slot(offsets[id_], offsets[id_ + 1] - offsets[id_])
+        self.key_blob_size = self.key_blob_capacity = data.size()
+        self.key_blob = <char*> malloc(max(self.key_blob_size, 1))
+        memcpy(self.key_blob, data.data(), self.key_blob_size)
 
+    def drop_key_table(self):
+        """
+        free the key table built by build_key_table
+        """
+        if self.buff == NULL:
+            free(self.key_slots)
+            free(self.key_blob)
+        self.key_slots = NULL
+        self.key_blob = NULL
+        self.key_blob_size = self.key_blob_capacity = 0
+
+
+    cdef void _own(self) except *:
+        # data in an external buffer is read only, copy it before changing the trie
+        if self.buff == NULL:
+            return
+        self.array = <Node*>copy_memory(self.array, sizeof(Node) * self.capacity)
+        if not self.frozen:
+            self.blocks = <Block*>copy_memory(self.blocks, sizeof(Block) * (self.capacity >> 8))
+        self.leafs = <int*>copy_memory(self.leafs, sizeof(int) * self.key_capacity)
+        if self.payload_kind != PAYLOAD_NONE:
+            self.payloads = <long long*>copy_memory(self.payloads, sizeof(long long) * self.key_capacity)
+            self.blob = <char*>copy_memory(self.blob, self.blob_size)
+        if self.key_slots != NULL:
+            self.key_slots = <long long*>copy_memory(self.key_slots, sizeof(long long) * self.key_capacity)
+            self.key_blob = <char*>copy_memory(self.key_blob, self.key_blob_size)
+        if self.weights_shared:
+            self.node_weights = <long long*>copy_memory(self.node_weights, sizeof(long long) * self.array_size)
+            self.node_ties = <int*>copy_memory(self.node_ties, sizeof(int) * self.array_size)
+            self.weights_shared = False
+        PyBuffer_Release(self.buff)
+        free(self.buff)
+        self.buff = NULL
 
     def __dealloc__(self):
         if self.buff == NULL:
             free(self.leafs)
             free(self.array)
             free(self.blocks)
+            free(self.payloads)
+            free(self.blob)
+            free(self.key_slots)
+            free(self.key_blob)
         else:
             PyBuffer_Release(self.buff)
             free(self.buff)
+        self._drop_weights()
     
-    def match_longest(self, unicode s not None, sep = None):
-        """
-        extract trie's keys from given string. only return the longest.
-        Args:
-            s : unicode
-            sep : set(int) | None
-                If you specify seperators. e.g. set([ord(' ')]), 
-                it only matches strings tween seperators.
-        Iterates:
-            matched: tuple(id, start_offset, end_offset)
-        Examples:
-            >>> for id_, start_offset, end_offset in trie.match_longest("python", set([ord(" ")])):
-            >>>     print(id_, start_offset, end_offset)
-        """
-        cdef ignore_case_alignment align = None
-        cdef xstring xs = xstring(s)
-        if self.ignore_case:
-            align = ignore_case_alignment(xs)
-            xs = align.lowercase
+    cdef int _match_leftmost(self, byte_t *bytes_, int byte_num, SepTable* sep, bool longest, int max_steps, vector[Matched]& res) noexcept nogil:
+        # walk from each candidate start, keep the longest match, or the one with the smallest id.
+        # if max_steps > 0, stop when walks take more than max_steps bytes per scanned byte.
+        # returns the offset where it stops
         cdef int offset = 0 # byte offset
         cdef int node = 0
-        cdef int bi
+        cdef int bi, vk
         cdef int last_vk
         cdef int last_b
-        while offset < xs.byte_num:
+        cdef long long steps = 0
+        while offset < byte_num:
+            if max_steps > 0 and steps > <long long>max_steps * offset + 4096:
+                return offset
             last_vk = -1
             last_b = 0
-            if sep is not None:
-                while offset < xs.byte_num and xs.chars[xs.char_idx_of_byte[offset]] in sep:
-                    offset += xs.char_byte_num(xs.char_idx_of_byte[offset])
-                if offset >= xs.byte_num:
+            if sep != NULL:
+                while offset < byte_num and in_sep(sep, char_at_byte(bytes_, offset, byte_num)):
+                    offset += utf8_char_len(bytes_[offset])
+                if offset >= byte_num:
                     break
             node = 0
-            for bi in range(offset, xs.byte_num):
-                b = xs.bytes_[bi]
-                node = self.jump(b, node)
+            bi = offset
+            for bi in range(offset, byte_num):
+                node = self.jump(bytes_[bi], node)
                 if node >= 0:
                     vk = self.value(node)
                     if vk >= 0:
-                        if sep is not None:
-                            if bi + 1 < xs.byte_num and xs.chars[xs.char_idx_of_byte[bi+1]] not in sep:
+                        if sep != NULL:
+                            if bi + 1 < byte_num and not in_sep(sep, char_at_byte(bytes_, bi + 1, byte_num)):
                                 continue
-                        last_vk = vk
-                        last_b = bi
+                        if longest or last_vk == -1 or vk < last_vk:
+                            last_vk = vk
+                            last_b = bi
                 else:
                     break
+            steps += bi - offset + 1
             if last_vk == -1:
-                offset += xs.char_byte_num(xs.char_idx_of_byte[offset])
-                if sep is not None:
-                    while offset < xs.byte_num and xs.chars[xs.char_idx_of_byte[offset]] not in sep:
-                        offset += xs.char_byte_num(xs.char_idx_of_byte[offset])
+                offset += utf8_char_len(bytes_[offset])
+                if sep != NULL:
+                    while offset < byte_num and not in_sep(sep, char_at_byte(bytes_, offset, byte_num)):
+                        offset += utf8_char_len(bytes_[offset])
                 continue
-            yield last_vk, ignore_case_offset(align, xs, offset), ignore_case_offset(align, xs, last_b) + 1
+            res.push_back(Matched(last_vk, offset, last_b + 1))
             offset = last_b + 1
+        return byte_num
+
+    def match_longest(self, unicode s not None, sep = None, as_arrays = False, with_payload = False):
+        """
+        extract trie's keys from given string. only return the longest.
+        Args:
+            s : unicode
+            sep : Separators | set(int) | None
+                If you specify seperators. e.g. set([ord(' ')]), 
+                it only matches strings tween seperators.
+            as_arrays : bool
+                return three array.array('i') (ids, start_offsets, end_offsets) instead of an iterator
+            with_payload : bool
+                append the payload of each key to the results, it's one more array if as_arrays
+        Iterates:
+            matched: tuple(id, start_offset, end_offset)
+        Examples:
+            >>> for id_, start_offset, end_offset in trie.match_longest("python", set([ord(" ")])):
+            >>>     print(id_, start_offset, end_offset)
+        """
+        cdef xstring xs = xstring(s)
+        cdef int* mapping = NULL
+        cdef vector[Matched] vect
+        cdef Separators seps = as_separators(sep)
+        cdef SepTable* sep_ptr = sep_table(seps)
+        cdef ignore_case_alignment align
+        if self.ignore_case:
+            align = ignore_case_alignment(xs)
+            xs = align.lowercase
+            mapping = align.lowercase_char_index_mapping
+        with nogil:
+            self._match_leftmost(xs.bytes_, xs.byte_num, sep_ptr, True, 0, vect)
+            to_char_offsets(vect, xs.char_idx_of_byte, mapping)
+        if as_arrays:
+            return matched_to_arrays(vect, True, payload_source(self, with_payload))
+        return matched_iter(vect, True, payload_source(self, with_payload))
+
+    def match_longest_bytes(self, data, sep = None, as_arrays = False, with_payload = False):
+        """
+        same as match_longest, but data is utf8 text in bytes, bytearray, mmap or memoryview. offsets are byte offsets.
+        Examples:
+            >>> for id_, start_offset, end_offset in trie.match_longest_bytes(b"python", set([ord(" ")])):
+            >>>     print(id_, start_offset, end_offset)
+        """
+        cdef xbytes xb = xbytes(data, self.ignore_case)
+        cdef vector[Matched] vect
+        cdef Separators seps = as_separators(sep)
+        cdef SepTable* sep_ptr = sep_table(seps)
+        with nogil:
+            self._match_leftmost(xb.bytes_, xb.byte_num, sep_ptr, True, 0, vect)
+            to_byte_offsets(vect, xb)
+        if as_arrays:
+            return matched_to_arrays(vect, True, payload_source(self, with_payload))
+        return matched_iter(vect, True, payload_source(self, with_payload))
+
+    def match_longest_fuzzy(self, unicode s not None, int max_dist = 1, sep = None):
+        """
+        extract trie's keys from given string, allowing at most max_dist edits (insert, delete or replace a char)
+        in each match. from the leftmost start, the match with the smallest distance is returned,
+        then the longest one, then the one with the smallest id.
+        Args:
+            s : unicode
+            max_dist : int
+            sep : Separators | set(int) | None
+                If you specify seperators. e.g. set([ord(' ')]),
+                it only matches strings tween seperators.
+        Iterates:
+            matched: tuple(id, start_offset, end_offset, dist)
+        Examples:
+            >>> trie = Trie.build([u"python", u"ruby"])
+            >>> list(trie.match_longest_fuzzy(u"pyton and rubby", 1, Separators.word_boundaries()))
+            >>> # [(0, 0, 5, 1), (1, 10, 15, 1)]
+        """
+        if max_dist < 0:
+            raise Exception("max_dist should be >= 0")
+        cdef vector[int] chars
+        cdef unicode lowered
+        if self.ignore_case:
+            # offsets are of s, so chars are lowered one by one if it changes the length
+            lowered = s.lower()
+            if len(lowered) == len(s):
+                chars = code_points(lowered)
+            else:
+                chars = code_points(u"".join([c.lower() if len(c.lower()) == 1 else c for c in s]))
+        else:
+            chars = code_points(s)
+        cdef Separators seps = as_separators(sep)
+        cdef SepTable* sep_ptr = sep_table(seps)
+        cdef vector[int] rows
+        cdef vector[FuzzyHit] hits
+        cdef vector[Matched] vect
+        cdef vector[int] dists
+        cdef Matched m
+        cdef int n = chars.size()
+        cdef int i = 0
+        cdef int best
+        cdef size_t h
+        with nogil:
+            while i < n:
+                if sep_ptr != NULL and i > 0 and not in_sep(sep_ptr, chars[i - 1]):
+                    i += 1
+                    continue
+                hits.clear()
+                self._fuzzy_walk(0, 0, 0, 0, chars.data() + i, n - i, max_dist, False, sep_ptr, rows, hits)
+                best = -1
+                for h in range(hits.size()):
+                    if best < 0 or hits[h].dist < hits[best].dist or (hits[h].dist == hits[best].dist and
+                            (hits[h].end > hits[best].end or (hits[h].end == hits[best].end and hits[h].id_ < hits[best].id_))):
+                        best = h
+                if best < 0:
+                    i += 1
+                    continue
+                m.val = hits[best].id_
+                m.start = i
+                m.end = i + hits[best].end
+                vect.push_back(m)
+                dists.push_back(hits[best].dist)
+                i = m.end
+        return iter([(vect[h].val, vect[h].start, vect[h].end, dists[h]) for h in range(vect.size())])
 
     def replace_longest(self, unicode s not None, callback not None, sep = None):
         """
@@ -839,7 +2043,7 @@ cdef class Trie(object):
         Args:
             s : unicode
             callback : lambda | list | dict
-            sep : set(int) | None
+            sep : Separators | set(int) | None
                 If you specify seperators. e.g. set([ord(' ')]), 
                 it only matches strings tween seperators.
         Returns:
@@ -864,14 +2068,16 @@ cdef class Trie(object):
         cdef byte_t *byte_code
         cdef bytes encoded_replaced
         cdef int char_byte_num
+        cdef Separators seps = as_separators(sep)
+        cdef SepTable* sep_ptr = sep_table(seps)
         cdef bool callback_list_or_dict = isinstance(callback, dict) or isinstance(callback, list)
 
         while offset < xs.byte_num:
             last_vk = -1
             last_b = 0
-            if sep is not None:
+            if sep_ptr != NULL:
                 prev_offset = offset
-                while offset < xs.byte_num and xs.chars[xs.char_idx_of_byte[offset]] in sep:
+                while offset < xs.byte_num and in_sep(sep_ptr, xs.chars[xs.char_idx_of_byte[offset]]):
                     offset += xs.char_byte_num(xs.char_idx_of_byte[offset])
                 if offset > prev_offset:
                     prev_offset2 = ignore_case_byte_index_mapping(align, prev_offset)
@@ -886,8 +2092,8 @@ cdef class Trie(object):
                 if node >= 0:
                     vk = self.value(node)
                     if vk >= 0:
-                        if sep is not None:
-                            if bi + 1 < xs.byte_num and xs.chars[xs.char_idx_of_byte[bi + 1]] not in sep:
+                        if sep_ptr != NULL:
+                            if bi + 1 < xs.byte_num and not in_sep(sep_ptr, xs.chars[xs.char_idx_of_byte[bi + 1]]):
                                 continue
                         last_vk = vk
                         last_b = bi
@@ -896,8 +2102,8 @@ cdef class Trie(object):
             if last_vk == -1:
                 prev_offset = offset
                 offset += xs.char_byte_num(xs.char_idx_of_byte[offset])
-                if sep is not None:
-                    while offset < xs.byte_num and xs.chars[xs.char_idx_of_byte[offset]] not in sep:
+                if sep_ptr != NULL:
+                    while offset < xs.byte_num and not in_sep(sep_ptr, xs.chars[xs.char_idx_of_byte[offset]]):
                         offset += xs.char_byte_num(xs.char_idx_of_byte[offset])
                 prev_offset2 = ignore_case_byte_index_mapping(align, prev_offset)
                 offset2 = ignore_case_byte_index_mapping(align, offset)
@@ -919,6 +2125,119 @@ cdef class Trie(object):
             offset = last_b + 1
         return sb.to_string().decode("utf8")
 
+    def match_longest_column(self, data, offsets, sep = None):
+        """
+        match_longest_bytes of each row of a column, in one call.
+        Args:
+            data : bytes-like object
+                utf8 text of all rows
+            offsets : array of int32 or int64, e.g. array.array('i'), array.array('q') or a numpy array
+                row i is data[offsets[i]:offsets[i + 1]], as in arrow string arrays
+            sep : Separators | set(int) | None
+        Returns:
+            (rows, ids, starts, ends) : tuple(array.array('i'))
+                starts and ends are byte offsets in the row
+        Examples:
+            >>> col = pyarrow.array([u"python", u"ruby"])
+            >>> _, offsets, data = col.buffers()
+            >>> rows, ids, starts, ends = trie.match_longest_column(data, memoryview(offsets).cast("i"))
+        """
+        cdef xcolumn col = xcolumn(data, offsets)
+        cdef vector[Matched] vect
+        cdef vector[Matched] res
+        cdef vector[int] rows
+        cdef Separators seps = as_separators(sep)
+        cdef SepTable* sep_ptr = sep_table(seps)
+        cdef xbytes xb
+        cdef int row
+        if self.ignore_case:
+            # rows are lowercased one by one
+            for row in range(col.rows):
+                xb = col.row_bytes(row, True)
+                vect.clear()
+                self._match_leftmost(xb.bytes_, xb.byte_num, sep_ptr, True, 0, vect)
+                to_byte_offsets(vect, xb)
+                add_row_hits(rows, res, vect, row)
+        else:
+            with nogil:
+                for row in range(col.rows):
+                    vect.clear()
+                    self._match_leftmost(col.row(row), col.row_len(row), sep_ptr, True, 0, vect)
+                    add_row_hits(rows, res, vect, row)
+        return column_arrays(rows, res)
+
+    def replace_longest_column(self, data, offsets, callback not None, sep = None):
+        """
+        replace_longest of each row of a column, in one call.
+        Args:
+            data : bytes-like object
+            offsets : array of int32 or int64
+                see match_longest_column
+            callback : lambda | list | dict
+                lambda gets (id, start_offset, end_offset), offsets are byte offsets in the row
+            sep : Separators | set(int) | None
+        Returns:
+            (data, offsets) : tuple(bytes, array.array)
+                the replaced column, offsets are array.array('i') for int32 offsets, array.array('q') for int64
+        Examples:
+            >>> data, offsets = trie.replace_longest_column(data, offsets, {python_id: u"snake"})
+        """
+        cdef xcolumn col = xcolumn(data, offsets)
+        cdef vector[Matched] vect
+        cdef Separators seps = as_separators(sep)
+        cdef SepTable* sep_ptr = sep_table(seps)
+        cdef bool callback_list_or_dict = isinstance(callback, dict) or isinstance(callback, list)
+        cdef stringbuf sb
+        cdef xbytes xb
+        cdef byte_t* row_bytes
+        cdef int row, row_len, last
+        cdef size_t k
+        cdef long long size = 0
+        cdef bytes encoded_replaced
+        cdef array.array ret_offsets = array.clone(int_array_template if col.width == 4 else int64_array_template, col.rows + 1, False)
+        if col.width == 4:
+            ret_offsets.data.as_ints[0] = 0
+        else:
+            (<long long*>ret_offsets.data.as_voidptr)[0] = 0
+        for row in range(col.rows):
+            row_bytes = col.row(row)
+            row_len = col.row_len(row)
+            vect.clear()
+            if self.ignore_case:
+                xb = col.row_bytes(row, True)
+                self._match_leftmost(xb.bytes_, xb.byte_num, sep_ptr, True, 0, vect)
+                to_byte_offsets(vect, xb)
+            else:
+                self._match_leftmost(row_bytes, row_len, sep_ptr, True, 0, vect)
+            last = 0
+            for k in range(vect.size()):
+                # lowercasing may split a char, so a match can start in the last char of the previous one
+                if vect[k].start > last:
+                    sb.write(<char*>row_bytes + last, vect[k].start - last)
+                    size += vect[k].start - last
+                if callback_list_or_dict:
+                    replaced_ = callback[vect[k].val]
+                else:
+                    replaced_ = callback(vect[k].val, vect[k].start, vect[k].end)
+                if isinstance(replaced_, unicode):
+                    encoded_replaced = replaced_.encode("utf8")
+                elif isinstance(replaced_, bytes):
+                    encoded_replaced = replaced_
+                else:
+                    raise Exception("Replaced result should be bytes or unicode")
+                sb.write(<char*>encoded_replaced, len(encoded_replaced))
+                size += len(encoded_replaced)
+                last = vect[k].end
+            sb.write(<char*>row_bytes + last, row_len - last)
+            size += row_len - last
+            if col.width == 4:
+                if size > value_limit:
+                    raise OverflowError("replaced column is larger than 2GB, use int64 offsets")
+                ret_offsets.data.as_ints[row + 1] = <int>size
+            else:
+                (<long long*>ret_offsets.data.as_voidptr)[row + 1] = size
+        return sb.to_string(), ret_offsets
+
     def _dump_array(self, fname):
         """
         Used for debug
@@ -933,6 +2252,14 @@ cdef class Trie(object):
     def __reduce__(self):
         return (new_object, (Trie,), self.__getstate__())
 
+    def __reduce_ex__(self, protocol):
+        # with protocol 5, the image is one PickleBuffer, which can be passed out of band
+        if protocol < 5 or PickleBuffer is None:
+            return self.__reduce__()
+        cdef bytearray image = bytearray(self.buff_size())
+        self.to_buff(image)
+        return (from_image, (Trie, PickleBuffer(image)))
+
     def __getstate__(self):
         return (self.key_num, self.key_capacity, 
             self.bheadF, self.bheadC, self.bheadO, 
@@ -942,14 +2269,24 @@ cdef class Trie(object):
             array_to_bytes(<char*>self.blocks, (self.array_size >> 8) * sizeof(Block)),
             array_to_bytes(<char*>self.leafs, self.leaf_size * sizeof(int)),
             array_to_bytes(<char*>self.reject, 257 * sizeof(int))
-        )
+        ) + ((self.frozen, self.payload_kind,
+            array_to_bytes(<char*>self.payloads, self.leaf_size * sizeof(long long)),
+            array_to_bytes(self.blob, self.blob_size)) if self.frozen or self.payload_kind != PAYLOAD_NONE or self.key_slots != NULL else ()
+        ) + ((array_to_bytes(<char*>self.key_slots, self.leaf_size * sizeof(long long)),
+            array_to_bytes(self.key_blob, self.key_blob_size)) if self.key_slots != NULL else ())
     
     def __setstate__(self, data):
         self.key_num, self.key_capacity, \
         self.bheadF, self.bheadC, self.bheadO, \
         self.array_size, self.capacity, self.ordered, self.ignore_case, \
         self.max_trial, self.leaf_size, \
-        array, blocks, leafs, reject = data
+        array, blocks, leafs, reject = data[:15]
+        payloads, blob = b"", b""
+        key_slots, key_blob = None, b""
+        if len(data) > 15:
+            self.frozen, self.payload_kind, payloads, blob = data[15:19]
+        if len(data) > 19:
+            key_slots, key_blob = data[19:21]
         if self.array != NULL:
             free(self.array)
         if self.blocks != NULL:
@@ -957,17 +2294,45 @@ cdef class Trie(object):
         if self.leafs != NULL:
             free(self.leafs)
         self.array = <Node*> bytes_to_array(array, (self.capacity * sizeof(Node)))
-        self.blocks = <Block*> bytes_to_array(blocks, (self.capacity >> 8) * sizeof(Block))
+        self.blocks = NULL
+        if not self.frozen:
+            self.blocks = <Block*> bytes_to_array(blocks, (self.capacity >> 8) * sizeof(Block))
         self.leafs = <int*> bytes_to_array(leafs, self.key_capacity * sizeof(int))
+        free(self.payloads)
+        free(self.blob)
+        self.payloads = NULL
+        self.blob = NULL
+        if self.payload_kind != PAYLOAD_NONE:
+            self.payloads = <long long*> bytes_to_array(payloads, max(self.key_capacity, 1) * sizeof(long long))
+            self.blob = <char*> bytes_to_array(blob, max(len(blob), 1))
+        self.blob_size = self.blob_capacity = len(blob)
+        free(self.key_slots)
+        free(self.key_blob)
+        self.key_slots = NULL
+        self.key_blob = NULL
+        if key_slots is not None:
+            self.key_slots = <long long*> bytes_to_array(key_slots, max(self.key_capacity, 1) * sizeof(long long))
+            self.key_blob = <char*> bytes_to_array(key_blob, max(len(key_blob), 1))
+        self.key_blob_size = self.key_blob_capacity = len(key_blob)
+        self._drop_weights()
         cdef int i
         for i in range(257):
             self.reject[i] = reject[i]
 
     cdef write(self, FILE* ptr_fw):
-        cdef uint32_t magic = magic_number
+        if self._saves_weights() and self.node_weights == NULL:
+            self._build_weights()
+        cdef int flags = self._flags()
+        cdef uint32_t magic = extended_magic_number if flags != 0 else magic_number
         fwrite(<void*>&magic, sizeof(magic), 1, ptr_fw)
-        cdef int size = self.buff_size()
-        fwrite(&size, sizeof(int), 1, ptr_fw)
+        if flags != 0:
+            fwrite(&flags, sizeof(int), 1, ptr_fw)
+        cdef long long size = self.buff_size()
+        cdef int small_size = <int>size
+        if flags & FLAG_LARGE:
+            fwrite(&size, sizeof(long long), 1, ptr_fw)
+        else:
+            fwrite(&small_size, sizeof(int), 1, ptr_fw)
         fwrite(<void*>&self.key_num, sizeof(int), 1, ptr_fw)
         fwrite(<void*>&self.key_capacity, sizeof(int), 1, ptr_fw)
         fwrite(<void*>&self.bheadF, sizeof(int), 1, ptr_fw)
@@ -984,22 +2349,297 @@ cdef class Trie(object):
         fwrite(<void*>&self.leaf_size, sizeof(int), 1, ptr_fw)
         
         fwrite(<void*>self.array, sizeof(Node), self.capacity, ptr_fw)
-        fwrite(<void*>self.blocks, sizeof(Block), self.capacity >> 8, ptr_fw)
+        if not self.frozen:
+            fwrite(<void*>self.blocks, sizeof(Block), self.capacity >> 8, ptr_fw)
         fwrite(<void*>self.leafs, sizeof(int), self.key_capacity, ptr_fw)
-        fwrite(<void*>&self.reject, sizeof(int), 257, ptr_fw)
+        if not self.frozen:
+            fwrite(<void*>&self.reject, sizeof(int), 257, ptr_fw)
+        cdef long long zero = 0
+        if self.key_slots != NULL:
+            fwrite(<void*>self.key_slots, sizeof(long long), self.key_capacity, ptr_fw)
+            fwrite(<void*>&self.key_blob_size, sizeof(long long), 1, ptr_fw)
+            fwrite(<void*>self.key_blob, 1, self.key_blob_size, ptr_fw)
+            fwrite(<void*>&zero, 1, padded_size(self.key_blob_size) - self.key_blob_size, ptr_fw)
+        if self._saves_weights():
+            fwrite(<void*>self.node_weights, sizeof(long long), self.array_size, ptr_fw)
+            fwrite(<void*>self.node_ties, sizeof(int), self.array_size, ptr_fw)
+        if self.payload_kind != PAYLOAD_NONE:
+            fwrite(<void*>self.payloads, sizeof(long long), self.key_capacity, ptr_fw)
+            fwrite(<void*>&self.blob_size, sizeof(long long), 1, ptr_fw)
+            fwrite(<void*>self.blob, 1, self.blob_size, ptr_fw)
+
+    cdef int _flags(self):
+        # written after the magic number, the image is the same as before if they are 0
+        cdef int flags = (FLAG_FROZEN if self.frozen else 0) | (FLAG_KEY_TABLE if self.key_slots != NULL else 0) | (self.payload_kind << 8)
+        if self._saves_weights():
+            flags |= FLAG_WEIGHTS
+        # with the flags word and an int size
+        if self._image_size() + sizeof(int) * 2 > value_limit:
+            flags |= FLAG_LARGE
+        return flags
 
     def buff_size(self):
         """
         return the memory size of buffer needed for exporting to external buffer.
         """
-        return sizeof(uint32_t) +  sizeof(int) + sizeof(self.key_num) + sizeof(self.key_capacity) + sizeof(self.bheadF) + sizeof(self.bheadC) + sizeof(self.bheadO) + \
+        cdef long long size = self._image_size()
+        cdef int flags = self._flags()
+        if flags != 0:
+            size += sizeof(int)
+        size += sizeof(long long) if flags & FLAG_LARGE else sizeof(int)
+        return size
+
+    cdef long long _image_size(self):
+        # bytes of the image except the flags word and the size
+        cdef long long size = sizeof(uint32_t) + sizeof(self.key_num) + sizeof(self.key_capacity) + sizeof(self.bheadF) + sizeof(self.bheadC) + sizeof(self.bheadO) + \
             sizeof(self.array_size) + sizeof(self.capacity) + sizeof(int) + sizeof(int) + sizeof(self.max_trial) + sizeof(self.leaf_size) + \
-            sizeof(Node) * self.capacity + sizeof(Block) * (self.capacity >> 8) + sizeof(int) * self.key_capacity + sizeof(int) * 257
+            sizeof(Node) * self.capacity + sizeof(int) * self.key_capacity
+        if not self.frozen:
+            size += sizeof(Block) * (self.capacity >> 8) + sizeof(int) * 257
+        if self.key_slots != NULL:
+            size += sizeof(long long) * self.key_capacity + sizeof(long long) + padded_size(self.key_blob_size)
+        if self._saves_weights():
+            size += (sizeof(long long) + sizeof(int)) * self.array_size
+        if self.payload_kind != PAYLOAD_NONE:
+            size += sizeof(long long) * self.key_capacity + sizeof(long long) + self.blob_size
+        return size
+
+    def freeze(self):
+        """
+        make the trie read only and drop what is only needed for changing it:
+        the spare capacity, the free lists of blocks, and the bytes of replaced payloads.
+        save, to_buff and pickle write the smallest image after it, from_buff loads it as usual.
+        insert and remove of new keys raise Exception.
+        Examples:
+            >>> trie.freeze()
+            >>> trie.save("trie.bin")
+        """
+        if self.frozen:
+            return
+        if self.buff == NULL:
+            self.array = <Node*> realloc(self.array, sizeof(Node) * self.array_size)
+            if self.leaf_size > 0:
+                self.leafs = <int*> realloc(self.leafs, sizeof(int) * self.leaf_size)
+                if self.payload_kind != PAYLOAD_NONE:
+                    self.payloads = <long long*> realloc(self.payloads, sizeof(long long) * self.leaf_size)
+                if self.key_slots != NULL:
+                    self.key_slots = <long long*> realloc(self.key_slots, sizeof(long long) * self.leaf_size)
+            if self.payload_kind == PAYLOAD_BYTES:
+                self._compact_blob()
+            if self.key_blob_size > 0:
+                self.key_blob = <char*> realloc(self.key_blob, self.key_blob_size)
+                self.key_blob_capacity = self.key_blob_size
+            free(self.blocks)
+        self.blocks = NULL
+        self.capacity = self.array_size
+        self.key_capacity = self.leaf_size
+        self.bheadF = self.bheadC = self.bheadO = 0
+        self.frozen = True
 
 
-    def save(self, fname):
+    def stats(self):
+        """
+        counters of the double array, to see how keys are laid out and where memory goes.
+        Returns:
+            stats : dict
+                keys, ids, key_capacity : keys, ids including the removed ones, and allocated ids
+                nodes, array_size, capacity : nodes in use, nodes in the array and allocated nodes
+                fill : nodes / array_size
+                blocks : blocks of 256 nodes, and how many of them are on the full, closed and open lists
+                relocations : relocations[n] is the number of times n nodes were moved to make room
+                    for a new child since the trie was created or loaded, build moves none
+                memory : bytes of each array, and of the image written by save and to_buff.
+                    payload_garbage is the bytes of replaced payloads in the blob, dropped when they are most of it
+        Examples:
+            >>> trie.stats()["fill"]
+        """
+        cdef int i
+        cdef int nodes = 1 # the root
+        for i in range(1, self.array_size):
+            if self.array[i].check >= 0:
+                nodes += 1
+        blocks = {"total": self.array_size >> 8, "full": 0, "closed": 0, "open": 0}
+        if self.blocks != NULL:
+            blocks["full"] = self._block_list_size(self.bheadF)
+            blocks["closed"] = self._block_list_size(self.bheadC)
+            blocks["open"] = self._block_list_size(self.bheadO)
+        relocations = [x for x in self.relocations]
+        while relocations and relocations[-1] == 0:
+            relocations.pop()
+        memory = {
+            "array": sizeof(Node) * self.capacity,
+            "blocks": sizeof(Block) * (self.capacity >> 8) if self.blocks != NULL else 0,
+            "leafs": sizeof(int) * self.key_capacity,
+            "payloads": sizeof(long long) * self.key_capacity + self.blob_capacity if self.payload_kind != PAYLOAD_NONE else 0,
+            "payload_garbage": self.blob_garbage,
+            "key_table": sizeof(long long) * self.key_capacity + self.key_blob_capacity if self.key_slots != NULL else 0,
+            "node_weights": (sizeof(long long) + sizeof(int)) * self.array_size if self.node_weights != NULL else 0,
+            "image": self.buff_size(),
+        }
+        return {
+            "keys": self.key_num,
+            "ids": self.leaf_size,
+            "key_capacity": self.key_capacity,
+            "nodes": nodes,
+            "array_size": self.array_size,
+            "capacity": self.capacity,
+            "fill": nodes / max(self.array_size, 1),
+            "frozen": self.frozen,
+            "shared": self.buff != NULL,
+            "blocks": blocks,
+            "relocations": relocations,
+            "memory": memory,
+        }
+
+    cdef int _block_list_size(self, int head):
+        # blocks on the circular list starting from head, 0 is an empty list
+        if head == 0:
+            return 0
+        cdef int num = 0
+        cdef int bi = head
+        while True:
+            num += 1
+            bi = self.blocks[bi].next_
+            if bi == head or num > (self.capacity >> 8):
+                return num
+
+    cdef int _verify(self, vector[int]& depths) except -1:
+        # check every link which is followed without bounds checks, so a corrupted image raises here
+        # instead of crashing a walk. depths[n] is the number of edges from the root to node n, -1 if it's free
+        cdef int size = self.array_size
+        cdef int i, p, base, id_, d, n
+        cdef int steps
+        cdef byte_t s
+        cdef Node* node
+        cdef long long slot
+        cdef bool seen[256]
+        cdef vector[int] path
+        cdef vector[int] children # number of nodes whose parent is each node
+        cdef string keys
+        cdef vector[long long] offsets
+        cdef long long key_size
+        depths.assign(size, -2) # -2 isn't known yet, -3 is on the path being walked
+        depths[0] = 0
+        for i in range(1, size):
+            if self.array[i].check < 0:
+                depths[i] = -1
+        for i in range(1, size):
+            if depths[i] != -2:
+                continue
+            p = i
+            while depths[p] == -2:
+                depths[p] = -3
+                path.push_back(p)
+                p = self.array[p].check
+                if p >= size:
+                    raise Exception("invalid data, node %d is not correct" % path.back())
+            if depths[p] < 0: # a loop, or the parent is free
+                raise Exception("invalid data, node %d is not correct" % path.back())
+            d = depths[p]
+            while path.size() > 0:
+                d += 1
+                depths[path.back()] = d
+                path.pop_back()
+        children.assign(size, 0)
+        for i in range(1, size):
+            if depths[i] >= 0:
+                children[self.array[i].check] += 1
+        for i in range(size):
+            node = &self.array[i]
+            if depths[i] < 0:
+                # free nodes link the free nodes of their block, their labels are reused as they are
+                if node.value > 0 or node.value <= -size or node.check <= -size or node.child != 0 or node.sibling != 0:
+                    raise Exception("invalid data, node %d is not correct" % i)
+                continue
+            if i > 0:
+                p = node.check
+                if self.array[p].value >= 0 or (self._node_base(&self.array[p]) ^ i) >= 256:
+                    raise Exception("invalid data, node %d is not correct" % i)
+            if node.value >= 0:
+                if node.value != value_limit and (node.value >= self.leaf_size or self.leafs[node.value] != i):
+                    raise Exception("invalid data, node %d is not correct" % i)
+                continue
+            base = self._node_base(node)
+            if (base | 255) >= size:
+                raise Exception("invalid data, node %d is not correct" % i)
+            # children are walked through their sibling labels, which must reach all of them once
+            memset(seen, 0, sizeof(seen))
+            steps = 0
+            s = node.child
+            if s == 0 and base > 0:
+                if self.array[base].check == i:
+                    steps += 1
+                s = self.array[base].sibling
+            while s != 0:
+                if seen[s] or self.array[base ^ s].check != i:
+                    raise Exception("invalid data, node %d is not correct" % i)
+                seen[s] = True
+                steps += 1
+                s = self.array[base ^ s].sibling
+            if steps != children[i]:
+                raise Exception("invalid data, node %d is not correct" % i)
+        for id_ in range(self.leaf_size):
+            p = self.leafs[id_]
+            if p < 0: # removed
+                continue
+            if p >= size or depths[p] < 0 or self.array[p].value != id_:
+                raise Exception("invalid data, key %d is not correct" % id_)
+            if self.key_slots != NULL:
+                slot = self.key_slots[id_]
+                if slot_offset(slot) + (slot & 0xffffffff) > self.key_blob_size:
+                    raise Exception("invalid data, key %d is not correct" % id_)
+            if self.payload_kind == PAYLOAD_BYTES:
+                slot = self.payloads[id_]
+                if slot_offset(slot) + (slot & 0xffffffff) > self.blob_size:
+                    raise Exception("invalid data, payload %d is not correct" % id_)
+        # keys are decoded without checks, so they must be utf8 and the key table must hold the keys of the trie
+        self._export_keys(keys, offsets, True)
+        for id_ in range(self.leaf_size):
+            if self.leafs[id_] < 0:
+                continue
+            key_size = offsets[id_ + 1] - offsets[id_]
+            if not valid_utf8(<byte_t*>keys.data() + offsets[id_], key_size):
+                raise Exception("invalid data, key %d is not correct" % id_)
+            if self.key_slots != NULL:
+                slot = self.key_slots[id_]
+                if (slot & 0xffffffff) != key_size or memcmp(self.key_blob + slot_offset(slot), keys.data() + offsets[id_], key_size) != 0:
+                    raise Exception("invalid data, key %d is not correct" % id_)
+        if self.frozen:
+            return 0
+        # blocks are only used by changes
+        n = size >> 8
+        if self.bheadF < 0 or self.bheadF >= n or self.bheadC < 0 or self.bheadC >= n or self.bheadO < 0 or self.bheadO >= n:
+            raise Exception("invalid data, blocks are not correct")
+        for i in range(n):
+            if self.blocks[i].prev < 0 or self.blocks[i].prev >= n or self.blocks[i].next_ < 0 or self.blocks[i].next_ >= n \
+                    or self.blocks[i].num < 0 or self.blocks[i].num > 256 \
+                    or (self.blocks[i].num > 0 and self.blocks[i].ehead >> 8 != i):
+                raise Exception("invalid data, blocks are not correct")
+            # free nodes of a block are a circular list from ehead, linked by -check forward and -value backward.
+            # the root is counted in num of the first block, but it isn't on the list
+            d = 0
+            for p in range(i << 8, (i + 1) << 8):
+                if depths[p] < 0:
+                    d += 1
+            if d != self.blocks[i].num - (1 if i == 0 else 0):
+                raise Exception("invalid data, blocks are not correct")
+            p = self.blocks[i].ehead
+            for steps in range(d):
+                id_ = -self.array[p].check
+                if depths[p] >= 0 or id_ >> 8 != i or self.array[id_].value != -p:
+                    raise Exception("invalid data, blocks are not correct")
+                p = id_
+            if p != self.blocks[i].ehead:
+                raise Exception("invalid data, blocks are not correct")
+        return 0
+
+    def save(self, fname, checksum = False):
         """
         save data into binary file
+        Args:
+            fname : str
+            checksum : bool
+                append the crc32 of the image, checked by load(fname, checksum=True)
         """
         cdef FILE *ptr_fw
         cdef bytes bfname = fname.encode("utf8")
@@ -1009,18 +2649,32 @@ cdef class Trie(object):
             raise Exception("Cannot open file: %s" % fname)
         self.write(ptr_fw)
         fclose(ptr_fw)
+        if checksum:
+            append_checksum(fname)
 
     cdef void _to_buff(self, void* buf):
-        cdef int offset = 0
+        cdef long long offset = 0
+        if self._saves_weights() and self.node_weights == NULL:
+            self._build_weights()
 
         cdef char* buff = <char*>buf
-        cdef uint32_t magic = magic_number
+        cdef int flags = self._flags()
+        cdef uint32_t magic = extended_magic_number if flags != 0 else magic_number
         memcpy(buff, <void*>&magic, sizeof(magic))
         offset += sizeof(magic)
 
-        cdef int size = self.buff_size()
-        memcpy(buff + offset, &size, sizeof(int))
-        offset += sizeof(int)
+        if flags != 0:
+            memcpy(buff + offset, &flags, sizeof(int))
+            offset += sizeof(int)
+
+        cdef long long size = self.buff_size()
+        cdef int small_size = <int>size
+        if flags & FLAG_LARGE:
+            memcpy(buff + offset, &size, sizeof(long long))
+            offset += sizeof(long long)
+        else:
+            memcpy(buff + offset, &small_size, sizeof(int))
+            offset += sizeof(int)
 
         memcpy(buff + offset, <void*>&self.key_num, sizeof(int))
         offset += sizeof(int)
@@ -1060,14 +2714,43 @@ cdef class Trie(object):
         memcpy(buff + offset, <void*>self.array, sizeof(Node) * self.capacity)
         offset += sizeof(Node) * self.capacity
 
-        memcpy(buff + offset, <void*>self.blocks, sizeof(Block) * (self.capacity >> 8))
-        offset += sizeof(Block) * (self.capacity >> 8)
+        if not self.frozen:
+            memcpy(buff + offset, <void*>self.blocks, sizeof(Block) * (self.capacity >> 8))
+            offset += sizeof(Block) * (self.capacity >> 8)
 
         memcpy(buff + offset, <void*>self.leafs, sizeof(int) * self.key_capacity)
         offset += sizeof(int) * self.key_capacity
 
-        memcpy(buff + offset, <void*>&self.reject, sizeof(int) * 257)
-        
+        if not self.frozen:
+            memcpy(buff + offset, <void*>&self.reject, sizeof(int) * 257)
+            offset += sizeof(int) * 257
+
+        if self.key_slots != NULL:
+            memcpy(buff + offset, <void*>self.key_slots, sizeof(long long) * self.key_capacity)
+            offset += sizeof(long long) * self.key_capacity
+
+            memcpy(buff + offset, <void*>&self.key_blob_size, sizeof(long long))
+            offset += sizeof(long long)
+
+            memcpy(buff + offset, <void*>self.key_blob, self.key_blob_size)
+            memset(buff + offset + self.key_blob_size, 0, padded_size(self.key_blob_size) - self.key_blob_size)
+            offset += padded_size(self.key_blob_size)
+
+        if self._saves_weights():
+            memcpy(buff + offset, <void*>self.node_weights, sizeof(long long) * self.array_size)
+            offset += sizeof(long long) * self.array_size
+
+            memcpy(buff + offset, <void*>self.node_ties, sizeof(int) * self.array_size)
+            offset += sizeof(int) * self.array_size
+
+        if self.payload_kind != PAYLOAD_NONE:
+            memcpy(buff + offset, <void*>self.payloads, sizeof(long long) * self.key_capacity)
+            offset += sizeof(long long) * self.key_capacity
+
+            memcpy(buff + offset, <void*>&self.blob_size, sizeof(long long))
+            offset += sizeof(long long)
+
+            memcpy(buff + offset, <void*>self.blob, self.blob_size)
 
     def to_buff(self, buff):
         """
@@ -1079,7 +2762,8 @@ cdef class Trie(object):
         cdef Py_buffer view
         if PyObject_GetBuffer(buff, &view, PyBUF_WRITABLE) != 0:
             raise Exception("cannot get writable buffer: https://docs.python.org/zh-cn/3/c-api/buffer.html")
-        if self.buff_size() < view.len:
+        if view.len < self.buff_size():
+            PyBuffer_Release(&view)
             raise Exception("buff size is smaller than needed.")
         cdef void *buf = view.buf
         self._to_buff(buf)
@@ -1089,43 +2773,196 @@ cdef class Trie(object):
 
 
     @classmethod
-    def from_buff(cls, buff, copy = True):
+    def from_buff(cls, buff, copy = True, verify = False):
         """
         init trie from buff
         Args:
             buff: object satisfy Python buff protocol https://docs.python.org/zh-cn/3/c-api/buffer.html
-            copy: whether copy data, by default, it copies data from buff
+            copy: whether copy data, by default, it copies data from buff.
+                a trie sharing buff copies it before the first change
+            verify: check every link of the image, see load
         """
         check_buffer(buff)
         cdef Py_buffer* view = <Py_buffer*>malloc(sizeof(Py_buffer))
+        cdef vector[int] depths
         if PyObject_GetBuffer(buff, view, PyBUF_SIMPLE) != 0:
             free(view)
             raise Exception("cannot get readable buffer: https://docs.python.org/zh-cn/3/c-api/buffer.html")
-        cdef Trie trie = trie_from_buff(view.buf, view.len, copy)
+        cdef Trie trie
+        try:
+            trie = trie_from_buff(view.buf, view.len, copy)
+        except:
+            PyBuffer_Release(view)
+            free(view)
+            raise
         if copy:
             trie.buff = NULL
             PyBuffer_Release(view)
             free(view)
         else:
             trie.buff = view
+        if verify:
+            trie._verify(depths)
         return trie
 
+    @classmethod
+    def load(cls, path, mmap = True, verify = True, populate = False, checksum = False):
+        """
+        load a file written by save
+        Args:
+            path : str
+            mmap : bool
+                share the pages of the file, see from_buff(copy=False), else the file is read into memory
+            verify : bool
+                check every link of the image, a corrupted file raises Exception instead of crashing a later call.
+                the sizes of the sections are always checked
+            populate : bool
+                read the file when it's mapped, so the first calls don't wait for page faults
+            checksum : bool
+                check the crc32 appended by save(path, checksum=True), raise Exception if it's missing
+        Returns:
+            trie : Trie
+        Examples:
+            >>> trie.save("trie.bin", checksum=True)
+            >>> trie = Trie.load("trie.bin", populate=True, checksum=True)
+        """
+        return cls.from_buff(open_image(path, mmap, populate, checksum), copy = not mmap, verify = verify)
+
+
+cdef class MatchedIter(object):
+    """
+    Iterates matched results as tuples, tuples are only created when they are consumed.
+    """
+    cdef vector[Matched] vect
+    cdef size_t pos
+    cdef bool with_start
+    cdef Trie payload_trie # payloads are appended to tuples if it's not None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.pos >= self.vect.size():
+            raise StopIteration
+        cdef Matched* m = &self.vect[self.pos]
+        self.pos += 1
+        if self.payload_trie is not None:
+            if self.with_start:
+                return m.val, m.start, m.end, self.payload_trie._payload(m.val)
+            return m.val, m.end, self.payload_trie._payload(m.val)
+        if self.with_start:
+            return m.val, m.start, m.end
+        return m.val, m.end
+
+    def __length_hint__(self):
+        return self.vect.size() - self.pos
+
+
+cdef object matched_iter(vector[Matched]& vect, bool with_start, Trie payload_trie = None):
+    cdef MatchedIter it = MatchedIter.__new__(MatchedIter)
+    it.vect.swap(vect)
+    it.pos = 0
+    it.with_start = with_start
+    it.payload_trie = payload_trie
+    return it
+
+
+cdef array.array int_array_template = array.array('i')
+cdef array.array int64_array_template = array.array('q')
+cdef array.array float_array_template = array.array('d')
+
+cdef array.array ids_to_array(vector[int]& ids):
+    cdef array.array ret = array.clone(int_array_template, ids.size(), False)
+    if ids.size() > 0:
+        memcpy(ret.data.as_ints, ids.data(), sizeof(int) * ids.size())
+    return ret
+
+cdef tuple matched_to_arrays(vector[Matched]& vect, bool with_start, Trie payload_trie = None):
+    cdef size_t i, n = vect.size()
+    cdef array.array ids = array.clone(int_array_template, n, False)
+    cdef array.array starts
+    cdef array.array ends = array.clone(int_array_template, n, False)
+    cdef tuple ret
+    for i in range(n):
+        ids.data.as_ints[i] = vect[i].val
+        ends.data.as_ints[i] = vect[i].end
+    if not with_start:
+        ret = (ids, ends)
+    else:
+        starts = array.clone(int_array_template, n, False)
+        for i in range(n):
+            starts.data.as_ints[i] = vect[i].start
+        ret = (ids, starts, ends)
+    if payload_trie is None:
+        return ret
+    return ret + (payloads_of(payload_trie, ids),)
+
+
+cdef tuple column_arrays(vector[int]& rows, vector[Matched]& vect):
+    # (rows, ids, starts, ends) of the matches of a column
+    cdef size_t i, n = rows.size()
+    cdef array.array rows_arr = array.clone(int_array_template, n, False)
+    for i in range(n):
+        rows_arr.data.as_ints[i] = rows[i]
+    return (rows_arr,) + matched_to_arrays(vect, True)
+
+
+cdef Trie payload_source(Trie trie, with_payload):
+    # the trie to read payloads from if they are requested, else None
+    if not with_payload:
+        return None
+    if trie.payload_kind == PAYLOAD_NONE:
+        raise Exception("trie has no payloads, create it with payload_type")
+    return trie
+
+
+cdef object payloads_of(Trie trie, array.array ids):
+    # array('q') or array('d') for numbers, list for bytes
+    cdef Py_ssize_t i, n = len(ids)
+    cdef array.array ret
+    if trie.payload_kind == PAYLOAD_BYTES:
+        return [trie._payload(ids.data.as_ints[i]) for i in range(n)]
+    ret = array.clone(int64_array_template if trie.payload_kind == PAYLOAD_INT else float_array_template, n, False)
+    for i in range(n):
+        # same 8 bytes for both types
+        (<long long*>ret.data.as_voidptr)[i] = trie.payloads[ids.data.as_ints[i]]
+    return ret
+
 
-cdef Trie trie_from_buff(void* buf, int buf_size, bool copy):
-    cdef int offset = 0
+cdef Trie trie_from_buff(void* buf, long long buf_size, bool copy, long long node_tail = 0, long long leaf_tail = 0):
+    # every section is checked to be in buf before it's read, node_tail and leaf_tail are bytes
+    # for each node and each leaf which follow the image, the tables of an automaton
+    cdef long long offset = 0
     cdef Trie trie = new_object(Trie)
     cdef uint32_t magic 
-    cdef int size
+    cdef long long size
+    cdef int small_size
     cdef char* buff = <char*>buf
+    check_bounds(sizeof(magic), buf_size)
     memcpy(<void*>&magic, buff, sizeof(magic))
-    if magic != magic_number and magic != legacy_magic_number:
+    if magic != magic_number and magic != legacy_magic_number and magic != extended_magic_number:
         raise Exception("invalid data, magic number is not correct")
     offset += sizeof(magic)
 
-    memcpy(&size, buff + offset, sizeof(int))
-    offset += sizeof(int)
-    if size > buf_size:
-        raise Exception("invalid data, buf size is not correct")
+    cdef int flags = 0
+    if magic == extended_magic_number:
+        check_bounds(offset + sizeof(int), buf_size)
+        memcpy(&flags, buff + offset, sizeof(int))
+        offset += sizeof(int)
+        if flags & ~(FLAG_FROZEN | FLAG_KEY_TABLE | FLAG_LARGE | FLAG_WEIGHTS | 0xff00) != 0 or (flags >> 8) >= len(payload_types):
+            raise Exception("reading newer binary file, please update cyac")
+    trie.frozen = flags & FLAG_FROZEN != 0
+    trie.payload_kind = flags >> 8
+
+    check_bounds(offset + sizeof(long long) + 11 * sizeof(int), buf_size)
+    if flags & FLAG_LARGE:
+        memcpy(&size, buff + offset, sizeof(long long))
+        offset += sizeof(long long)
+    else:
+        memcpy(&small_size, buff + offset, sizeof(int))
+        offset += sizeof(int)
+        size = small_size
+    check_bounds(size, buf_size)
 
     cdef int value = 0
     memcpy(<void*>&value, buff + offset, sizeof(int))
@@ -1172,14 +3009,48 @@ cdef Trie trie_from_buff(void* buf, int buf_size, bool copy):
     trie.leaf_size = value
     offset += sizeof(int)
 
+    # blocks have 256 nodes, and ids index leafs
+    if trie.array_size <= 0 or trie.array_size & 255 or trie.capacity < trie.array_size or trie.capacity & 255 \
+            or trie.leaf_size < 0 or trie.key_capacity < trie.leaf_size or trie.key_num < 0:
+        raise Exception("invalid data, header is not correct")
+    cdef long long end = offset + sizeof(Node) * <long long>trie.capacity + sizeof(int) * <long long>trie.key_capacity
+    if not trie.frozen:
+        end += sizeof(Block) * (trie.capacity >> 8) + sizeof(int) * 257
+    if flags & FLAG_KEY_TABLE:
+        end += sizeof(long long) * <long long>trie.key_capacity
+        check_bounds(end + sizeof(long long), buf_size)
+        memcpy(<void*>&trie.key_blob_size, buff + end, sizeof(long long))
+        if trie.key_blob_size < 0:
+            raise Exception("invalid data, header is not correct")
+        end += sizeof(long long) + padded_size(trie.key_blob_size)
+    if (flags & FLAG_WEIGHTS != 0) != trie._saves_weights():
+        raise Exception("invalid data, header is not correct")
+    if flags & FLAG_WEIGHTS:
+        end += (sizeof(long long) + sizeof(int)) * <long long>trie.array_size
+    if trie.payload_kind != PAYLOAD_NONE:
+        end += sizeof(long long) * <long long>trie.key_capacity
+        check_bounds(end + sizeof(long long), buf_size)
+        memcpy(<void*>&trie.blob_size, buff + end, sizeof(long long))
+        if trie.blob_size < 0:
+            raise Exception("invalid data, header is not correct")
+        end += sizeof(long long) + trie.blob_size
+    check_bounds(end + node_tail * trie.array_size + leaf_tail * trie.leaf_size, buf_size)
+    # arrays of an empty trie are replaced
+    free(trie.array)
+    free(trie.blocks)
+    free(trie.leafs)
+
     if copy:
         trie.array = <Node*>malloc(sizeof(Node) * trie.capacity)
         memcpy(<void*>trie.array, buff + offset, sizeof(Node) * trie.capacity)
         offset += sizeof(Node) * trie.capacity
 
-        trie.blocks = <Block*>malloc(sizeof(Block) * (trie.capacity >> 8))
-        memcpy(<void*>trie.blocks, buff + offset, sizeof(Block) * (trie.capacity >> 8))
-        offset += sizeof(Block) * (trie.capacity >> 8)
+        if trie.frozen:
+            trie.blocks = NULL
+        else:
+            trie.blocks = <Block*>malloc(sizeof(Block) * (trie.capacity >> 8))
+            memcpy(<void*>trie.blocks, buff + offset, sizeof(Block) * (trie.capacity >> 8))
+            offset += sizeof(Block) * (trie.capacity >> 8)
 
         trie.leafs = <int*>malloc(sizeof(int) * trie.key_capacity)
         memcpy(<void*>trie.leafs, buff + offset, sizeof(int) * trie.key_capacity)
@@ -1188,14 +3059,54 @@ cdef Trie trie_from_buff(void* buf, int buf_size, bool copy):
         trie.array =  <Node*>(buff + offset)
         offset += sizeof(Node) * trie.capacity
 
-        trie.blocks = <Block*>(buff + offset)
-        offset += sizeof(Block) * (trie.capacity >> 8)
+        if trie.frozen:
+            trie.blocks = NULL
+        else:
+            trie.blocks = <Block*>(buff + offset)
+            offset += sizeof(Block) * (trie.capacity >> 8)
 
         trie.leafs = <int*>(buff + offset)
         offset += sizeof(int) * trie.key_capacity
 
 
-    memcpy(<void*>&trie.reject, buff + offset, sizeof(int) * 257)
+    if not trie.frozen:
+        memcpy(<void*>&trie.reject, buff + offset, sizeof(int) * 257)
+        offset += sizeof(int) * 257
+
+    if flags & FLAG_KEY_TABLE:
+        memcpy(<void*>&trie.key_blob_size, buff + offset + sizeof(long long) * trie.key_capacity, sizeof(long long))
+        trie.key_blob_capacity = trie.key_blob_size
+        if copy:
+            trie.key_slots = <long long*>malloc(sizeof(long long) * max(trie.key_capacity, 1))
+            memcpy(<void*>trie.key_slots, buff + offset, sizeof(long long) * trie.key_capacity)
+            trie.key_blob = <char*>malloc(max(trie.key_blob_size, 1))
+            memcpy(<void*>trie.key_blob, buff + offset + sizeof(long long) * (trie.key_capacity + 1), trie.key_blob_size)
+        else:
+            trie.key_slots = <long long*>(buff + offset)
+            trie.key_blob = buff + offset + sizeof(long long) * (trie.key_capacity + 1)
+        offset += sizeof(long long) * (trie.key_capacity + 1) + padded_size(trie.key_blob_size)
+
+    if flags & FLAG_WEIGHTS:
+        if copy:
+            trie.node_weights = <long long*>copy_memory(buff + offset, sizeof(long long) * trie.array_size)
+            trie.node_ties = <int*>copy_memory(buff + offset + sizeof(long long) * trie.array_size, sizeof(int) * trie.array_size)
+        else:
+            trie.node_weights = <long long*>(buff + offset)
+            trie.node_ties = <int*>(buff + offset + sizeof(long long) * trie.array_size)
+            trie.weights_shared = True
+        offset += (sizeof(long long) + sizeof(int)) * trie.array_size
+
+    if trie.payload_kind != PAYLOAD_NONE:
+        memcpy(<void*>&trie.blob_size, buff + offset + sizeof(long long) * trie.key_capacity, sizeof(long long))
+        trie.blob_capacity = trie.blob_size
+        if copy:
+            trie.payloads = <long long*>malloc(sizeof(long long) * max(trie.key_capacity, 1))
+            memcpy(<void*>trie.payloads, buff + offset, sizeof(long long) * trie.key_capacity)
+            trie.blob = <char*>malloc(max(trie.blob_size, 1))
+            memcpy(<void*>trie.blob, buff + offset + sizeof(long long) * (trie.key_capacity + 1), trie.blob_size)
+        else:
+            trie.payloads = <long long*>(buff + offset)
+            trie.blob = buff + offset + sizeof(long long) * (trie.key_capacity + 1)
     return trie
 
 
@@ -1,7 +1,7 @@
 
 # distutils: language=c++
 ctypedef unsigned char byte_t
-cdef inline byte_t* iter_unicode(byte_t *src, int* ret, int *char_byte_num):
+cdef inline byte_t* iter_unicode(byte_t *src, int* ret, int *char_byte_num) noexcept nogil:
     cdef int result = 0
     cdef int i
     cdef byte_t leading_byte, c
@@ -46,7 +46,7 @@ cdef inline byte_t* iter_unicode(byte_t *src, int* ret, int *char_byte_num):
     return src
 
 
-cdef inline byte_t* encode_unicode(int c, byte_t *utf8_dst):
+cdef inline byte_t* encode_unicode(int c, byte_t *utf8_dst) noexcept nogil:
     if c == 0:
         return utf8_dst
     cdef byte_t ch
@@ -102,6 +102,82 @@ cdef inline byte_t* encode_unicode(int c, byte_t *utf8_dst):
     return utf8_dst
 
 
+cdef inline int utf8_char_len(byte_t leading_byte) noexcept nogil:
+    if leading_byte < 0x80:
+        return 1
+    if leading_byte & 0xe0 == 0xc0:
+        return 2
+    if leading_byte & 0xf0 == 0xe0:
+        return 3
+    if leading_byte & 0xf8 == 0xf0:
+        return 4
+    return 1
+
+
+cdef inline int char_at_byte(byte_t *src, int byte_idx, int byte_num) noexcept nogil:
+    # code point starting at byte_idx, -1 if byte_idx is not a char boundary
+    cdef byte_t leading_byte = src[byte_idx]
+    cdef int ret = 0
+    cdef int char_byte_num = 0
+    if leading_byte < 0x80:
+        return leading_byte
+    if leading_byte & 0xe0 == 0xc0:
+        char_byte_num = 2
+    elif leading_byte & 0xf0 == 0xe0:
+        char_byte_num = 3
+    elif leading_byte & 0xf8 == 0xf0:
+        char_byte_num = 4
+    else:
+        return -1
+    if byte_idx + char_byte_num > byte_num:
+        return -1
+    if iter_unicode(src + byte_idx, &ret, &char_byte_num) == NULL:
+        return -1
+    return ret
+
+
+cdef inline int char_before_byte(byte_t *src, int byte_idx, int byte_num) noexcept nogil:
+    # code point which ends right before byte_idx
+    cdef int i = byte_idx - 1
+    while i > 0 and byte_idx - i < 4 and src[i] & 0xc0 == 0x80:
+        i -= 1
+    return char_at_byte(src, i, byte_num)
+
+
 cdef int char_num(byte_t *src)
 cdef int fill_char_info(byte_t *src, int *char_idx_of_byte, int *chars, int *char_offsets)
 
+
+
+cdef inline bint valid_utf8(const byte_t *src, long long byte_num) noexcept nogil:
+    # same rules as the strict decoder of python: no overlong forms, surrogates or code points over 0x10ffff
+    cdef long long i = 0
+    cdef int c, n, j
+    while i < byte_num:
+        c = src[i]
+        if c < 0x80:
+            i += 1
+            continue
+        if 0xc2 <= c <= 0xdf:
+            n = 1
+            c &= 0x1f
+        elif 0xe0 <= c <= 0xef:
+            n = 2
+            c &= 0x0f
+        elif 0xf0 <= c <= 0xf4:
+            n = 3
+            c &= 0x07
+        else:
+            return False
+        if i + n >= byte_num:
+            return False
+        for j in range(1, n + 1):
+            if src[i + j] & 0xc0 != 0x80:
+                return False
+            c = (c << 6) | (src[i + j] & 0x3f)
+        if n == 2 and (c < 0x800 or 0xd800 <= c <= 0xdfff):
+            return False
+        if n == 3 and (c < 0x10000 or c > 0x10ffff):
+            return False
+        i += n + 1
+    return True
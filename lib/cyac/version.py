@@ -1,3 +1,7 @@
 legacy_magic_number = 0
 magic_number = 0xACACACAC
-ac_binary_version = 1
\ No newline at end of file
+extended_magic_number = 0xACACACAF # trie image with a flags word after the magic, see Trie._to_buff
+ac_binary_version = 2
+sharded_magic_number = 0xACACACB0 # see ShardedAC.to_buff
+ac_large_binary_version = 3 # same as 2 with a long long size, written only for images over 2GB
+checksum_magic_number = 0xACACACC5 # trailer of save(fname, checksum=True)
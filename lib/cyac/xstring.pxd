@@ -3,6 +3,9 @@
 import cython
 from cpython.version cimport PY_MAJOR_VERSION
 from libcpp.string cimport string
+from libcpp cimport bool
+from cpython.buffer cimport Py_buffer
+from cpython.unicode cimport PyUnicode_DATA, PyUnicode_GET_LENGTH
 from .utf8 cimport byte_t
 
 ctypedef fused text_t:
@@ -13,6 +16,17 @@ ctypedef fused unicode_int_t:
     unicode
     int
 
+cdef extern from "Python.h":
+    bint PyUnicode_IS_ASCII(object o)
+
+cdef inline const char* ascii_utf8(unicode text, Py_ssize_t* size):
+    # the storage of an ascii str is its utf8, NULL for other text.
+    # PyUnicode_AsUTF8AndSize would keep a utf8 copy in a non ascii str as long as the str lives
+    if not PyUnicode_IS_ASCII(text):
+        return NULL
+    size[0] = PyUnicode_GET_LENGTH(text)
+    return <const char*>PyUnicode_DATA(text)
+
 cdef class xstring(object):
     cdef unicode py_unicode
     cdef bytes py_bytes
@@ -23,6 +37,9 @@ cdef class xstring(object):
     cdef int* char_idx_of_byte # 每个byte对应的char
     cdef int* char_offsets # 每个char 在bytes中的offset
     cdef int* chars # char的数组
+    cdef int* data # block of the arrays and the utf8 of non ascii text, char_idx_of_byte and char_offsets may belong to layout
+    cdef size_t data_size # bytes of data, the block is kept for the next xstring, see take_block
+    cdef xstring layout # a string of the same byte layout, None if arrays are owned
     cpdef int char_at(self, int i)
 
     cdef inline int char_byte_num(self, int i):
@@ -30,8 +47,57 @@ cdef class xstring(object):
 
 cdef class ignore_case_alignment(object):
     cdef xstring original
-    cdef xstring lowercase
-    cdef int* lowercase_char_index_mapping # char的 index 到 index 的转换
+    cdef xstring lowercase # original itself if no char changes
+    cdef int* lowercase_char_index_mapping # char的 index 到 index 的转换, NULL if they are the same
+    cdef void _lower_by_python(self) except *
+
+cdef class xbytes(object):
+    # utf8 text held by an object which supports buffer protocol
+    cdef Py_buffer view
+    cdef bool has_view
+    cdef ignore_case_alignment align # None if offsets are the same as the buffer's
+    cdef bytes lowered # lowercased ascii text
+    cdef byte_t* bytes_
+    cdef int byte_num
+    # offsets of matched bytes_ in the original buffer
+    cdef inline int start_offset(self, int byte_idx) noexcept nogil:
+        if self.align is None:
+            return byte_idx
+        cdef int char_idx = self.align.lowercase.char_idx_of_byte[byte_idx]
+        if self.align.lowercase_char_index_mapping != NULL:
+            char_idx = self.align.lowercase_char_index_mapping[char_idx]
+        return self.align.original.char_offsets[char_idx]
+
+    cdef inline int end_offset(self, int byte_idx) noexcept nogil:
+        if self.align is None:
+            return byte_idx
+        cdef int char_idx = self.align.lowercase.char_idx_of_byte[byte_idx - 1]
+        if self.align.lowercase_char_index_mapping != NULL:
+            char_idx = self.align.lowercase_char_index_mapping[char_idx]
+        return self.align.original.char_offsets[char_idx + 1]
+
+cdef class xcolumn(object):
+    # utf8 strings in one buffer, row i is data[offsets[i]:offsets[i + 1]], the layout of arrow string arrays
+    cdef object data # memoryview of data, rows of ignore case tries are sliced from it
+    cdef Py_buffer data_view
+    cdef Py_buffer offsets_view
+    cdef bool has_data
+    cdef bool has_offsets
+    cdef byte_t* bytes_
+    cdef int width # bytes of an offset, 4 or 8
+    cdef int rows
+    cdef inline long long offset(self, int row) noexcept nogil:
+        if self.width == 4:
+            return (<int*>self.offsets_view.buf)[row]
+        return (<long long*>self.offsets_view.buf)[row]
+
+    cdef inline byte_t* row(self, int row) noexcept nogil:
+        return self.bytes_ + self.offset(row)
+
+    cdef inline int row_len(self, int row) noexcept nogil:
+        return <int>(self.offset(row + 1) - self.offset(row))
+
+    cdef xbytes row_bytes(self, int row, bool lowercase)
 
 cdef extern from "<sstream>" namespace "std" nogil:
     ctypedef int streamsize
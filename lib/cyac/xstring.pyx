@@ -3,28 +3,78 @@
 # If return NULL then it's invalid utf8
 from libc.stdlib cimport malloc, free, realloc
 from cython cimport typeof
-from .utf8 cimport fill_char_info, char_num
 from cython cimport Py_UCS4
+from cpython.buffer cimport PyObject_GetBuffer, PyBuffer_Release, PyBUF_SIMPLE, PyBUF_FORMAT
+from cpython.unicode cimport PyUnicode_DecodeUTF8, PyUnicode_DATA, PyUnicode_KIND, PyUnicode_GET_LENGTH
+from cpython.bytes cimport PyBytes_FromStringAndSize, PyBytes_AS_STRING
+from libcpp.vector cimport vector
+from .utf8 cimport encode_unicode
+
+cdef inline int utf8_len(Py_UCS4 c):
+    return 1 if c < 0x80 else 2 if c < 0x800 else 3 if c < 0x10000 else 4
 cdef extern from "unicode_portability.c":
     cdef extern int _PyUnicode_ToLowerFull(Py_UCS4 ch, Py_UCS4* res)
 
 # from libc.wctype cimport towlower, towupper, iswlower, iswupper
 
 
+# the block of the last freed xstring is kept for the next one, so texts matched one after another
+# don't take new pages each time. xstrings are created and freed with the GIL, which guards it
+cdef void* spare_block = NULL
+cdef size_t spare_size = 0
+cdef size_t spare_limit = 1 << 26
+
+
+cdef void* take_block(size_t size, size_t* capacity) noexcept:
+    global spare_block, spare_size
+    cdef void* ret = spare_block
+    if ret != NULL and spare_size >= size:
+        capacity[0] = spare_size
+        spare_block = NULL
+        spare_size = 0
+        return ret
+    capacity[0] = max(size, 1)
+    return malloc(capacity[0])
+
+
+cdef void give_block(void* block, size_t capacity) noexcept:
+    global spare_block, spare_size
+    if capacity > spare_limit or (spare_block != NULL and spare_size >= capacity):
+        free(block)
+        return
+    free(spare_block)
+    spare_block = block
+    spare_size = capacity
+
+
 cdef class xstring(object):
-    def __cinit__(self, unicode text):
-        cdef bytes py_bytes = text.encode("utf8")
+    def __cinit__(self, unicode text = None):
+        if text is None: # filled by lowercase_of
+            return
+        cdef Py_ssize_t byte_num
+        cdef void* chars = PyUnicode_DATA(text)
+        cdef int kind = PyUnicode_KIND(text)
+        self.char_num = PyUnicode_GET_LENGTH(text)
+        # an ascii str is its own utf8, other text is encoded from its code points into data
+        self.bytes_ = <byte_t*>ascii_utf8(text, &byte_num)
+        if self.bytes_ == NULL:
+            byte_num = unicode_utf8_size(chars, kind, self.char_num)
+            if byte_num < 0:
+                text.encode("utf8") # raises for the surrogate
+        if byte_num > 0x7fffffff:
+            raise OverflowError("text is larger than 2GB")
         self.py_unicode = text
-        self.py_bytes = py_bytes
-        self.bytes_ = py_bytes
-        self.byte_num = len(py_bytes)
-        self.char_num = char_num(self.bytes_)
-        if self.char_num < 0:
-            raise Exception("Invalid UTF8 string")
-        self.char_idx_of_byte = <int*> malloc((self.byte_num + 1  + self.char_num + self.char_num + 1) * sizeof(int))
+        self.byte_num = byte_num
+        cdef size_t ints = self.byte_num + 1  + self.char_num + self.char_num + 1
+        self.data = <int*> take_block(ints * sizeof(int) + (byte_num if self.bytes_ == NULL else 0), &self.data_size)
+        self.char_idx_of_byte = self.data
         self.chars = self.char_idx_of_byte + self.byte_num + 1
         self.char_offsets =self.chars + self.char_num
-        fill_char_info(self.bytes_, self.char_idx_of_byte, self.chars, self.char_offsets)
+        if self.bytes_ == NULL:
+            self.bytes_ = <byte_t*>(self.data + ints)
+            fill_unicode_info(chars, kind, self.char_num, self.char_idx_of_byte, self.chars, self.char_offsets, self.bytes_)
+        else:
+            fill_unicode_info(chars, kind, self.char_num, self.char_idx_of_byte, self.chars, self.char_offsets, NULL)
 
     property byte_num:
         def __get__(self):
@@ -41,31 +91,181 @@ cdef class xstring(object):
 
     property bytes:
         def __get__(self):
+            if self.py_bytes is None:
+                return <bytes>(<char*>self.bytes_)[:self.byte_num]
             return self.py_bytes
 
     def __dealloc__(self):
-        if self.char_idx_of_byte:
-            free(self.char_idx_of_byte)
+        if self.data:
+            give_block(self.data, self.data_size)
 
     def __repr__(self):
-        return repr(self.py_bytes)
+        return repr(self.bytes)
 
     def __str__(self):
-        return str(self.py_bytes)
+        return str(self.bytes)
+
+
+cdef Py_ssize_t unicode_utf8_size(void* data, int kind, Py_ssize_t char_num) noexcept nogil:
+    # bytes of the utf8 of a str from its code points, -1 if it has a surrogate, which has no utf8
+    cdef Py_ssize_t i
+    cdef Py_ssize_t ret = char_num
+    cdef Py_UCS4 c
+    if kind == 1:
+        for i in range(char_num):
+            ret += (<unsigned char*>data)[i] >> 7
+        return ret
+    for i in range(char_num):
+        c = (<unsigned short*>data)[i] if kind == 2 else (<Py_UCS4*>data)[i]
+        if c >= 0xd800 and c <= 0xdfff:
+            return -1
+        ret += 0 if c < 0x80 else 1 if c < 0x800 else 2 if c < 0x10000 else 3
+    return ret
+
+
+cdef void fill_unicode_info(void* data, int kind, int char_num, int* char_idx_of_byte, int* chars, int* char_offsets, byte_t* utf8) noexcept nogil:
+    # same as fill_char_info, from the code points of a str instead of decoding its utf8.
+    # the utf8 is written to utf8 unless it's NULL
+    cdef int i, j, n
+    cdef int offset = 0
+    cdef unsigned int c
+    if kind == 1:
+        for i in range(char_num):
+            c = (<unsigned char*>data)[i]
+            chars[i] = c
+            char_offsets[i] = offset
+            char_idx_of_byte[offset] = i
+            if c >= 0x80:
+                char_idx_of_byte[offset + 1] = i
+                if utf8 != NULL:
+                    utf8[offset] = 0xc0 | (c >> 6)
+                    utf8[offset + 1] = 0x80 | (c & 0x3f)
+                offset += 2
+            else:
+                if utf8 != NULL:
+                    utf8[offset] = c
+                offset += 1
+    else:
+        for i in range(char_num):
+            c = (<unsigned short*>data)[i] if kind == 2 else (<Py_UCS4*>data)[i]
+            chars[i] = c
+            char_offsets[i] = offset
+            n = 1 if c < 0x80 else 2 if c < 0x800 else 3 if c < 0x10000 else 4
+            for j in range(n):
+                char_idx_of_byte[offset + j] = i
+            if utf8 != NULL:
+                if n == 1:
+                    utf8[offset] = c
+                else:
+                    # leading byte has n high bits set, then 6 bits in each continuation byte
+                    for j in range(n - 1, 0, -1):
+                        utf8[offset + j] = 0x80 | (c & 0x3f)
+                        c >>= 6
+                    utf8[offset] = (0xf00 >> n) | c
+            offset += n
+    char_idx_of_byte[offset] = char_num
+    char_offsets[char_num] = offset
+
+
+cdef xstring lowercase_of(vector[Py_UCS4]& chars, xstring layout):
+    # xstring of lowercased chars, it shares char_idx_of_byte and char_offsets of layout if it's not None
+    cdef xstring ret = xstring()
+    cdef int i, j, byte_num = 0
+    cdef byte_t* p
+    cdef byte_t* end
+    ret.char_num = chars.size()
+    if layout is not None:
+        byte_num = layout.byte_num
+    else:
+        for i in range(ret.char_num):
+            byte_num += 1 if chars[i] < 0x80 else 2 if chars[i] < 0x800 else 3 if chars[i] < 0x10000 else 4
+    ret.py_bytes = PyBytes_FromStringAndSize(NULL, byte_num)
+    ret.bytes_ = <byte_t*>PyBytes_AS_STRING(ret.py_bytes)
+    ret.byte_num = byte_num
+    if layout is not None:
+        ret.layout = layout
+        ret.data = <int*> take_block(ret.char_num * sizeof(int), &ret.data_size)
+        ret.chars = ret.data
+        ret.char_idx_of_byte = layout.char_idx_of_byte
+        ret.char_offsets = layout.char_offsets
+    else:
+        ret.data = <int*> take_block((byte_num + 1 + ret.char_num + ret.char_num + 1) * sizeof(int), &ret.data_size)
+        ret.char_idx_of_byte = ret.data
+        ret.chars = ret.char_idx_of_byte + byte_num + 1
+        ret.char_offsets = ret.chars + ret.char_num
+    p = ret.bytes_
+    for i in range(ret.char_num):
+        ret.chars[i] = chars[i]
+        end = encode_unicode(chars[i], p)
+        if layout is None:
+            ret.char_offsets[i] = p - ret.bytes_
+            for j in range(end - p):
+                ret.char_idx_of_byte[p - ret.bytes_ + j] = i
+        p = end
+    if layout is None:
+        ret.char_idx_of_byte[byte_num] = ret.char_num
+        ret.char_offsets[ret.char_num] = byte_num
+    return ret
 
 
 cdef class ignore_case_alignment(object):
     def __cinit__(self, xstring original):
+        # chars are lowercased one by one, ascii chars without calling python.
+        # the mapping is only built if a char is lowercased to more chars,
+        # and the offset arrays are shared if every char keeps its utf8 length
         self.original = original
-        self.lowercase = xstring(original.py_unicode.lower())
-        self.lowercase_char_index_mapping =  <int*> malloc((len(self.lowercase.py_unicode) + 1) * sizeof(int))
+        self.lowercase_char_index_mapping = NULL
+        cdef vector[Py_UCS4] lowered
         cdef Py_UCS4 buf[4]
+        cdef int c
+        cdef int i, j, n
         cdef int offset = 0
-        cdef int n
-        for ori_char_idx in range(len(original.py_unicode)):
-            n = _PyUnicode_ToLowerFull(original.chars[ori_char_idx], buf)
-            for i in range(n):
-                self.lowercase_char_index_mapping[offset + i] = ori_char_idx
+        cdef bool changed = False
+        cdef bool same_layout = True
+        lowered.reserve(original.char_num)
+        for i in range(original.char_num):
+            c = original.chars[i]
+            if c < 0x80:
+                if c >= 65 and c <= 90: # A-Z
+                    c += 32
+                    changed = True
+                lowered.push_back(<Py_UCS4>c)
+                continue
+            if c == 0x3a3: # capital sigma is lowercased by its context
+                self._lower_by_python()
+                return
+            n = _PyUnicode_ToLowerFull(<Py_UCS4>c, buf)
+            if n != 1 or <int>buf[0] != c:
+                changed = True
+                if n != 1 or utf8_len(buf[0]) != utf8_len(<Py_UCS4>c):
+                    same_layout = False
+            for j in range(n):
+                lowered.push_back(buf[j])
+        if not changed:
+            self.lowercase = original
+            return
+        self.lowercase = lowercase_of(lowered, original if same_layout else None)
+        if <int>lowered.size() == original.char_num:
+            return
+        self.lowercase_char_index_mapping = <int*> malloc((lowered.size() + 1) * sizeof(int))
+        for i in range(original.char_num):
+            n = _PyUnicode_ToLowerFull(original.chars[i], buf)
+            for j in range(n):
+                self.lowercase_char_index_mapping[offset + j] = i
+            offset += n
+        self.lowercase_char_index_mapping[offset] = original.char_num
+
+    cdef void _lower_by_python(self) except *:
+        cdef xstring original = self.original
+        cdef Py_UCS4 buf[4]
+        cdef int offset = 0
+        cdef int n, i, j
+        self.lowercase = xstring(original.py_unicode.lower())
+        self.lowercase_char_index_mapping = <int*> malloc((self.lowercase.char_num + 1) * sizeof(int))
+        for i in range(original.char_num):
+            n = _PyUnicode_ToLowerFull(original.chars[i], buf)
+            for j in range(n):
+                self.lowercase_char_index_mapping[offset + j] = i
             offset += n
         self.lowercase_char_index_mapping[offset] = original.char_num
 
@@ -80,10 +280,107 @@ cdef class ignore_case_alignment(object):
 
 
     def alignment_array(self):
-        return [self.lowercase_char_index_mapping[cidx] for cidx in range(len(self.lowercase.py_unicode))]
+        if self.lowercase_char_index_mapping == NULL:
+            return list(range(self.lowercase.char_num))
+        return [self.lowercase_char_index_mapping[cidx] for cidx in range(self.lowercase.char_num)]
 
 
     def __dealloc__(self):
         if self.lowercase_char_index_mapping:
             free(self.lowercase_char_index_mapping)
 
+
+cdef class xbytes(object):
+    def __cinit__(self, data, bool lowercase = False):
+        cdef xstring original
+        cdef ignore_case_alignment align
+        if PyObject_GetBuffer(data, &self.view, PyBUF_SIMPLE) != 0:
+            raise Exception("cannot get readable buffer: https://docs.python.org/zh-cn/3/c-api/buffer.html")
+        self.has_view = True
+        if self.view.len > 0x7fffffff:
+            raise OverflowError("buffer is larger than 2GB")
+        self.bytes_ = <byte_t*>self.view.buf
+        self.byte_num = self.view.len
+        if not lowercase:
+            return
+        cdef byte_t* src = <byte_t*>self.view.buf
+        cdef Py_ssize_t i
+        cdef bool upper = False
+        for i in range(self.view.len):
+            if src[i] >= 0x80:
+                break
+            upper = upper or (src[i] >= 65 and src[i] <= 90)
+        else:
+            # ascii, offsets don't change
+            if upper:
+                # not created from src, bytes of one char are shared by python
+                self.lowered = PyBytes_FromStringAndSize(NULL, self.view.len)
+                self.bytes_ = <byte_t*>PyBytes_AS_STRING(self.lowered)
+                for i in range(self.view.len):
+                    self.bytes_[i] = src[i] + 32 if src[i] >= 65 and src[i] <= 90 else src[i]
+                PyBuffer_Release(&self.view)
+                self.has_view = False
+            return
+        original = xstring(PyUnicode_DecodeUTF8(<char*>self.view.buf, self.view.len, NULL))
+        align = ignore_case_alignment(original)
+        if align.lowercase is original:
+            return
+        PyBuffer_Release(&self.view)
+        self.has_view = False
+        self.align = align
+        self.bytes_ = self.align.lowercase.bytes_
+        self.byte_num = self.align.lowercase.byte_num
+
+    property byte_num:
+        def __get__(self):
+            return self.byte_num
+
+    def __dealloc__(self):
+        if self.has_view:
+            PyBuffer_Release(&self.view)
+
+
+cdef class xcolumn(object):
+    def __cinit__(self, data, offsets):
+        cdef int i
+        cdef long long n
+        cdef bytes fmt
+        self.data = memoryview(data).cast("B")
+        if PyObject_GetBuffer(self.data, &self.data_view, PyBUF_SIMPLE) != 0:
+            raise Exception("cannot get readable buffer: https://docs.python.org/zh-cn/3/c-api/buffer.html")
+        self.has_data = True
+        self.bytes_ = <byte_t*>self.data_view.buf
+        if PyObject_GetBuffer(offsets, &self.offsets_view, PyBUF_FORMAT) != 0:
+            raise Exception("cannot get readable buffer: https://docs.python.org/zh-cn/3/c-api/buffer.html")
+        self.has_offsets = True
+        fmt = self.offsets_view.format if self.offsets_view.format != NULL else b"B"
+        self.width = self.offsets_view.itemsize
+        if fmt[-1:] not in (b"i", b"l", b"q") or self.width not in (4, 8):
+            raise Exception("offsets should be an array of int32 or int64")
+        n = self.offsets_view.len // self.width
+        if n - 1 > 0x7fffffff:
+            raise OverflowError("more than 2^31 rows")
+        self.rows = max(n - 1, 0)
+        if n == 0:
+            return
+        if self.offset(0) < 0 or self.offset(self.rows) > self.data_view.len:
+            raise Exception("invalid offsets, they are out of the data")
+        for i in range(self.rows):
+            n = self.offset(i + 1) - self.offset(i)
+            if n < 0:
+                raise Exception("invalid offsets, they decrease at row %d" % i)
+            if n > 0x7fffffff:
+                raise OverflowError("row %d is larger than 2GB" % i)
+
+    cdef xbytes row_bytes(self, int row, bool lowercase):
+        return xbytes(self.data[self.offset(row):self.offset(row + 1)], lowercase)
+
+    property rows:
+        def __get__(self):
+            return self.rows
+
+    def __dealloc__(self):
+        if self.has_data:
+            PyBuffer_Release(&self.data_view)
+        if self.has_offsets:
+            PyBuffer_Release(&self.offsets_view)
@@ -31,7 +31,7 @@ setup(
     include_package_data=True,
     long_description_content_type="text/markdown",
     long_description=long_description,
-    install_requires=['cython>=0.29.0', 'Cython>=0.29.0'],
+    install_requires=['cython>=0.29.31', 'Cython>=0.29.31'],
     setup_requires=['Cython'],
     ext_modules = cythonize([
         "lib/cyac/util.pyx",
@@ -1,6 +1,7 @@
 #-*- coding:utf-8 -*- 
 import unittest
-from cyac import AC
+from cyac import AC, Trie, Separators, Replacements
+import pickle
 import sys
 
 class TestAC(unittest.TestCase):
@@ -15,6 +16,21 @@ class TestAC(unittest.TestCase):
         arr = [(end_, val) for val, _, end_ in ac.match(u"a aaa", sep)]
         self.assertEqual(arr, [(1, 0)])
 
+    def test_separators(self):
+        ac = AC.build([u"a", u"aa", u"b😀"])
+        sep = Separators(u" ,😀")
+        self.assertTrue(u"," in sep and ord(u"😀") in sep and u"a" not in sep)
+        self.assertEqual(list(pickle.loads(pickle.dumps(sep))), list(sep))
+        text = u"a aa,aaa b😀 a😀"
+        self.assertEqual(list(ac.match(text, sep)), list(ac.match(text, set(map(ord, u" ,😀")))))
+        self.assertEqual(list(ac.match(text, sep)), [(0, 0, 1), (1, 2, 4), (2, 9, 11), (0, 12, 13)])
+        words = Separators.word_boundaries()
+        self.assertTrue(u" " in words and u"。" in words and u"\n" in words and u"中" not in words)
+        self.assertEqual(list(ac.match(u"a。aa!a1", words)), [(0, 0, 1), (1, 2, 4)])
+        trie = Trie()
+        trie.insert(u"aa")
+        self.assertEqual(trie.replace_longest(u"aa aaa,aa", {0: u"x"}, sep), u"x aaa,x")
+
     def test_ignore_case(self):
         if sys.version_info.major < 3:
             return
@@ -46,3 +62,260 @@ class TestAC(unittest.TestCase):
         var1 = "gmailhello@gmail.comhiaa"
         lst = list(ac.match(var1, return_all=False))
         self.assertEqual(len(lst), 1)
+
+    def test_build_sorted(self):
+        ac = AC.build(iter([u"我", u"我是", u"是中"]), sorted=True)
+        arr = [(end_, val) for val, start_, end_ in ac.match(u"我是中国人")]
+        self.assertEqual(arr, [(1, 0), (2, 1), (3, 2)])
+
+    def test_add_remove(self):
+        ac = AC.build([u"我", u"我是", u"是中"])
+        self.assertEqual(ac.add(u"中国"), 3)
+        self.assertEqual(ac.add(u"我是"), 1)
+        self.assertEqual(ac.remove(u"我是"), 1)
+        self.assertEqual(ac.remove(u"我是"), -1)
+        arr = [(end_, val) for val, start_, end_ in ac.match(u"我是中国人")]
+        self.assertEqual(arr, [(1, 0), (3, 2), (4, 3)])
+        self.assertEqual(ac.add(u"国人"), 1) # reuses the removed id
+        ac.commit()
+        self.assertEqual(list(ac.match_longest(u"我是中国人")), [(0, 0, 1), (2, 1, 3), (1, 3, 5)])
+        self.assertEqual(ac.size, 4)
+
+    def test_add_remove_stream(self):
+        ac = AC.build([u"abc", u"xyz"])
+        scanner = ac.stream()
+        self.assertEqual(scanner.feed(u"zzab"), [])
+        ac.add(u"bcd")
+        ac.remove(u"xyz")
+        self.assertEqual(scanner.feed(u"cdxyz"), [(0, 2, 5), (2, 3, 6)])
+
+    def test_match_leftmost(self):
+        ac = AC.build([u"abcd", u"ab", u"bcde", u"de", u"abcdeX"])
+        self.assertEqual(list(ac.match_leftmost(u"abcde")), [(0, 0, 4)])
+        self.assertEqual(list(ac.match_leftmost(u"abcde", longest=False)), [(0, 0, 4)])
+        ac = AC.build([u"ab", u"abcd", u"bcde", u"de", u"abcdeX"])
+        self.assertEqual(list(ac.match_leftmost(u"abcde", longest=False)), [(0, 0, 2), (3, 3, 5)])
+        self.assertEqual(ac.replace_leftmost(u"xabcde", {0: u"1", 3: u"2"}, longest=False), u"x1c2")
+
+    def test_replace(self):
+        ac = AC.build([u"ab", u"abcd", u"bcde", u"de", u"中文"])
+        text = u"xabcde 中文 é"
+        reps = Replacements([u"1", b"2", u"\U0001F600", u"4", u"cn"])
+        self.assertEqual(ac.replace(text, reps), u"x2e cn é")
+        self.assertEqual(ac.replace(text, reps, "leftmost-first"), u"x1c4 cn é")
+        self.assertEqual(ac.replace(text, {0: u"1", 3: u"2"}, "all-nonoverlapping"), u"x1c2 中文 é")
+        self.assertEqual(ac.replace(text, [None, None, u"3"], "all-nonoverlapping"), text)
+        self.assertEqual(ac.replace(u"de ab", reps, sep=set([ord(u" ")])), u"4 1")
+        self.assertEqual(ac.replace(u"xyz", reps), u"xyz")
+        self.assertRaises(Exception, ac.replace, text, reps, "longest")
+        self.assertRaises(Exception, Replacements, [1])
+        ac = AC.build([u"ab", u"İ"], ignore_case=True)
+        self.assertEqual(ac.replace(u"xAbİ", [u"-", u"i"]), u"x-i")
+
+    def test_match_longest_near_prefix(self):
+        # long walks from every start switch to fail links
+        words = [u"a" * k + u"b" for k in range(1, 100)] + [u"a", u"aa b"]
+        ac = AC.build(words)
+        trie = Trie()
+        for w in words:
+            trie.insert(w)
+        sep = set([ord(u" ")])
+        for text in [u"a" * 1000 + u"b", u"aa " * 1000 + u"b"]:
+            for sep_ in [None, sep]:
+                self.assertEqual(list(ac.match_longest(text, sep_)), list(trie.match_longest(text, sep_)))
+                self.assertEqual(ac.replace_longest(text, lambda x, start, end: u"<%d>" % x, sep_),
+                                 trie.replace_longest(text, lambda x, start, end: u"<%d>" % x, sep_))
+
+    def test_match_batch(self):
+        ac = AC.build([u"a", u"aa", u"我是", u"是中"])
+        texts = [u"a aaa", u"我是中国人", u"", u"bbb"] * 10
+        sep = set([ord(" ")])
+        for n_threads in [1, 4]:
+            self.assertEqual(ac.match_batch(texts, n_threads=n_threads), [list(ac.match(t)) for t in texts])
+            self.assertEqual(ac.match_batch(texts, n_threads=n_threads, sep=sep), [list(ac.match(t, sep)) for t in texts])
+            self.assertEqual(ac.match_batch(texts, n_threads=n_threads, return_all=False), [list(ac.match(t, return_all=False)) for t in texts])
+
+    def test_match_as_arrays(self):
+        ac = AC.build([u"我", u"我是", u"是中"])
+        ids, starts, ends = ac.match(u"我是中国人", as_arrays=True)
+        self.assertEqual(list(zip(ids, starts, ends)), list(ac.match(u"我是中国人")))
+        self.assertEqual(ids.typecode, 'i')
+        ids, starts, ends = ac.match(u"", as_arrays=True)
+        self.assertEqual(len(ids), 0)
+
+    def test_match_lazy(self):
+        # the iterator scans 16KB at a time, keys and separators across chunks are found
+        ac = AC.build([u"我", u"我是", u"是中", u"ab", u"İx"], True)
+        text = (u"a" * 5461 + u"我是中 ab İX ") * 20
+        for sep in [None, set([ord(u" ")])]:
+            ids, starts, ends = ac.match(text, sep, as_arrays=True)
+            self.assertEqual(list(ac.match(text, sep)), list(zip(ids, starts, ends)))
+            data = text.encode("utf8")
+            ids, starts, ends = ac.match_bytes(data, sep, as_arrays=True)
+            self.assertEqual(list(ac.match_bytes(data, sep)), list(zip(ids, starts, ends)))
+        counters = {}
+        it = ac.match(text, counters=counters)
+        next(it)
+        self.assertLess(counters["bytes"], len(text.encode("utf8")))
+        # keys added while iterating are found in the text which isn't scanned yet
+        self.assertEqual(ac.add(u"aa"), 5)
+        self.assertIn(5, set(id_ for id_, _, _ in it))
+
+    def test_match_bytes(self):
+        ac = AC.build([u"我", u"我是", u"是中"])
+        text = u"我是中国人"
+        data = text.encode("utf8")
+        expected = [(id_, len(text[:s].encode("utf8")), len(text[:e].encode("utf8")))
+                    for id_, s, e in ac.match(text)]
+        self.assertEqual(list(ac.match_bytes(data)), expected)
+        self.assertEqual(list(ac.match_bytes(bytearray(data))), expected)
+        self.assertEqual(list(ac.match_bytes(memoryview(data))), expected)
+        sep = set([ord(u" ")])
+        self.assertEqual(list(ac.match_bytes(u"我是 中".encode("utf8"), sep)),
+                         [(1, 0, 6)])
+
+    def test_stream(self):
+        ac = AC.build([u"我", u"我是", u"是中", u"中国人"])
+        text = u"我是中国人我是"
+        expected = list(ac.match(text))
+        scanner = ac.stream()
+        matched = []
+        for i in range(0, len(text), 2):
+            matched.extend(scanner.feed(text[i:i + 2]))
+        matched.extend(scanner.flush())
+        self.assertEqual(matched, expected)
+        # utf8 chars split between chunks
+        data = text.encode("utf8")
+        matched = []
+        for i in range(len(data)):
+            matched.extend(scanner.feed(data[i:i + 1]))
+        matched.extend(scanner.flush())
+        self.assertEqual(matched, list(ac.match_bytes(data)))
+
+    def test_stream_sep(self):
+        ac = AC.build([u"ab", u"abc"])
+        sep = set([ord(u" ")])
+        scanner = ac.stream(sep)
+        self.assertEqual(scanner.feed(u"ab"), [])
+        self.assertEqual(scanner.feed(u"c ab"), [(1, 0, 3)])
+        self.assertEqual(scanner.flush(), [(0, 4, 6)])
+        scanner.feed(u"ab")
+        self.assertRaises(Exception, scanner.feed, b"ab")
+
+    def test_stats(self):
+        ac = AC.build([u"a", u"aa", u"aaa", u"b", u"ab"])
+        stats = ac.stats()
+        self.assertEqual(stats["keys"], 5)
+        self.assertEqual(stats["fail_depths"], [1, 2, 2, 1])
+        self.assertEqual(stats["memory"]["image"], ac.buff_size())
+        counters = {}
+        self.assertEqual(len(list(ac.match(u"aaab", counters=counters))), 8)
+        self.assertEqual(counters, {"bytes": 4, "fails": 2, "hits": 8})
+        # the iterator counts as it advances, arrays are counted at once
+        it = ac.match_bytes(b"aaab", counters=counters)
+        self.assertEqual(counters["bytes"], 4)
+        list(it)
+        self.assertEqual(counters, {"bytes": 8, "fails": 4, "hits": 16})
+        ac.match(u"aaab", as_arrays=True, counters=counters)
+        self.assertEqual(counters, {"bytes": 12, "fails": 6, "hits": 24})
+        ac.add(u"aaaa")
+        self.assertEqual(ac.stats()["fail_depths"], [1, 2, 2, 1, 1])
+
+    def test_match_column(self):
+        from array import array
+        ac = AC.build([u"a", u"ab", u"b", u"bc"])
+        rows = [u"abc", u"xb", u"哈a b"]
+        data = b"".join(r.encode("utf8") for r in rows)
+        offsets = array("q", [0, 3, 5, 11])
+        rows_, ids, starts, ends = ac.match_column(data, offsets)
+        self.assertEqual(list(zip(rows_, ids, starts, ends)),
+            [(r, id_, s, e) for r, text in enumerate(rows) for id_, s, e in ac.match_bytes(text.encode("utf8"))])
+        self.assertEqual([list(x) for x in ac.match_column(data, offsets, set([ord(u" ")]))], [[2], [2], [5], [6]])
+        self.assertEqual([list(x) for x in ac.match_longest_column(data, offsets)], [[0, 1, 2, 2], [1, 2, 0, 2], [0, 1, 3, 5], [2, 2, 4, 6]])
+        data, offsets = ac.replace_longest_column(data, offsets, {0: u"A", 1: u"AB", 2: u"B", 3: u"BC"})
+        self.assertEqual(data, u"ABcxB哈A B".encode("utf8"))
+        self.assertEqual(list(offsets), [0, 3, 5, 11])
+
+    def test_count(self):
+        ac = AC.build([u"a", u"ab", u"b", u"İ", u"bc"], ignore_case=True)
+        text = u"xaİb abc"
+        matched = list(ac.match(text))
+        self.assertEqual(ac.count(text), len(matched))
+        self.assertEqual(ac.count(text.encode("utf8")), len(matched))
+        self.assertTrue(ac.contains_any(text))
+        self.assertFalse(ac.contains_any(u"xyz"))
+        self.assertEqual(ac.first(text), matched[0])
+        self.assertEqual(ac.first(u"xyİ"), (3, 2, 3))
+        self.assertEqual(ac.first(u"xyİ".encode("utf8")), (3, 2, 4))
+        self.assertEqual(ac.first(u"xyz"), None)
+        sep = set([ord(u" ")])
+        self.assertEqual(ac.first(u"xa abc bc", sep), (4, 7, 9))
+        self.assertEqual(ac.count(u"xa abc bc a", sep), 2)
+        ac.remove(u"b")
+        self.assertEqual(list(ac.histogram(u"ab AB bc")), [2, 2, 0, 0, 1])
+
+    def test_text_not_grown(self):
+        # python keeps the utf8 of a non ascii str once it's asked for, matching mustn't ask for it
+        ac = AC.build([u"中文", u"é"])
+        trie = Trie.build([u"中文"])
+        text = u"中文é" * 100
+        key = u"文中é"
+        size = sys.getsizeof(text)
+        key_size = sys.getsizeof(key)
+        list(ac.match(text))
+        ac.count(text)
+        ac.replace(text, {0: u"x"})
+        list(trie.match_longest(text))
+        trie.insert(key)
+        trie.get(key)
+        self.assertEqual(sys.getsizeof(text), size)
+        self.assertEqual(sys.getsizeof(key), key_size)
+
+    def test_sharded(self):
+        from cyac.sharded import ShardedAC
+        words = [u"a", u"ab", u"abc", u"bc", u"c", u"b", u"ca", u"哈哈", u"哈"]
+        text = u"abcab 哈哈哈 cabc"
+        single = AC.build(words)
+        ac = ShardedAC.build(words, shards=3)
+        self.assertEqual(len(ac), len(words))
+        self.assertEqual(sorted(ac[id_] for id_ in ac), sorted(words))
+        for sep in [None, set([ord(u" ")])]:
+            self.assertEqual([(ac[id_], s, e) for id_, s, e in ac.match(text, sep)],
+                [(single[id_], s, e) for id_, s, e in single.match(text, sep)])
+            data = text.encode("utf8")
+            self.assertEqual([(ac[id_], s, e) for id_, s, e in ac.match_bytes(data, sep)],
+                [(single[id_], s, e) for id_, s, e in single.match_bytes(data, sep)])
+        # the state of each shard is different, so the key of the state is not the key of one automaton
+        self.assertRaises(Exception, ac.match, text, None, False)
+        self.assertRaises(Exception, ac.match_bytes, data, None, False)
+        id_ = ac.add(u"abca")
+        self.assertEqual(ac[id_], u"abca")
+        self.assertEqual(ac.get(u"abca"), id_)
+        id_ = ac.get(u"ab")
+        self.assertTrue(id_ >= 0)
+        self.assertEqual(ac.remove(u"ab"), id_)
+        self.assertEqual(ac.remove(u"ab"), -1)
+        self.assertTrue(u"ab" not in ac)
+        self.assertEqual(sorted(k for k, _ in ac.items()), sorted(set(words + [u"abca"]) - set([u"ab"])))
+
+        bs = bytearray(ac.buff_size())
+        ac.to_buff(bs)
+        for copy in [True, False]:
+            ac2 = ShardedAC.from_buff(bs, copy=copy)
+            self.assertEqual(list(ac2.match(text)), list(ac.match(text)))
+        ac.save("ac.bin")
+        with open("ac.bin", "rb") as fi:
+            self.assertEqual(bytearray(fi.read()), bs)
+        self.assertEqual(list(pickle.loads(pickle.dumps(ac)).match(text)), list(ac.match(text)))
+
+        ac = ShardedAC.build([(u"python", 1), (u"ruby", 2)], shards=4, ignore_case=True, payload_type="int")
+        self.assertEqual([(ac[id_], p) for id_, _, _, p in ac.match(u"Ruby PYTHON", with_payload=True)], [(u"ruby", 2), (u"python", 1)])
+        self.assertEqual(ac.payload(ac.get(u"RUBY")), 2)
+        bs = bytearray(ac.buff_size())
+        ac.to_buff(bs)
+        self.assertEqual(ShardedAC.from_buff(bs).get(u"RUBY"), ac.get(u"ruby"))
+
+    def test_ignore_case_match_bytes(self):
+        ac = AC.build([u"İ", u"ab"], ignore_case=True)
+        data = u"İAB".encode("utf8")
+        self.assertEqual(list(ac.match_bytes(data)), [(0, 0, 2), (1, 2, 4)])
@@ -2,6 +2,11 @@
 import unittest
 from cyac import Trie, AC
 import sys
+import struct
+import pickle
+import subprocess
+import time
+import os
 
 class TestBuff(unittest.TestCase):
     def test_buff_ac(self):
@@ -44,6 +49,247 @@ class TestBuff(unittest.TestCase):
         self._check_ac_correct(AC.from_buff(bs2, copy=True))
         self._check_ac_correct(AC.from_buff(bs2, copy=False))
 
+    def test_buff_ac_version1(self):
+        # version 1 has no output links, they are computed when loading
+        ac = AC.build([u"aİ", u"aaİ", u"aai̇", u"aai̇bİ"], True)
+        bs = bytearray(ac.buff_size())
+        ac.to_buff(bs)
+        trie_size, = struct.unpack_from("i", bs, 16)
+        array_size, = struct.unpack_from("i", bs, 12 + 28)
+        outputs_offset = 12 + trie_size + 4 * array_size
+        del bs[outputs_offset: outputs_offset + 4 * array_size]
+        struct.pack_into("ii", bs, 4, 1, len(bs))
+        self._check_ac_correct(AC.from_buff(bs, copy=True))
+        self._check_ac_correct(AC.from_buff(bs, copy=False))
+
+    def test_buff_ac_add(self):
+        # the buffer is copied before the first change
+        ac = AC.build([u"aİ", u"aaİ", u"aai̇", u"aai̇bİ"], True)
+        bs = bytearray(ac.buff_size())
+        ac.to_buff(bs)
+        ac2 = AC.from_buff(bs, copy=False)
+        ac2.remove(u"aaİ")
+        self.assertEqual(ac2.add(u"İa"), 1)
+        self.assertEqual(list(ac2.match(u"aai̇bİa")), [(0, 1, 4), (2, 0, 6), (1, 5, 7)])
+        self._check_ac_correct(AC.from_buff(bs, copy=False))
+
+    def test_buff_frozen(self):
+        ac = AC.build([u"aİ", u"aaİ", u"aai̇", u"aai̇bİ"], True)
+        size = ac.buff_size()
+        ac.freeze()
+        self.assertLess(ac.buff_size(), size)
+        ac.save("ac.bin")
+        with open("ac.bin", "rb") as fi:
+            bs = bytearray(fi.read())
+        self.assertEqual(len(bs), ac.buff_size())
+        for ac2 in [AC.from_buff(bs, copy=True), AC.from_buff(bs, copy=False), pickle.loads(pickle.dumps(ac))]:
+            self.assertTrue(ac2.frozen)
+            self._check_ac_correct(ac2)
+            self.assertEqual(ac2.add(u"aaİ"), 1)
+            with self.assertRaises(Exception):
+                ac2.add(u"b")
+
+    def test_buff_trie_frozen(self):
+        trie = Trie(ignore_case=True)
+        ids = {w : trie.insert(w) for w in [u"aİİ", u"aai̇", u"aai̇bİ"]}
+        trie.freeze()
+        bs = bytearray(trie.buff_size())
+        trie.to_buff(bs)
+        self._check_trie_correct(Trie.from_buff(bs, copy=True), ids)
+        self._check_trie_correct(Trie.from_buff(bs, copy=False), ids)
+        with self.assertRaises(Exception):
+            trie.insert(u"b")
+        self.assertEqual(trie.remove(u"b"), -1)
+
+    def test_buff_payload(self):
+        ac = AC.build([(u"aİ", 1), (u"aaİ", -2), (u"aai̇", 2 ** 40), (u"aai̇bİ", 3)], True, payload_type="int")
+        ac.save("ac.bin")
+        with open("ac.bin", "rb") as fi:
+            bs = bytearray(fi.read())
+        for ac2 in [AC.from_buff(bs, copy=True), AC.from_buff(bs, copy=False), pickle.loads(pickle.dumps(ac))]:
+            self.assertEqual(ac2.payload_type, "int")
+            self._check_ac_correct(ac2)
+            self.assertEqual(list(ac2.match(u"aai̇bİa", with_payload=True)), [(1, 0, 4, 2 ** 40), (0, 1, 4, 1), (2, 0, 6, 3)])
+            self.assertEqual(ac2.add(u"aai̇", 4), 1)
+            self.assertEqual(ac2.payload(1), 4)
+        self.assertEqual(AC.from_buff(bs, copy=False).payload(1), 2 ** 40)
+
+    def test_buff_key_table(self):
+        trie = Trie.build([(u"aİ", 1), (u"aaİ", 2), (u"aai̇", 3), (u"aai̇bİ", 4)], ignore_case=True, payload_type="int")
+        trie.build_key_table()
+        trie.save("trie.bin")
+        with open("trie.bin", "rb") as fi:
+            bs = bytearray(fi.read())
+        trie.freeze()
+        for trie2 in [Trie.from_buff(bs, copy=True), Trie.from_buff(bs, copy=False), pickle.loads(pickle.dumps(trie)), trie]:
+            self.assertTrue(trie2.has_key_table)
+            self.assertEqual(list(trie2.items()), [(u"ai̇", 0), (u"aai̇", 1), (u"aai̇bi̇", 2)])
+        trie2 = Trie.from_buff(bs, copy=True)
+        self.assertEqual(trie2.insert(u"b", 5), 3)
+        self.assertEqual([trie2[3], trie2.payload(3)], [u"b", 5])
+        # a trie sharing the buffer copies it before the first change
+        image = bytes(bs)
+        trie3 = Trie.from_buff(bs, copy=False)
+        trie3.build_key_table()
+        self.assertEqual(trie3.insert(u"b", 5), 3)
+        self.assertEqual([trie3[3], trie3.payload(3)], [u"b", 5])
+        self.assertEqual(bytes(bs), image)
+        ac = AC.build([u"aİ", u"aaİ", u"aai̇", u"aai̇bİ"], True)
+        ac.build_key_table()
+        ac.save("ac.bin")
+        with open("ac.bin", "rb") as fi:
+            ac2 = AC.from_buff(bytearray(fi.read()), copy=False)
+        self.assertTrue(ac2.has_key_table)
+        self._check_ac_correct(ac2)
+        self.assertEqual(ac2[2], u"aai̇bi̇")
+
+    def test_buff_key_table_invalid(self):
+        trie = Trie.build([u"hello中文", u"world"])
+        trie.build_key_table()
+        bs = bytearray(trie.buff_size())
+        trie.to_buff(bs)
+        self.assertEqual(list(Trie.from_buff(bs, verify=True)), [0, 1])
+        # the keys in the key table are only found in the blob, the trie keeps single bytes
+        pos = bs.find(u"hello中文".encode("utf8"))
+        for offset, byte in [(1, b"a"), (5, b"\xff")]:
+            broken = bytearray(bs)
+            broken[pos + offset:pos + offset + 1] = byte
+            self.assertRaises(Exception, Trie.from_buff, broken, verify=True)
+
+    def test_pickle_buffer(self):
+        if sys.version_info < (3, 8):
+            return
+        ac = AC.build([u"aİ", u"aaİ", u"aai̇", u"aai̇bİ"], True)
+        self._check_ac_correct(pickle.loads(pickle.dumps(ac, protocol=5)))
+        buffers = []
+        data = pickle.dumps(ac, protocol=5, buffer_callback=buffers.append)
+        self.assertEqual([b.raw().nbytes for b in buffers], [ac.buff_size()])
+        self.assertLess(len(data), 100)
+        ac2 = pickle.loads(data, buffers=buffers)
+        self._check_ac_correct(ac2)
+        # an automaton sharing a buffer passes the same buffer
+        buffers2 = []
+        pickle.dumps(ac2, protocol=5, buffer_callback=buffers2.append)
+        self.assertEqual(buffers2[0].raw(), buffers[0].raw())
+        ac2.add(u"b")
+        self._check_ac_correct(pickle.loads(data, buffers=buffers))
+        trie = Trie.build([u"aİİ", u"aai̇"], ignore_case=True)
+        data = pickle.dumps(trie, protocol=5, buffer_callback=buffers.append)
+        trie2 = pickle.loads(data, buffers=buffers[-1:])
+        self.assertEqual(list(trie2.items()), list(trie.items()))
+        self.assertTrue(trie2.stats()["shared"])
+        image = bytes(buffers[-1].raw())
+        trie2.insert(u"b")
+        trie2.remove(u"aai̇")
+        self.assertFalse(trie2.stats()["shared"])
+        self.assertEqual(list(trie2), [0, 2])
+        self.assertEqual(bytes(buffers[-1].raw()), image)
+
+    def test_shared_memory(self):
+        if sys.version_info < (3, 8):
+            return
+        from cyac.shm import publish, attach
+        shm = publish(AC.build([u"aİ", u"aaİ", u"aai̇", u"aai̇bİ"], True))
+        try:
+            ac, block = attach(shm.name)
+            self._check_ac_correct(ac)
+            del ac
+            block.close()
+            # the attached block isn't unlinked with the attaching process, or by its resource tracker after it
+            code = "from cyac.shm import attach; ac, block = attach(%r); del ac; block.close()" % shm.name
+            subprocess.check_call([sys.executable, "-c", code])
+            for _ in range(10):
+                time.sleep(0.02)
+                ac, block = attach(shm.name)
+                self._check_ac_correct(ac)
+                del ac
+                block.close()
+        finally:
+            shm.close()
+            shm.unlink()
+
+    def test_buff_large(self):
+        # images over 2GB have FLAG_LARGE and a long long size, or version 3 for automata
+        trie = Trie.build([u"aİİ", u"aai̇", u"aai̇bİ"], ignore_case=True)
+        ids = dict((k, trie.get(k)) for k in [u"aİİ", u"aai̇", u"aai̇bİ"])
+        bs = bytearray(trie.buff_size())
+        trie.to_buff(bs)
+        magic, size = struct.unpack("<Ii", bs[:8])
+        large = struct.pack("<IIq", 0xACACACAF, 4, size + 8) + bs[8:]
+        self._check_trie_correct(Trie.from_buff(large), ids)
+        self.assertRaises(Exception, Trie.from_buff, large[:-1])
+
+        ac = AC.build([u"aİ", u"aaİ", u"aai̇", u"aai̇bİ"], True)
+        bs = bytearray(ac.buff_size())
+        ac.to_buff(bs)
+        magic, version, size = struct.unpack("<IIi", bs[:12])
+        self.assertEqual(version, 2)
+        large = struct.pack("<IIq", magic, 3, size + 4) + bs[12:]
+        self._check_ac_correct(AC.from_buff(large))
+        self._check_ac_correct(AC.from_buff(large, copy=False))
+
+    def test_load(self):
+        trie = Trie.build([u"aİİ", u"aai̇", u"aai̇bİ"], ignore_case=True)
+        ids = dict((k, trie.get(k)) for k in [u"aİİ", u"aai̇", u"aai̇bİ"])
+        ac = AC.build([u"aİ", u"aaİ", u"aai̇", u"aai̇bİ"], True)
+        try:
+            trie.save("trie_load.bin", checksum=True)
+            ac.save("ac_load.bin", checksum=True)
+            for mmap in [True, False]:
+                self._check_trie_correct(Trie.load("trie_load.bin", mmap=mmap, checksum=True), ids)
+                self._check_ac_correct(AC.load("ac_load.bin", mmap=mmap, populate=True, checksum=True))
+            # a mapped trie or automaton copies it before the first change
+            self.assertEqual(Trie.load("trie_load.bin").insert(u"b"), 3)
+            self._check_trie_correct(Trie.load("trie_load.bin", checksum=True), ids)
+            self.assertEqual(AC.load("ac_load.bin").add(u"b"), 3)
+            # the checksum trailer is ignored by from_buff
+            with open("ac_load.bin", "rb") as fi:
+                self._check_ac_correct(AC.from_buff(bytearray(fi.read()), verify=True))
+            ac.save("ac_load.bin")
+            self._check_ac_correct(AC.load("ac_load.bin"))
+            self.assertRaises(Exception, AC.load, "ac_load.bin", checksum=True)
+        finally:
+            os.remove("trie_load.bin")
+            os.remove("ac_load.bin")
+
+    def test_load_invalid(self):
+        ac = AC.build([u"aİ", u"aaİ", u"aai̇", u"aai̇bİ"], True)
+        bs = bytearray(ac.buff_size())
+        ac.to_buff(bs)
+        self.assertRaises(Exception, AC.from_buff, bs[:-4])
+        self.assertRaises(Exception, AC.from_buff, bs[:len(bs) // 2], copy=False)
+        # a node pointing to a parent out of the trie
+        array_size, = struct.unpack_from("i", bs, 12 + 28)
+        broken = bytearray(bs)
+        struct.pack_into("i", broken, 12 + 52 + 12 * 1 + 4, array_size + 1)
+        self.assertRaises(Exception, AC.from_buff, broken, verify=True)
+        try:
+            ac.save("ac_load.bin", checksum=True)
+            with open("ac_load.bin", "r+b") as fo:
+                fo.seek(100)
+                b = fo.read(1)
+                fo.seek(100)
+                fo.write(bytes([b[0] ^ 1]))
+            self.assertRaises(Exception, AC.load, "ac_load.bin", checksum=True)
+        finally:
+            os.remove("ac_load.bin")
+
+    def test_load_truncated_header(self):
+        ac = AC.build([u"aİ", u"aaİ", u"aai̇", u"aai̇bİ"], True)
+        bs = bytearray(ac.buff_size())
+        ac.to_buff(bs)
+        try:
+            for size in [0, 3, 7, 15]:
+                for copy in [True, False]:
+                    self.assertRaises(ValueError, AC.from_buff, bytes(bs[:size]), copy=copy)
+                    self.assertRaises(ValueError, Trie.from_buff, bytes(bs[:size]), copy=copy)
+                with open("ac_load.bin", "wb") as fo:
+                    fo.write(bs[:size])
+                for mmap in [True, False]:
+                    self.assertRaises(ValueError, AC.load, "ac_load.bin", mmap=mmap)
+        finally:
+            os.remove("ac_load.bin")
+
     def _check_ac_correct(self, ac):
         self.assertEqual(ac.size, 3)
         arr = [(end_, val) for val, start_, end_ in ac.match(u"aai̇bİa")]
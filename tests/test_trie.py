@@ -1,6 +1,7 @@
 #-*- coding:utf-8 -*- 
 import unittest, sys
 import os
+import pickle
 from cyac import Trie
 
 class TestTrie(unittest.TestCase):
@@ -87,6 +88,27 @@ class TestTrie(unittest.TestCase):
             (ids[u"City"], len(u"New York "), len(u"New York City"))
         ])
 
+    def test_match_longest_as_arrays(self):
+        trie = Trie()
+        ids = {w : trie.insert(w) for w in [u"New York", u"New", u"York", u"York City", u"City", u"City is"]}
+        ids_, starts, ends = trie.match_longest(u"New York City isA", as_arrays=True)
+        self.assertEqual(list(zip(ids_, starts, ends)), list(trie.match_longest(u"New York City isA")))
+        ids_, ends = trie.prefix(u"New York City", as_arrays=True)
+        self.assertEqual(list(zip(ids_, ends)), [(ids[u"New"], 3), (ids[u"New York"], 8)])
+
+    def test_match_longest_bytes(self):
+        trie = Trie()
+        ids = {w : trie.insert(w) for w in [u"中国", u"中", u"国人", u"人"]}
+        text = u"中国人 中"
+        data = text.encode("utf8")
+        sep = set([ord(" ")])
+        for sep_ in [None, sep]:
+            expected = [(id_, len(text[:s].encode("utf8")), len(text[:e].encode("utf8")))
+                        for id_, s, e in trie.match_longest(text, sep_)]
+            self.assertEqual(list(trie.match_longest_bytes(data, sep_)), expected)
+            self.assertEqual(list(trie.match_longest_bytes(bytearray(data), sep_)), expected)
+        self.assertEqual(list(trie.prefix_bytes(data)), [(ids[u"中"], 3), (ids[u"中国"], 6)])
+
     def test_ignore_case_match_longest(self):
         if sys.version_info.major < 3:
             return
@@ -227,3 +249,210 @@ class TestTrie(unittest.TestCase):
         
         trie.insert("hello2")
         trie[0]
+
+    def test_build(self):
+        words = [u"ruby", u"rubx", u"", u"rab", u"Rub", u"ruby", u"rb", u"中文"]
+        trie = Trie()
+        ids = [trie.insert(w) for w in words]
+        built = Trie.build(iter(words))
+        self.assertEqual(len(built), len(trie))
+        self.assertEqual(list(built.items()), list(trie.items()))
+        self.assertEqual([built.get(w) for w in words], ids)
+        self.assertEqual(list(built.prefix(u"ruby on rails")), list(trie.prefix(u"ruby on rails")))
+        self.assertEqual(built.insert(u"rubies"), trie.insert(u"rubies"))
+        self.assertEqual(built.remove(u"rub"), -1)
+        self.assertEqual(built.remove(u"ruby"), ids[0])
+
+    def test_ordered_insert(self):
+        trie = Trie(ordered=True)
+        ids = [trie.insert(w) for w in [u"fabce", u"a", u"hagg", u"fab", u"c"]]
+        self.assertEqual([trie[i] for i in trie.predict(u"")], [u"a", u"c", u"fab", u"hagg", u"fabce"])
+        built = Trie.build([u"fabce", u"a", u"hagg"], ordered=True)
+        self.assertEqual([built.insert(w) for w in [u"fab", u"c"]], ids[3:])
+        self.assertEqual([built[i] for i in built.predict(u"")], [u"a", u"c", u"fab", u"hagg", u"fabce"])
+
+    def test_build_sorted(self):
+        trie = Trie.build([u"Rab", u"rb", u"RB", u"rub", u"Ruby"], ignore_case=True, sorted=True)
+        self.assertEqual(list(trie.items()), [(u"rab", 0), (u"rb", 1), (u"rub", 2), (u"ruby", 3)])
+        with self.assertRaises(Exception):
+            Trie.build([u"rub", u"rab"], sorted=True)
+
+    def test_many(self):
+        words = [u"ruby", u"Rubx", u"", u"中文", u"RUBY", u"İa"]
+        trie = Trie(ignore_case=True)
+        ids = trie.insert_many(words)
+        self.assertEqual(list(ids), [trie.get(w) for w in words])
+        self.assertEqual(list(ids), [0, 1, -1, 2, 0, 3])
+        self.assertEqual(list(trie.get_many([u"rubx", u"RUBX", u"rub", u"i̇a"])), [1, 1, -1, 3])
+        self.assertEqual(list(trie.remove_many([u"RUBX", u"RUBX", u"中文"])), [1, -1, 2])
+        self.assertEqual(list(trie.items()), [(u"ruby", 0), (u"i̇a", 3)])
+        trie = Trie(payload_type="int")
+        self.assertEqual(list(trie.insert_many(iter([u"a", u"b", u"a"]), [1, 2, 3])), [0, 1, 0])
+        self.assertEqual([trie.payload(0), trie.payload(1)], [3, 2])
+        trie = Trie(payload_type="int")
+        with self.assertRaises(Exception):
+            trie.insert_many([u"a", u"b", u"c"], [1])
+        self.assertEqual(len(trie), 0)
+        with self.assertRaises(Exception):
+            trie.insert_many(iter([u"a", u"b", u"c"]), iter([1]))
+        with self.assertRaises(Exception):
+            trie.insert_many(iter([u"a"]), iter([1, 2]))
+
+    def test_keys_buffer(self):
+        trie = Trie.build([u"ruby", u"Rub", u"中文", u"rb"], ignore_case=True)
+        trie.remove(u"rub")
+        data, offsets = trie.keys_buffer()
+        self.assertEqual(list(offsets), [0, 4, 4, 10, 12])
+        self.assertEqual(data, u"ruby中文rb".encode("utf8"))
+        self.assertFalse(trie.has_key_table)
+        trie.build_key_table()
+        self.assertTrue(trie.has_key_table)
+        self.assertEqual(trie.keys_buffer(), (data, offsets))
+        self.assertEqual(trie.insert(u"RUBX"), 1)
+        self.assertEqual(trie.insert(u"py"), 4)
+        trie.remove(u"ruby")
+        self.assertEqual([trie[1], trie[4]], [u"rubx", u"py"])
+        self.assertEqual(list(trie.items()), [(u"rubx", 1), (u"中文", 2), (u"rb", 3), (u"py", 4)])
+        data, offsets = trie.keys_buffer()
+        self.assertEqual(data, u"rubx中文rbpy".encode("utf8"))
+        trie.drop_key_table()
+        self.assertEqual(trie.keys_buffer(), (data, offsets))
+
+    def test_predict_limit(self):
+        trie = Trie()
+        for w in [u"ruby", u"rubx", u"rb", u"r中", u"rub", u"py"]:
+            trie.insert(w)
+        self.assertEqual(list(trie.predict(u"r", order="lex")), [2, 4, 1, 0, 3])
+        self.assertEqual(list(trie.predict(u"r", limit=2, order="lex")), [2, 4])
+        self.assertEqual(len(list(trie.predict(u"r", limit=3))), 3)
+        self.assertEqual(list(trie.predict(u"r", limit=0)), [])
+        with self.assertRaises(ValueError):
+            list(trie.predict(u"r", limit=-1))
+        # removing the last key unlinks it from the root
+        trie = Trie()
+        trie.insert(u"aba")
+        trie.remove(u"aba")
+        trie.insert(u"abbbb")
+        self.assertEqual(list(trie.predict(u"")), [0])
+
+    def test_predict_top(self):
+        trie = Trie.build([(u"python", 10), (u"perl", 2), (u"php", 5), (u"pyc", -1), (u"ruby", 20)], payload_type="int")
+        self.assertEqual(list(trie.predict_top(u"p", 2)), [0, 2])
+        self.assertEqual(list(trie.predict_top(u"", 10, with_payload=True)), [(4, 20), (0, 10), (2, 5), (1, 2), (3, -1)])
+        trie.insert(u"pyx", 7)
+        trie.set_payload(1, 8)
+        self.assertEqual(list(trie.predict_top(u"p", 3)), [0, 1, 5])
+        trie.remove(u"python")
+        self.assertEqual(list(trie.predict_top(u"py", 3)), [5, 3])
+        trie = Trie.build([(u"a", -0.5), (u"ab", 1.5), (u"b", 2.5)], payload_type="float")
+        self.assertEqual(list(trie.predict_top(u"a", 5)), [1, 0])
+        with self.assertRaises(Exception):
+            list(Trie().predict_top(u"a", 1))
+
+    def test_predict_top_ties(self):
+        # keys of the same payload come out by id, whatever the order of the trie
+        keys = [u"pz", u"pb", u"pab", u"p", u"pa", u"q", u"pzz"]
+        trie = Trie.build([(k, 5 if i != 5 else 9) for i, k in enumerate(keys)], payload_type="int")
+        self.assertEqual(list(trie.predict_top(u"", 7)), [5, 0, 1, 2, 3, 4, 6])
+        self.assertEqual(list(trie.predict_top(u"p", 3)), [0, 1, 2])
+        trie.set_payload(4, 9)
+        self.assertEqual(list(trie.predict_top(u"p", 3)), [4, 0, 1])
+
+    def test_predict_top_saved(self):
+        # a frozen trie saves the max weights, a loaded one doesn't build them again
+        trie = Trie.build([(u"python", 10), (u"perl", 2), (u"php", 5), (u"pyc", -1), (u"ruby", 20)], payload_type="int")
+        expected = list(trie.predict_top(u"p", 3))
+        trie.freeze()
+        bs = bytearray(trie.buff_size())
+        trie.to_buff(bs)
+        self.assertEqual(trie.buff_size(), len(bs))
+        for copy in [True, False]:
+            trie2 = Trie.from_buff(bs, copy=copy, verify=True)
+            self.assertGreater(trie2.stats()["memory"]["node_weights"], 0)
+            self.assertEqual(list(trie2.predict_top(u"p", 3)), expected)
+        self.assertEqual(list(pickle.loads(pickle.dumps(trie)).predict_top(u"p", 3)), expected)
+
+    def test_fuzzy(self):
+        trie = Trie.build([u"python", u"pythons", u"typhon", u"中文字", u"py"])
+        self.assertEqual(list(trie.fuzzy(u"pyton")), [(0, 1)])
+        self.assertEqual(list(trie.fuzzy(u"pythn", 2)), [(0, 1), (1, 2)])
+        self.assertEqual(list(trie.fuzzy(u"中字", 1)), [(3, 1)])
+        self.assertEqual(list(trie.fuzzy(u"python", 0)), [(0, 0)])
+        self.assertEqual(list(Trie(ignore_case=True).fuzzy(u"a")), [])
+        trie = Trie.build([u"python", u"ruby"], ignore_case=True)
+        self.assertEqual(list(trie.fuzzy(u"PYTON")), [(0, 1)])
+        self.assertEqual(list(trie.match_longest_fuzzy(u"Pyton and rubby", 1, set([ord(u" ")]))), [(0, 0, 5, 1), (1, 10, 15, 1)])
+        self.assertEqual(list(trie.match_longest_fuzzy(u"xpython rubyist", 1)), [(0, 1, 7, 0), (1, 8, 12, 0)])
+        self.assertEqual(list(trie.match_longest_fuzzy(u"rubyist", 1, set([ord(u" ")]))), [])
+        # the walk doesn't recurse for each char of a long key
+        trie = Trie.build([u"a" * 200000, u"中" * 100000])
+        self.assertEqual(list(trie.fuzzy(u"a" * 200000, 0)), [(0, 0)])
+        self.assertEqual(list(trie.fuzzy(u"中" * 99999 + u"文", 1)), [(1, 1)])
+        self.assertEqual(list(trie.match_longest_fuzzy(u"b" + u"a" * 199999, 1)), [(0, 0, 200000, 1)])
+
+    def test_match_longest_column(self):
+        from array import array
+        trie = Trie.build([u"python", u"py", u"ruby", u"İ"], ignore_case=True)
+        rows = [u"python ruby", u"", u"İpy", u"perl"]
+        data = b"".join(r.encode("utf8") for r in rows)
+        for typecode in "iq":
+            offsets = array(typecode, [0, 11, 11, 15, 19])
+            self.assertEqual([list(x) for x in trie.match_longest_column(data, offsets)],
+                [[0, 0, 2, 2], [0, 2, 3, 1], [0, 7, 0, 2], [6, 11, 2, 4]])
+            out, new_offsets = trie.replace_longest_column(data, offsets, lambda id_, start, end: u"<%d>" % id_)
+            self.assertEqual(new_offsets.typecode, typecode)
+            self.assertEqual([out[new_offsets[i]:new_offsets[i + 1]].decode("utf8") for i in range(4)],
+                [u"<0> <2>", u"", u"<3><1>", u"perl"])
+        self.assertRaises(Exception, trie.match_longest_column, data, array("i", [0, 11, 5]))
+        self.assertRaises(Exception, trie.match_longest_column, data, array("i", [0, 20]))
+        self.assertRaises(Exception, trie.match_longest_column, data, array("h", [0, 11]))
+
+    def test_stats(self):
+        trie = Trie()
+        for i in range(1000):
+            trie.insert(u"%x" % (i * 7919))
+        stats = trie.stats()
+        self.assertEqual((stats["keys"], stats["ids"]), (1000, 1000))
+        self.assertTrue(0 < stats["fill"] <= 1)
+        self.assertEqual(stats["blocks"]["total"], stats["array_size"] >> 8)
+        self.assertTrue(sum(stats["relocations"]) > 0)
+        self.assertEqual(stats["memory"]["image"], trie.buff_size())
+        trie = Trie.build([k for k, _ in trie.items()])
+        self.assertEqual(trie.stats()["relocations"], [])
+        trie.freeze()
+        self.assertEqual(trie.stats()["blocks"]["open"], 0)
+
+    def test_payload(self):
+        trie = Trie(payload_type="float")
+        self.assertEqual(trie.insert(u"ruby", 0.5), 0)
+        self.assertEqual(trie.insert(u"rb"), 1)
+        self.assertEqual(trie.insert(u"ruby", 2.5), 0)
+        self.assertEqual([trie.payload(0), trie.payload(1)], [2.5, 0.0])
+        trie.set_payload(1, 1.5)
+        self.assertEqual(list(trie.predict(u"r", with_payload=True)), [(1, 1.5), (0, 2.5)])
+        self.assertEqual(list(trie.match_longest(u"ruby rb", with_payload=True)), [(0, 0, 4, 2.5), (1, 5, 7, 1.5)])
+        self.assertEqual(list(trie.match_longest(u"ruby rb", as_arrays=True, with_payload=True)[3]), [2.5, 1.5])
+        with self.assertRaises(AttributeError):
+            trie.payload(2)
+        with self.assertRaises(Exception):
+            Trie().insert(u"ruby", 1)
+        built = Trie.build([(u"ruby", b"x"), (u"rb", b""), (u"ruby", b"yz")], payload_type="bytes")
+        self.assertEqual(list(built.predict(u"r", with_payload=True)), [(1, b""), (0, b"yz")])
+        # payloads of a repeated key which are replaced in build are garbage too
+        built = Trie.build([(u"a", b"x"), (u"a", b"y" * 100), (u"b", b"z")], payload_type="bytes")
+        self.assertEqual([built.payload(0), built.stats()["memory"]["payload_garbage"]], [b"y" * 100, 1])
+        built = Trie.build([(u"a", b"x" * 100), (u"a", b"y"), (u"b", b"z")], payload_type="bytes")
+        self.assertEqual([built.payload(0), built.payload(1), built.stats()["memory"]["payload_garbage"]], [b"y", b"z", 0])
+        stats = built.stats()
+        self.assertEqual(stats["memory"]["payloads"], 8 * stats["key_capacity"] + 2)
+        # replaced bytes don't pile up in the blob
+        trie = Trie(payload_type="bytes")
+        trie.insert(u"rb", b"rb")
+        size = trie.stats()["memory"]["payloads"]
+        for i in range(1000):
+            trie.insert(u"ruby", b"x" * 100)
+            trie.set_payload(0, b"y" * 10)
+        self.assertLess(trie.stats()["memory"]["payloads"], size + 1000)
+        trie.remove(u"rb")
+        trie.freeze()
+        self.assertEqual([trie.payload(1), trie.stats()["memory"]["payloads"]], [b"x" * 100, 8 * 2 + 100])
@@ -11,6 +11,17 @@ class TestXString(unittest.TestCase):
         for i, c in enumerate(txt):
             self.assertEqual(s.char_at(i), ord(c))
 
+    def test_kinds(self):
+        # one, two and four bytes storage of str, and a nul char
+        for txt in [u"ab c", u"a\x00éb", u"中é文a", u"\U0001F600中a\x00"]:
+            s = xstring(txt)
+            self.assertEqual(s.char_num, len(txt))
+            self.assertEqual(s.bytes, txt.encode("utf8"))
+            self.assertEqual([s.char_at(i) for i in range(len(txt))], [ord(c) for c in txt])
+        from cyac import Trie
+        trie = Trie.build([u"\U0001F600中", u"é"])
+        self.assertEqual(list(trie.match_longest(u"x\x00é\U0001F600中")), [(1, 2, 3), (0, 3, 5)])
+
     def test_lowercase(self):
         if sys.version_info.major < 3:
             return
@@ -20,5 +31,19 @@ class TestXString(unittest.TestCase):
         self.assertEqual(align.lowercase_xstring.bytes, txt.lower().encode("utf8"))
         self.assertEqual(align.alignment_array(), [0,1,2,2,3])
 
+    def test_lowercase_lazy(self):
+        if sys.version_info.major < 3:
+            return
+        for txt in [u"aaİbΣ ΣΑ", u"ABcȺ", u"中文Ab", u"ǅǄ ẞ"]:
+            align = ignore_case_alignment(xstring(txt))
+            self.assertEqual(align.lowercase_xstring.bytes, txt.lower().encode("utf8"))
+        s = xstring(u"中文ab")
+        align = ignore_case_alignment(s)
+        self.assertIs(align.lowercase_xstring, s)
+        self.assertEqual(align.alignment_array(), [0, 1, 2, 3])
+        align = ignore_case_alignment(xstring(u"ABȺ"))
+        self.assertEqual(align.lowercase_xstring.bytes, u"abⱥ".encode("utf8"))
+        self.assertEqual(align.alignment_array(), [0, 1, 2])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file